@@ -0,0 +1,282 @@
+'''
+Admission control in front of the handlers: per-user token buckets per action, concurrency
+limits on heavy actions and a clamped page size. Rejected requests get 429 with Retry-After.
+
+Each function declares its rules keyed "METHOD:action", "METHOD" or "*" (the first that
+matches applies). Buckets are per user, or per client address before sign-in. They live
+in Redis when ADMISSION_REDIS_URL is set and the redis package is installed, so every
+instance shares them; otherwise each instance keeps its own. A store error admits the
+request. Decisions and counters are added to the request log line.
+Identical copy lives in every backend function folder, since each folder is deployed on its own.
+'''
+
+import functools
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Callable, Optional, Tuple
+import instrument
+import response
+import tokens
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+ADMISSION_ENABLED = os.environ.get('ADMISSION_ENABLED', '1') != '0'
+ADMISSION_REDIS_URL = os.environ.get('ADMISSION_REDIS_URL')
+# JSON object "<function>:<rule key>" -> [rate, burst] or [rate, burst, concurrency]
+ADMISSION_OVERRIDES = os.environ.get('ADMISSION_OVERRIDES', '')
+CONCURRENCY_WAIT = float(os.environ.get('ADMISSION_CONCURRENCY_WAIT', '0.2'))
+MAX_BUCKETS = int(os.environ.get('ADMISSION_MAX_BUCKETS', '50000'))
+SLOT_TTL = 60
+
+
+class Rule:
+    """rate requests per second on average, bursts of up to burst, at most concurrency at once"""
+
+    def __init__(self, rate: float, burst: int, concurrency: Optional[int] = None):
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+
+
+class LocalStore:
+    """Buckets and running counts of this instance only"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets: 'OrderedDict[str, Tuple[float, float]]' = OrderedDict()
+        self._running: Dict[str, int] = {}
+        self._freed = threading.Condition(self._lock)
+
+    def take(self, key: str, rule: Rule, now: float) -> float:
+        """Take a token; returns 0 when admitted, otherwise seconds until one is available"""
+        with self._lock:
+            tokens_left, stamp = self._buckets.pop(key, (float(rule.burst), now))
+            tokens_left = min(float(rule.burst), tokens_left + (now - stamp) * rule.rate)
+            wait = 0.0
+            if tokens_left >= 1:
+                tokens_left -= 1
+            else:
+                wait = (1 - tokens_left) / rule.rate
+            self._buckets[key] = (tokens_left, now)
+            if len(self._buckets) > MAX_BUCKETS:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def acquire(self, key: str, limit: int, timeout: float) -> bool:
+        with self._freed:
+            if not self._freed.wait_for(lambda: self._running.get(key, 0) < limit, timeout):
+                return False
+            self._running[key] = self._running.get(key, 0) + 1
+            return True
+
+    def release(self, key: str) -> None:
+        with self._freed:
+            self._running[key] -= 1
+            self._freed.notify_all()
+
+    def running(self) -> Dict[str, int]:
+        with self._lock:
+            return {key: count for key, count in self._running.items() if count}
+
+
+class RedisStore:
+    """Shared buckets: one hash per bucket updated by a script, one counter per concurrency slot"""
+
+    TAKE = """
+        local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+        local state = redis.call('HMGET', KEYS[1], 't', 'ts')
+        local left = tonumber(state[1]) or burst
+        left = math.min(burst, left + math.max(now - (tonumber(state[2]) or now), 0) * rate)
+        local wait = 0
+        if left >= 1 then left = left - 1 else wait = (1 - left) / rate end
+        redis.call('HSET', KEYS[1], 't', left, 'ts', now)
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+        return tostring(wait)
+    """
+
+    def __init__(self, url: str):
+        self._redis = redis.Redis.from_url(url, decode_responses=True, socket_timeout=0.5)
+        self._take = self._redis.register_script(self.TAKE)
+        self._held: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rule: Rule, now: float) -> float:
+        return float(self._take(keys=[f'admission:bucket:{key}'], args=[rule.rate, rule.burst, now]))
+
+    def acquire(self, key: str, limit: int, timeout: float) -> bool:
+        slot = f'admission:running:{key}'
+        deadline = time.monotonic() + timeout
+        while True:
+            pipe = self._redis.pipeline()
+            pipe.incr(slot)
+            # A slot held by an instance that died frees itself once the counter expires
+            pipe.expire(slot, SLOT_TTL)
+            if pipe.execute()[0] <= limit:
+                with self._lock:
+                    self._held[key] = self._held.get(key, 0) + 1
+                return True
+            self._redis.decr(slot)
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.02)
+
+    def release(self, key: str) -> None:
+        self._redis.decr(f'admission:running:{key}')
+        with self._lock:
+            self._held[key] -= 1
+
+    def running(self) -> Dict[str, int]:
+        with self._lock:
+            return {key: count for key, count in self._held.items() if count}
+
+
+store = RedisStore(ADMISSION_REDIS_URL) if ADMISSION_REDIS_URL and redis is not None else LocalStore()
+
+_stats_lock = threading.Lock()
+_stats: Dict[str, Any] = {
+    'admitted': 0,
+    'rateLimited': 0,
+    'concurrencyLimited': 0,
+    'clamped': 0,
+    'storeErrors': 0,
+    'rejectedBy': {}
+}
+
+
+def _count(name: str, rule_key: Optional[str] = None) -> None:
+    with _stats_lock:
+        _stats[name] += 1
+        if rule_key is not None:
+            _stats['rejectedBy'][rule_key] = _stats['rejectedBy'].get(rule_key, 0) + 1
+
+
+def stats() -> Dict[str, Any]:
+    """Counters since this instance started, plus heavy requests running right now"""
+    with _stats_lock:
+        snapshot = dict(_stats, rejectedBy=dict(_stats['rejectedBy']))
+    snapshot['running'] = store.running()
+    return snapshot
+
+
+def page_size(params: Dict[str, Any], default: int, maximum: int) -> int:
+    """Requested page size clamped to 1..maximum; a missing or malformed limit gets the default"""
+    try:
+        requested = int(params.get('limit', default))
+    except (TypeError, ValueError):
+        requested = default
+    if requested > maximum:
+        _count('clamped')
+    return min(max(requested, 1), maximum)
+
+
+def with_overrides(function: str, rules: Dict[str, Rule]) -> Dict[str, Rule]:
+    if not ADMISSION_OVERRIDES:
+        return rules
+    merged = dict(rules)
+    for name, values in json.loads(ADMISSION_OVERRIDES).items():
+        target, _, key = name.partition(':')
+        if target == function and key:
+            merged[key] = Rule(*values)
+    return merged
+
+
+def _action(event: Dict[str, Any], method: str) -> Optional[str]:
+    if method in ('GET', 'DELETE'):
+        return (event.get('queryStringParameters') or {}).get('action')
+    body = event.get('body') or ''
+    # Only bodies that name an action are parsed twice; large message batches always do
+    if '"action"' not in body:
+        return None
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None
+    return data.get('action') if isinstance(data, dict) else None
+
+
+def _client(event: Dict[str, Any]) -> str:
+    user_id = tokens.authenticate(event)
+    if user_id:
+        return f'u{user_id}'
+    identity = (event.get('requestContext') or {}).get('identity') or {}
+    headers = event.get('headers') or {}
+    forwarded = headers.get('X-Forwarded-For') or headers.get('x-forwarded-for') or ''
+    return 'ip' + (identity.get('sourceIp') or forwarded.split(',')[0].strip() or 'unknown')
+
+
+def too_many(retry_after: float) -> Dict[str, Any]:
+    seconds = max(1, math.ceil(retry_after))
+    return response.json(429, {'error': 'Too many requests', 'retryAfter': seconds}, {
+        'Retry-After': str(seconds),
+        'Access-Control-Expose-Headers': 'Retry-After'
+    })
+
+
+def admitted(function: str, rules: Dict[str, Rule]) -> Callable:
+    """Wrap a cloud function handler with the rate and concurrency rules of that function"""
+    rules = with_overrides(function, rules)
+
+    def decorate(handler: Callable) -> Callable:
+
+        @functools.wraps(handler)
+        def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+            method = event.get('httpMethod', 'GET')
+            if method == 'OPTIONS':
+                return handler(event, context)
+            action = _action(event, method)
+            # The log line reads only query parameters on its own; POST actions come from the body
+            instrument.annotate('action', action)
+            if not ADMISSION_ENABLED:
+                return handler(event, context)
+            rule_key = next((k for k in (f'{method}:{action}', method, '*') if k in rules), None)
+            if rule_key is None:
+                return handler(event, context)
+            rule = rules[rule_key]
+            scope = f'{function}:{rule_key}'
+
+            try:
+                wait = store.take(f'{scope}:{_client(event)}', rule, time.time())
+            except Exception:
+                _count('storeErrors')
+                wait = 0.0
+            if wait > 0:
+                _count('rateLimited', rule_key)
+                instrument.annotate('admission', {'rule': rule_key, 'decision': 'rate', 'counters': stats()})
+                return too_many(wait)
+
+            if not rule.concurrency:
+                _count('admitted')
+                instrument.annotate('admission', {'rule': rule_key, 'decision': 'admitted', 'counters': stats()})
+                return handler(event, context)
+
+            with instrument.phase('admission'):
+                try:
+                    acquired = store.acquire(scope, rule.concurrency, CONCURRENCY_WAIT)
+                except Exception:
+                    _count('storeErrors')
+                    acquired = None
+            if acquired is False:
+                _count('concurrencyLimited', rule_key)
+                instrument.annotate('admission', {'rule': rule_key, 'decision': 'concurrency', 'counters': stats()})
+                return too_many(1)
+            _count('admitted')
+            instrument.annotate('admission', {'rule': rule_key, 'decision': 'admitted', 'counters': stats()})
+            try:
+                return handler(event, context)
+            finally:
+                if acquired:
+                    try:
+                        store.release(scope)
+                    except Exception:
+                        _count('storeErrors')
+
+        return wrapper
+
+    return decorate
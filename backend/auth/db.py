@@ -0,0 +1,190 @@
+'''
+Shared Postgres connection pool kept at module level so warm invocations reuse connections.
+Identical copy lives in every backend function folder, since each folder is deployed on its own.
+'''
+
+import json
+import os
+import threading
+import time
+import psycopg2
+import psycopg2.extensions
+from typing import Dict, Any, List, Optional
+
+POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+POOL_WAIT_TIMEOUT = float(os.environ.get('DB_POOL_WAIT_TIMEOUT', '5'))
+POOL_MAX_IDLE = float(os.environ.get('DB_POOL_MAX_IDLE', '60'))
+POOL_MAX_LIFETIME = float(os.environ.get('DB_POOL_MAX_LIFETIME', '1800'))
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection frees up within DB_POOL_WAIT_TIMEOUT seconds"""
+
+
+class ConnectionPool:
+    """Bounded pool of psycopg2 connections with health checks and usage statistics"""
+
+    cursor_factory = None
+
+    def __init__(self, dsn: str, max_size: int = POOL_MAX_SIZE, wait_timeout: float = POOL_WAIT_TIMEOUT,
+                 max_idle: float = POOL_MAX_IDLE, max_lifetime: float = POOL_MAX_LIFETIME):
+        self.dsn = dsn
+        self.max_size = max(1, max_size)
+        self.wait_timeout = wait_timeout
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self._idle: List[Any] = []
+        self._in_use = 0
+        self._born: Dict[int, float] = {}
+        self._last_used: Dict[int, float] = {}
+        self._cond = threading.Condition()
+        self._stats = {
+            'created': 0,
+            'reused': 0,
+            'discarded': 0,
+            'waits': 0,
+            'waitTimeMs': 0.0,
+            'timeouts': 0
+        }
+
+    def connect(self):
+        """Open a new connection; overridable for instrumentation"""
+        return psycopg2.connect(self.dsn, cursor_factory=self.cursor_factory)
+
+    def getconn(self):
+        """Check out a healthy connection, waiting if the pool is at capacity"""
+        deadline = None
+        waited_from = None
+        with self._cond:
+            while True:
+                # Either way the slot is taken here; an idle connection is health-checked after the lock is released
+                if self._idle or self._in_use < self.max_size:
+                    self._in_use += 1
+                    conn = self._idle.pop() if self._idle else None
+                    self._finish_wait(waited_from)
+                    break
+                if waited_from is None:
+                    waited_from = time.monotonic()
+                    deadline = waited_from + self.wait_timeout
+                    self._stats['waits'] += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._finish_wait(waited_from)
+                    self._stats['timeouts'] += 1
+                    raise PoolTimeout('No database connection available')
+                self._cond.wait(remaining)
+
+        while conn is not None:
+            if self._is_healthy(conn):
+                with self._cond:
+                    self._stats['reused'] += 1
+                return conn
+            with self._cond:
+                self._discard(conn)
+                conn = self._idle.pop() if self._idle else None
+
+        try:
+            conn = self.connect()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        now = time.monotonic()
+        with self._cond:
+            self._born[id(conn)] = now
+            self._last_used[id(conn)] = now
+            self._stats['created'] += 1
+        return conn
+
+    def putconn(self, conn) -> None:
+        """Return a connection, resetting any open transaction before it is reused"""
+        keep = not conn.closed
+        if keep:
+            try:
+                if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                keep = conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+            except psycopg2.Error:
+                keep = False
+
+        with self._cond:
+            self._in_use -= 1
+            if keep and time.monotonic() - self._born.get(id(conn), 0) < self.max_lifetime:
+                self._last_used[id(conn)] = time.monotonic()
+                self._idle.append(conn)
+            else:
+                self._discard(conn)
+            self._cond.notify()
+
+    def stats(self) -> Dict[str, Any]:
+        """Snapshot of pool counters"""
+        with self._cond:
+            snapshot = dict(self._stats)
+            snapshot['idle'] = len(self._idle)
+            snapshot['inUse'] = self._in_use
+            snapshot['maxSize'] = self.max_size
+            return snapshot
+
+    def close(self) -> None:
+        with self._cond:
+            while self._idle:
+                self._discard(self._idle.pop())
+
+    def _is_healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+        now = time.monotonic()
+        if now - self._born.get(id(conn), 0) >= self.max_lifetime:
+            return False
+        if now - self._last_used.get(id(conn), 0) < self.max_idle:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn) -> None:
+        self._born.pop(id(conn), None)
+        self._last_used.pop(id(conn), None)
+        self._stats['discarded'] += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _finish_wait(self, waited_from: Optional[float]) -> None:
+        if waited_from is not None:
+            self._stats['waitTimeMs'] += (time.monotonic() - waited_from) * 1000
+            print(json.dumps({'event': 'db_pool_wait', 'stats': self._stats}))
+
+
+_pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """Module-level pool, created on first use and kept for the lifetime of the instance"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(os.environ['DATABASE_URL'])
+    return _pool
+
+
+def getconn():
+    return get_pool().getconn()
+
+
+def putconn(conn) -> None:
+    get_pool().putconn(conn)
+
+
+def stats() -> Dict[str, Any]:
+    return get_pool().stats()
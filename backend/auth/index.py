@@ -6,11 +6,26 @@ Returns: HTTP response dict with user data or error
 '''
 
 import json
-import os
 import hashlib
 import secrets
-import psycopg2
-from typing import Dict, Any
+import psycopg2.errors
+import db
+import instrument
+import response
+import admission
+import presence
+import tokens
+from typing import Dict, Any, Optional, Tuple
+
+REGISTER_ATTEMPTS = 3
+RETRY_CONSTRAINTS = ('ux_users_username_discriminator', 'users_incordes_id_key')
+# Sign-in attempts are limited per client address, everything else per user
+ADMISSION_RULES = {
+    '*': admission.Rule(5, 20),
+    'POST:login': admission.Rule(0.2, 5),
+    'POST:register': admission.Rule(0.05, 3),
+    'POST:heartbeat': admission.Rule(1, 5)
+}
 
 def generate_incordes_id() -> str:
     """Generate unique Incordes ID like INCRD-XXXX-XXXX"""
@@ -18,40 +33,132 @@ def generate_incordes_id() -> str:
     part2 = secrets.token_hex(2).upper()
     return f"INCRD-{part1}-{part2}"
 
-def generate_discriminator(username: str, conn) -> str:
-    """Generate 4-digit discriminator for username"""
+def generate_discriminator(username: str, conn) -> Optional[str]:
+    """Free 4-digit discriminator for username in one query, None when all 10000 are taken"""
+    cursor = conn.cursor()
+    # Probe upwards from a random start: about ten index lookups at 90% full. The series
+    # streams from the select list, and the scalar subquery keeps one index probe per
+    # candidate even when statistics for a new username would suggest scanning all of its tags.
+    cursor.execute("""
+        SELECT free.d
+        FROM (SELECT to_char((%s + generate_series(0, 9999)) %% 10000, 'FM0000') AS d) free
+        WHERE (SELECT u.id FROM users u WHERE u.username = %s AND u.discriminator = free.d) IS NULL
+        LIMIT 1
+    """, (secrets.randbelow(10000), username))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def insert_user(conn, email: str, username: str, password_hash: str) -> Optional[Tuple]:
+    """Insert a user with a free discriminator, retrying when a concurrent registration takes the same one"""
     cursor = conn.cursor()
-    for _ in range(10):
-        disc = f"{secrets.randbelow(10000):04d}"
-        cursor.execute(
-            "SELECT id FROM users WHERE username = %s AND discriminator = %s",
-            (username, disc)
-        )
-        if not cursor.fetchone():
-            return disc
-    return f"{secrets.randbelow(10000):04d}"
+    for _ in range(REGISTER_ATTEMPTS):
+        discriminator = generate_discriminator(username, conn)
+        if discriminator is None:
+            return None
+        try:
+            cursor.execute(
+                """INSERT INTO users (incordes_id, email, username, discriminator, password_hash, status)
+                   VALUES (%s, %s, %s, %s, %s, %s) RETURNING id, incordes_id, email, username, discriminator""",
+                (generate_incordes_id(), email, username, discriminator, password_hash, 'online')
+            )
+            return cursor.fetchone()
+        except psycopg2.errors.UniqueViolation as exc:
+            conn.rollback()
+            if exc.diag.constraint_name not in RETRY_CONSTRAINTS:
+                raise
+    return None
 
+def session_fields(user_id: int) -> Dict[str, Any]:
+    """Token fields added to login and register responses; null when no signing keys are set"""
+    issued = tokens.issue(user_id)
+    return {'token': issued['token'] if issued else None, 'tokenExpiresAt': issued['expiresAt'] if issued else None}
+
+def heartbeat(user_id: int, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Refresh the caller's presence; touches the database only when a batched flush is due"""
+    status = body_data.get('status', 'online')
+    if status not in presence.STATUSES:
+        return response.error(400, 'status must be online, idle, dnd or offline')
+    
+    changed = presence.heartbeat(user_id, status)
+    flushed = 0
+    if presence.flush_due():
+        with instrument.phase('connect'):
+            conn = db.getconn()
+        try:
+            flushed = presence.flush(conn.cursor())
+            conn.commit()
+        finally:
+            db.putconn(conn)
+    
+    return response.json(200, {'status': status, 'changed': changed, 'flushed': flushed, 'ttl': presence.PRESENCE_TTL})
+
+def lookup_presence(conn, user_id: int, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Statuses for a list of user ids, or the non-offline members of a server the caller belongs to"""
+    cursor = conn.cursor()
+    try:
+        server_id = int(body_data['serverId']) if body_data.get('serverId') else None
+        user_ids = [int(i) for i in (body_data.get('userIds') or [])[:presence.MAX_LOOKUP]]
+    except (TypeError, ValueError):
+        return response.error(400, 'userIds and serverId must be numeric')
+    
+    if server_id:
+        cursor.execute("SELECT 1 FROM server_members WHERE server_id = %s AND user_id = %s", (server_id, user_id))
+        if cursor.fetchone() is None:
+            return response.error(403, 'Not a member of this server')
+        cursor.execute("""
+            SELECT u.id, u.status
+            FROM server_members sm
+            JOIN users u ON u.id = sm.user_id
+            WHERE sm.server_id = %s AND u.status <> 'offline'
+            LIMIT %s
+        """, (server_id, presence.MAX_LOOKUP))
+    else:
+        if not user_ids:
+            return response.error(400, 'userIds or serverId required')
+        cursor.execute("SELECT id, status FROM users WHERE id = ANY(%s)", (user_ids,))
+    
+    statuses = {row[0]: row[1] or 'offline' for row in cursor.fetchall()}
+    live = presence.lookup(statuses)
+    if presence.store.authoritative:
+        statuses = {user_id: live.get(user_id, 'offline') for user_id in statuses}
+    else:
+        statuses.update(live)
+    
+    return response.json(200, {'presence': {str(k): v for k, v in statuses.items() if not server_id or v != 'offline'}})
+
+@instrument.instrumented
+@response.negotiated
+@admission.admitted('auth', ADMISSION_RULES)
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Auth-Token',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
+        return response.preflight('GET, POST, OPTIONS', 'Content-Type, X-User-Id, X-Auth-Token')
+    
+    body_data = json.loads(event.get('body') or '{}') if method == 'POST' else {}
+    action = body_data.get('action')
+    
+    if action == 'refresh':
+        token = tokens.token_from(event)
+        user_id = tokens.verify(token) if token else None
+        if user_id is None:
+            return response.error(401, 'Valid token required')
+        return response.json(200, session_fields(user_id))
+    
+    if action in ('heartbeat', 'presence'):
+        user_id = tokens.authenticate(event)
+        if user_id is None:
+            return response.error(401, 'User ID required')
+        if action == 'heartbeat':
+            return heartbeat(user_id, body_data)
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    with instrument.phase('connect'):
+        conn = db.getconn()
     
     try:
         if method == 'POST':
-            body_data = json.loads(event.get('body', '{}'))
-            action = body_data.get('action')
+            if action == 'presence':
+                return lookup_presence(conn, user_id, body_data)
             
             if action == 'register':
                 email = body_data.get('email')
@@ -59,55 +166,40 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 password = body_data.get('password')
                 
                 if not email or not username or not password:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Missing required fields'})
-                    }
+                    return response.error(400, 'Missing required fields')
                 
                 cursor = conn.cursor()
                 cursor.execute("SELECT id FROM users WHERE email = %s", (email,))
                 if cursor.fetchone():
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Email already registered'})
-                    }
+                    return response.error(400, 'Email already registered')
                 
                 password_hash = hashlib.sha256(password.encode()).hexdigest()
-                incordes_id = generate_incordes_id()
-                discriminator = generate_discriminator(username, conn)
+                try:
+                    user = insert_user(conn, email, username, password_hash)
+                except psycopg2.errors.UniqueViolation:
+                    return response.error(400, 'Email already registered')
+                
+                if user is None:
+                    return response.error(400, 'Too many users with this username, please choose another')
                 
-                cursor.execute(
-                    """INSERT INTO users (incordes_id, email, username, discriminator, password_hash, status)
-                       VALUES (%s, %s, %s, %s, %s, %s) RETURNING id, incordes_id, email, username, discriminator""",
-                    (incordes_id, email, username, discriminator, password_hash, 'online')
-                )
-                user = cursor.fetchone()
                 conn.commit()
+                presence.heartbeat(user[0])
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
-                        'id': user[0],
-                        'incordesId': user[1],
-                        'email': user[2],
-                        'username': user[3],
-                        'discriminator': user[4]
-                    })
-                }
+                return response.json(200, {
+                    'id': user[0],
+                    'incordesId': user[1],
+                    'email': user[2],
+                    'username': user[3],
+                    'discriminator': user[4],
+                    **session_fields(user[0])
+                })
             
             elif action == 'login':
                 email = body_data.get('email')
                 password = body_data.get('password')
                 
                 if not email or not password:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Missing email or password'})
-                    }
+                    return response.error(400, 'Missing email or password')
                 
                 password_hash = hashlib.sha256(password.encode()).hexdigest()
                 
@@ -120,35 +212,26 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 user = cursor.fetchone()
                 
                 if not user:
-                    return {
-                        'statusCode': 401,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Invalid credentials'})
-                    }
+                    return response.error(401, 'Invalid credentials')
                 
-                cursor.execute("UPDATE users SET status = %s WHERE id = %s", ('online', user[0]))
-                conn.commit()
+                presence.heartbeat(user[0])
+                if presence.flush_due():
+                    presence.flush(cursor)
+                    conn.commit()
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({
-                        'id': user[0],
-                        'incordesId': user[1],
-                        'email': user[2],
-                        'username': user[3],
-                        'discriminator': user[4],
-                        'avatarUrl': user[5],
-                        'bio': user[6],
-                        'customStatus': user[7]
-                    })
-                }
+                return response.json(200, {
+                    'id': user[0],
+                    'incordesId': user[1],
+                    'email': user[2],
+                    'username': user[3],
+                    'discriminator': user[4],
+                    'avatarUrl': user[5],
+                    'bio': user[6],
+                    'customStatus': user[7],
+                    **session_fields(user[0])
+                })
         
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'})
-        }
+        return response.error(405, 'Method not allowed')
     
     finally:
-        conn.close()
\ No newline at end of file
+        db.putconn(conn)
\ No newline at end of file
@@ -0,0 +1,166 @@
+'''
+Per-request instrumentation: phase timings, query counts and row counts, reported as a
+Server-Timing header and one structured log line per request.
+Identical copy lives in every backend function folder, since each folder is deployed on its own.
+'''
+
+import functools
+import json
+import os
+import random
+import threading
+import time
+import psycopg2.extensions
+import db
+from contextlib import contextmanager
+from typing import Dict, Any, Callable, List, Optional
+
+REQUEST_LOG = os.environ.get('REQUEST_LOG', '1') != '0'
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', '0'))
+SLOW_QUERY_SAMPLE_RATE = float(os.environ.get('SLOW_QUERY_SAMPLE_RATE', '1'))
+MAX_TIMING_ENTRIES = 10
+
+_local = threading.local()
+
+
+class Trace:
+    """Timings collected while one request is handled"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: List[Dict[str, Any]] = []
+        self.queries: List[Dict[str, Any]] = []
+        self.fields: Dict[str, Any] = {}
+
+    def add_phase(self, name: str, ms: float) -> None:
+        self.phases.append({'name': name, 'ms': round(ms, 3)})
+
+    def add_query(self, sql: str, ms: float, rows: int) -> None:
+        self.queries.append({'sql': _fingerprint(sql), 'ms': round(ms, 3), 'rows': rows})
+
+    def server_timing(self, total_ms: float) -> str:
+        entries = [f"{p['name']};dur={p['ms']}" for p in self.phases]
+        db_ms = sum(q['ms'] for q in self.queries)
+        entries.append(f'db;dur={round(db_ms, 3)};desc="{len(self.queries)} queries"')
+        for i, query in enumerate(self.queries[:MAX_TIMING_ENTRIES], 1):
+            entries.append(f"q{i};dur={query['ms']}")
+        entries.append(f'total;dur={round(total_ms, 3)}')
+        return ', '.join(entries)
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """Cursor that records every statement into the current request trace"""
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self._record(query, vars, (time.perf_counter() - started) * 1000)
+
+    def _record(self, query, vars, ms: float) -> None:
+        trace = current()
+        sql = query.decode() if isinstance(query, bytes) else str(query)
+        if trace is not None:
+            trace.add_query(sql, ms, self.rowcount)
+        if SLOW_QUERY_MS and ms >= SLOW_QUERY_MS and random.random() < SLOW_QUERY_SAMPLE_RATE:
+            self._explain(sql, vars, ms)
+
+    def _explain(self, sql: str, vars, ms: float) -> None:
+        """Log the plan of a slow statement; plain EXPLAIN never executes writes, and inside a
+        transaction it runs under a savepoint so a failing EXPLAIN leaves the handler's work intact"""
+        status = self.connection.get_transaction_status()
+        if status == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+            return
+        cursor = psycopg2.extensions.cursor(self.connection)
+        saved = False
+        try:
+            statement = self.mogrify(sql, vars).decode() if vars is not None else sql
+            if status == psycopg2.extensions.TRANSACTION_STATUS_INTRANS:
+                cursor.execute('SAVEPOINT slow_query_explain')
+                saved = True
+            cursor.execute('EXPLAIN (FORMAT JSON) ' + statement)
+            plan = cursor.fetchone()[0]
+        except psycopg2.Error as exc:
+            plan = {'error': str(exc).strip()}
+        finally:
+            if saved:
+                cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+                cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+            cursor.close()
+        print(json.dumps({'event': 'slow_query', 'ms': round(ms, 3), 'sql': _fingerprint(sql), 'plan': plan}))
+
+
+# Connections opened by the pool use the timed cursor
+db.ConnectionPool.cursor_factory = TimedCursor
+
+
+def current() -> Optional[Trace]:
+    return getattr(_local, 'trace', None)
+
+
+@contextmanager
+def phase(name: str):
+    """Time a block of handler work as a named Server-Timing phase"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace = current()
+        if trace is not None:
+            trace.add_phase(name, (time.perf_counter() - started) * 1000)
+
+
+def annotate(name: str, value: Any) -> None:
+    """Attach an extra field to the current request's log line"""
+    trace = current()
+    if trace is not None:
+        trace.fields[name] = value
+
+
+def instrumented(handler: Callable) -> Callable:
+    """Wrap a cloud function handler with request tracing"""
+
+    @functools.wraps(handler)
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        trace = Trace()
+        _local.trace = trace
+        response = None
+        try:
+            response = handler(event, context)
+            return response
+        finally:
+            _local.trace = None
+            total_ms = (time.perf_counter() - trace.started) * 1000
+            if response is not None:
+                headers = dict(response.get('headers') or {})
+                headers['Server-Timing'] = trace.server_timing(total_ms)
+                headers['Timing-Allow-Origin'] = '*'
+                response['headers'] = headers
+            if REQUEST_LOG:
+                _log(event, context, response, trace, total_ms)
+
+    return wrapper
+
+
+def _log(event: Dict[str, Any], context: Any, response: Optional[Dict[str, Any]], trace: Trace, total_ms: float) -> None:
+    params = event.get('queryStringParameters') or {}
+    print(json.dumps({
+        'event': 'request',
+        'function': getattr(context, 'function_name', None),
+        'requestId': getattr(context, 'request_id', None),
+        'method': event.get('httpMethod'),
+        'action': params.get('action'),
+        'status': response.get('statusCode') if response is not None else 'exception',
+        'totalMs': round(total_ms, 3),
+        'phases': trace.phases,
+        'queryCount': len(trace.queries),
+        'rows': sum(max(q['rows'], 0) for q in trace.queries),
+        'queries': trace.queries,
+        'pool': db.stats() if db._pool is not None else None,
+        **trace.fields
+    }, ensure_ascii=False))
+
+
+def _fingerprint(sql: str) -> str:
+    return ' '.join(sql.split())[:160]
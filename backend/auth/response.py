@@ -0,0 +1,131 @@
+'''
+Shared HTTP response layer: precomputed headers, fast JSON and negotiated compression.
+Identical copy lives in every backend function folder, since each folder is deployed on its own.
+'''
+
+import base64
+import functools
+import gzip
+import json as _json
+import os
+import instrument
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Dict, Any, Callable, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', '1024'))
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def dumps(value: Any) -> str:
+    """Serialize with orjson when installed, stdlib json otherwise"""
+    if orjson is not None:
+        return orjson.dumps(value, default=_default).decode()
+    return _json.dumps(value, ensure_ascii=False, separators=(',', ':'), default=_default)
+
+
+def json(status: int, payload: Any, headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    """JSON response sharing the precomputed header dict unless extra headers are given"""
+    with instrument.phase('serialize'):
+        body = dumps(payload)
+    return {'statusCode': status, 'headers': dict(JSON_HEADERS, **headers) if headers else JSON_HEADERS, 'body': body}
+
+
+def error(status: int, message: str) -> Dict[str, Any]:
+    """JSON error response in the {'error': message} shape the clients expect"""
+    return json(status, {'error': message})
+
+
+def text(status: int, body: str, content_type: str, headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    """Non-JSON body, e.g. an NDJSON export chunk; still compressed by negotiated"""
+    merged = dict(JSON_HEADERS, **headers) if headers else dict(JSON_HEADERS)
+    merged['Content-Type'] = content_type
+    return {'statusCode': status, 'headers': merged, 'body': body}
+
+
+def empty(status: int, headers: Dict[str, str]) -> Dict[str, Any]:
+    """Bodyless response with extra headers, e.g. a 304"""
+    return {'statusCode': status, 'headers': dict(JSON_HEADERS, **headers), 'body': ''}
+
+
+@functools.lru_cache(maxsize=None)
+def _preflight_headers(methods: str, allow_headers: str) -> Dict[str, str]:
+    return {
+        'Access-Control-Allow-Origin': '*',
+        'Access-Control-Allow-Methods': methods,
+        'Access-Control-Allow-Headers': allow_headers,
+        'Access-Control-Max-Age': '86400'
+    }
+
+
+def preflight(methods: str, allow_headers: str) -> Dict[str, Any]:
+    """CORS preflight response; the header dict is built once per distinct argument pair"""
+    return {'statusCode': 200, 'headers': _preflight_headers(methods, allow_headers), 'body': ''}
+
+
+def accepted_encoding(event: Dict[str, Any]) -> str:
+    """Best encoding the client accepts: br (if brotli is installed), gzip or identity"""
+    headers = event.get('headers') or {}
+    accept = headers.get('Accept-Encoding') or headers.get('accept-encoding') or ''
+    offered = set()
+    for part in accept.split(','):
+        token, _, params = part.strip().partition(';')
+        if params.strip().replace(' ', '') in ('q=0', 'q=0.0'):
+            continue
+        offered.add(token.strip().lower())
+    if brotli is not None and 'br' in offered:
+        return 'br'
+    if 'gzip' in offered or '*' in offered:
+        return 'gzip'
+    return 'identity'
+
+
+def compress(event: Dict[str, Any], result: Dict[str, Any]) -> Dict[str, Any]:
+    """Compress a text body above COMPRESS_MIN_BYTES into a base64 body with Content-Encoding"""
+    body = result.get('body')
+    if not isinstance(body, str) or result.get('isBase64Encoded') or len(body) < COMPRESS_MIN_BYTES:
+        return result
+    encoding = accepted_encoding(event)
+    if encoding == 'identity':
+        return result
+    with instrument.phase('compress'):
+        raw = body.encode()
+        if encoding == 'br':
+            packed = brotli.compress(raw, quality=BROTLI_QUALITY)
+        else:
+            packed = gzip.compress(raw, compresslevel=GZIP_LEVEL)
+        headers = dict(result.get('headers') or {})
+        headers['Content-Encoding'] = encoding
+        headers['Vary'] = 'Accept-Encoding'
+        return dict(result, headers=headers, body=base64.b64encode(packed).decode(), isBase64Encoded=True)
+
+
+def negotiated(handler: Callable) -> Callable:
+    """Wrap a cloud function handler so large bodies are compressed per Accept-Encoding"""
+
+    @functools.wraps(handler)
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        return compress(event, handler(event, context))
+
+    return wrapper
@@ -6,66 +6,122 @@ Returns: HTTP response dict with friends data or error
 '''
 
 import json
-import os
-import psycopg2
-from typing import Dict, Any
+import base64
+import db
+import instrument
+import response
+import admission
+import tokens
+import versions
+from datetime import datetime
+from typing import Dict, Any, Optional, Tuple
 
+STATES = ('friends', 'incoming', 'outgoing')
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+ADMISSION_RULES = {
+    '*': admission.Rule(10, 30),
+    'POST': admission.Rule(1, 10)
+}
+
+def encode_cursor(created_at: datetime, peer_id: int) -> str:
+    """Opaque keyset cursor for the (created_at, peer_id) position of a relation"""
+    raw = f"{created_at.isoformat()}|{peer_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Parse a cursor from encode_cursor, raising ValueError when malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, peer_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(created_at), int(peer_id)
+    except (UnicodeDecodeError, TypeError, ValueError) as exc:
+        raise ValueError('Invalid cursor') from exc
+
+def list_friends(cursor, user_id: str, state: Optional[str], params: Dict[str, Any], tag: str) -> Dict[str, Any]:
+    """One page of the user's relations, newest first, optionally limited to one state.
+    Online status is left out: it changes without bumping friends:<user>, so a 304 would freeze it;
+    clients read it from the auth presence lookup"""
+    limit = admission.page_size(params, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+    try:
+        keyset = decode_cursor(params['cursor']) if params.get('cursor') else None
+    except ValueError:
+        return response.error(400, 'Invalid cursor')
+    
+    conditions = ['e.user_id = %s']
+    args = [user_id]
+    if state is not None:
+        conditions.append('e.state = %s')
+        args.append(state)
+    if keyset is not None:
+        conditions.append('(e.created_at, e.peer_id) < (%s, %s)')
+        args.extend(keyset)
+    args.append(limit + 1)
+    
+    cursor.execute(f"""
+        SELECT u.id, u.incordes_id, u.username, u.discriminator, u.avatar_url, e.state, e.created_at
+        FROM friend_edges e
+        JOIN users u ON u.id = e.peer_id
+        WHERE {' AND '.join(conditions)}
+        ORDER BY e.created_at DESC, e.peer_id DESC
+        LIMIT %s
+    """, args)
+    rows = cursor.fetchall()
+    
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    friends = []
+    for row in rows:
+        friends.append({
+            'id': row[0],
+            'incordesId': row[1],
+            'username': row[2],
+            'discriminator': row[3],
+            'avatarUrl': row[4],
+            'friendStatus': 'accepted' if row[5] == 'friends' else 'pending',
+            'direction': None if row[5] == 'friends' else row[5]
+        })
+    
+    return response.json(200, {
+        'friends': friends,
+        'nextCursor': encode_cursor(rows[-1][6], rows[-1][0]) if has_more else None,
+        'hasMore': has_more
+    }, versions.cache_headers(tag))
+
+
+@instrument.instrumented
+@response.negotiated
+@admission.admitted('friends', ADMISSION_RULES)
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
+        return response.preflight('GET, POST, PUT, DELETE, OPTIONS', 'Content-Type, X-User-Id, X-Auth-Token, If-None-Match')
     
-    headers_dict = event.get('headers', {})
-    user_id = headers_dict.get('X-User-Id') or headers_dict.get('x-user-id')
+    user_id = tokens.authenticate(event)
     
     if not user_id:
-        return {
-            'statusCode': 401,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'User ID required'})
-        }
+        return response.error(401, 'User ID required')
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    with instrument.phase('connect'):
+        conn = db.getconn()
     
     try:
         cursor = conn.cursor()
         
         if method == 'GET':
-            cursor.execute("""
-                SELECT u.id, u.incordes_id, u.username, u.discriminator, u.avatar_url, u.status, f.status as friend_status
-                FROM friendships f
-                JOIN users u ON (f.user_id = u.id OR f.friend_id = u.id)
-                WHERE (f.user_id = %s OR f.friend_id = %s) AND u.id != %s
-                ORDER BY f.created_at DESC
-            """, (user_id, user_id, user_id))
+            params = event.get('queryStringParameters') or {}
+            state = params.get('status')
+            if state is not None and state not in STATES:
+                return response.error(400, 'status must be friends, incoming or outgoing')
             
-            friends = []
-            for row in cursor.fetchall():
-                friends.append({
-                    'id': row[0],
-                    'incordesId': row[1],
-                    'username': row[2],
-                    'discriminator': row[3],
-                    'avatarUrl': row[4],
-                    'status': row[5],
-                    'friendStatus': row[6]
-                })
+            key = versions.friends_key(user_id)
+            with instrument.phase('version'):
+                tag = versions.etag(key, versions.current(cursor, key))
+            if versions.not_modified(event, tag):
+                return response.empty(304, versions.cache_headers(tag))
             
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'friends': friends})
-            }
+            return list_friends(cursor, user_id, state, params, tag)
         
         elif method == 'POST':
             body_data = json.loads(event.get('body', '{}'))
@@ -75,91 +131,63 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 incordes_id = body_data.get('incordesId')
                 
                 if not incordes_id:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Incordes ID required'})
-                    }
+                    return response.error(400, 'Incordes ID required')
                 
                 cursor.execute("SELECT id FROM users WHERE incordes_id = %s", (incordes_id,))
                 friend = cursor.fetchone()
                 
                 if not friend:
-                    return {
-                        'statusCode': 404,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'User not found'})
-                    }
+                    return response.error(404, 'User not found')
                 
                 friend_id = friend[0]
                 
                 if int(user_id) == friend_id:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Cannot add yourself'})
-                    }
+                    return response.error(400, 'Cannot add yourself')
                 
                 cursor.execute("""
-                    SELECT id FROM friendships 
-                    WHERE (user_id = %s AND friend_id = %s) OR (user_id = %s AND friend_id = %s)
+                    INSERT INTO friend_edges (user_id, peer_id, state)
+                    VALUES (%s, %s, 'outgoing'), (%s, %s, 'incoming')
+                    ON CONFLICT (user_id, peer_id) DO NOTHING
                 """, (user_id, friend_id, friend_id, user_id))
                 
-                if cursor.fetchone():
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Friend request already exists'})
-                    }
+                if cursor.rowcount == 0:
+                    conn.rollback()
+                    return response.error(400, 'Friend request already exists')
                 
-                cursor.execute("""
-                    INSERT INTO friendships (user_id, friend_id, status)
-                    VALUES (%s, %s, %s) RETURNING id
-                """, (user_id, friend_id, 'pending'))
+                versions.bump(cursor, [versions.friends_key(user_id), versions.friends_key(friend_id)])
                 conn.commit()
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'message': 'Friend request sent'})
-                }
+                return response.json(200, {'message': 'Friend request sent'})
             
             elif action == 'accept':
                 friend_id = body_data.get('friendId')
                 
                 cursor.execute("""
-                    UPDATE friendships SET status = %s
-                    WHERE friend_id = %s AND user_id = %s AND status = %s
-                """, ('accepted', user_id, friend_id, 'pending'))
+                    UPDATE friend_edges SET state = 'friends'
+                    WHERE (user_id = %s AND peer_id = %s AND state = 'incoming')
+                       OR (user_id = %s AND peer_id = %s AND state = 'outgoing')
+                """, (user_id, friend_id, friend_id, user_id))
+                if cursor.rowcount:
+                    versions.bump(cursor, [versions.friends_key(user_id), versions.friends_key(friend_id)])
                 conn.commit()
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'message': 'Friend request accepted'})
-                }
+                return response.json(200, {'message': 'Friend request accepted'})
         
         elif method == 'DELETE':
             params = event.get('queryStringParameters', {})
             friend_id = params.get('friendId')
             
             cursor.execute("""
-                DELETE FROM friendships
-                WHERE (user_id = %s AND friend_id = %s) OR (user_id = %s AND friend_id = %s)
+                DELETE FROM friend_edges
+                WHERE (user_id = %s AND peer_id = %s) OR (user_id = %s AND peer_id = %s)
             """, (user_id, friend_id, friend_id, user_id))
+            if cursor.rowcount:
+                versions.bump(cursor, [versions.friends_key(user_id), versions.friends_key(friend_id)])
             conn.commit()
             
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'message': 'Friend removed'})
-            }
+            return response.json(200, {'message': 'Friend removed'})
         
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'})
-        }
+        return response.error(405, 'Method not allowed')
     
     finally:
-        conn.close()
+        db.putconn(conn)
@@ -0,0 +1,120 @@
+'''
+Stateless session tokens: HMAC-SHA256 signed, expiring, carrying the user id.
+auth issues them; every function verifies them locally, with no database round-trip.
+
+Keys come from AUTH_TOKEN_KEYS as "kid:secret,kid:secret". The first key signs new
+tokens and every listed key verifies, so a key is rotated by putting a new one first
+and dropping the old one once AUTH_TOKEN_TTL has passed.
+Identical copy lives in every backend function folder, since each folder is deployed on its own.
+'''
+
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+
+AUTH_TOKEN_TTL = int(os.environ.get('AUTH_TOKEN_TTL', str(7 * 24 * 3600)))
+AUTH_REQUIRE_TOKEN = os.environ.get('AUTH_REQUIRE_TOKEN', '0') == '1'
+VERIFY_CACHE_SIZE = int(os.environ.get('AUTH_VERIFY_CACHE_SIZE', '4096'))
+TOKEN_VERSION = 'v1'
+
+
+def _load_keys(spec: str) -> Tuple[Optional[str], Dict[str, bytes]]:
+    keys = {}
+    active = None
+    for part in spec.split(','):
+        kid, sep, secret = part.strip().partition(':')
+        if not sep or not kid or not secret:
+            continue
+        keys[kid] = secret.encode()
+        active = active or kid
+    return active, keys
+
+
+ACTIVE_KID, KEYS = _load_keys(os.environ.get('AUTH_TOKEN_KEYS', ''))
+
+_cache_lock = threading.Lock()
+_cache: 'OrderedDict[str, Tuple[int, int]]' = OrderedDict()
+
+
+def _b64(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def _unb64(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def _sign(kid: str, body: str) -> str:
+    return _b64(hmac.new(KEYS[kid], f'{TOKEN_VERSION}.{kid}.{body}'.encode(), hashlib.sha256).digest())
+
+
+def issue(user_id: int, now: Optional[float] = None) -> Optional[Dict[str, Any]]:
+    """Signed token for a user with the active key; None when no keys are configured"""
+    if ACTIVE_KID is None:
+        return None
+    issued = int(now if now is not None else time.time())
+    expires = issued + AUTH_TOKEN_TTL
+    body = _b64(f'{int(user_id)}:{issued}:{expires}'.encode())
+    return {'token': f'{TOKEN_VERSION}.{ACTIVE_KID}.{body}.{_sign(ACTIVE_KID, body)}', 'expiresAt': expires}
+
+
+def verify(token: str) -> Optional[int]:
+    """User id of a valid, unexpired token signed by any configured key, else None"""
+    now = time.time()
+    with _cache_lock:
+        cached = _cache.get(token)
+        if cached is not None:
+            _cache.move_to_end(token)
+    if cached is not None:
+        return cached[0] if cached[1] > now else None
+
+    try:
+        version, kid, body, signature = token.split('.')
+        if version != TOKEN_VERSION or kid not in KEYS:
+            return None
+        # Bytes, since compare_digest raises TypeError on non-ASCII str
+        if not hmac.compare_digest(signature.encode(), _sign(kid, body).encode()):
+            return None
+        user_id, _, expires = _unb64(body).decode().split(':')
+        user_id, expires = int(user_id), int(expires)
+    except (ValueError, UnicodeDecodeError):
+        return None
+    if expires <= now:
+        return None
+
+    # Only valid signatures are cached, so garbage tokens cannot evict real ones
+    with _cache_lock:
+        _cache[token] = (user_id, expires)
+        if len(_cache) > VERIFY_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return user_id
+
+
+def token_from(event: Dict[str, Any]) -> Optional[str]:
+    headers = event.get('headers') or {}
+    token = headers.get('X-Auth-Token') or headers.get('x-auth-token')
+    if token:
+        return token
+    authorization = headers.get('Authorization') or headers.get('authorization') or ''
+    scheme, _, value = authorization.partition(' ')
+    return value.strip() if scheme.lower() == 'bearer' and value.strip() else None
+
+
+def authenticate(event: Dict[str, Any]) -> Optional[int]:
+    """Caller's user id from X-Auth-Token (or a Bearer token), else X-User-Id unless AUTH_REQUIRE_TOKEN=1"""
+    token = token_from(event)
+    if token is not None:
+        return verify(token)
+    if AUTH_REQUIRE_TOKEN:
+        return None
+    headers = event.get('headers') or {}
+    user_id = headers.get('X-User-Id') or headers.get('x-user-id')
+    try:
+        return int(user_id) if user_id else None
+    except ValueError:
+        return None
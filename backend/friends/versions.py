@@ -0,0 +1,68 @@
+'''
+Per-entity version counters behind the ETag / If-None-Match support of list GETs.
+Writers bump the keys of every list they change in the same transaction; readers
+look the version up and answer 304 when the client already holds it.
+Identical copy lives in every backend function folder that serves cached lists.
+'''
+
+from typing import Dict, Any, Iterable, Optional
+
+
+def servers_key(user_id: Any) -> str:
+    return f'servers:{int(user_id)}'
+
+
+def channels_key(server_id: Any) -> str:
+    return f'channels:{int(server_id)}'
+
+
+def friends_key(user_id: Any) -> str:
+    return f'friends:{int(user_id)}'
+
+
+def current(cursor, key: str) -> int:
+    """Version of one list; 0 until it is first bumped"""
+    cursor.execute("SELECT version FROM entity_versions WHERE key = %s", (key,))
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def bump(cursor, keys: Iterable[str]) -> None:
+    """Increment the versions of the given lists; call inside the writing transaction"""
+    cursor.execute("""
+        INSERT INTO entity_versions (key, version)
+        SELECT k, 1 FROM unnest(%s::text[]) k
+        ON CONFLICT (key) DO UPDATE
+        SET version = entity_versions.version + 1, updated_at = CURRENT_TIMESTAMP
+    """, (sorted(set(keys)),))
+
+
+def etag(key: str, version: int) -> str:
+    return f'W/"{key}:{version}"'
+
+
+def not_modified(event: Dict[str, Any], tag: str) -> bool:
+    """True when If-None-Match already names this tag (weak comparison, '*' matches)"""
+    header = _header(event, 'If-None-Match')
+    if not header:
+        return False
+    opaque = tag[2:] if tag.startswith('W/') else tag
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate == '*':
+            return True
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+
+def cache_headers(tag: str) -> Dict[str, str]:
+    """Headers for both the 200 and the 304: the tag, and revalidate on every use"""
+    return {'ETag': tag, 'Cache-Control': 'private, no-cache'}
+
+
+def _header(event: Dict[str, Any], name: str) -> Optional[str]:
+    headers = event.get('headers') or {}
+    return headers.get(name) or headers.get(name.lower())
@@ -0,0 +1,181 @@
+'''
+Read side of the cold message archive written by tools/archive/archive_messages.py.
+
+MESSAGES_ARCHIVE_DIR holds catalog.json plus, per archived monthly partition,
+<partition>.ndjson.gz and <partition>.json. The data file is a concatenation of
+gzip members, one per conversation (key "c:<channel>" or "d:<low>:<high>"), each
+holding that conversation's rows oldest first as JSON arrays
+[id, createdAt, senderId, content, editedAt]. The partition manifest maps a key
+to [offset, length, rows], so a page reads and inflates one member only; an
+inflated member is cached with its sorted keyset positions, so later pages seek
+into it by bisection. History reads come here only after the hot partitions run
+out of rows and a manifest shows the conversation has older archived rows.
+'''
+
+import gzip
+import json
+import os
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+
+ARCHIVE_DIR = os.environ.get('MESSAGES_ARCHIVE_DIR')
+CATALOG_FILE = 'catalog.json'
+CATALOG_TTL = float(os.environ.get('ARCHIVE_CATALOG_TTL', '30'))
+MEMBER_CACHE_SIZE = int(os.environ.get('ARCHIVE_MEMBER_CACHE_SIZE', '32'))
+
+_lock = threading.Lock()
+_catalog: Optional[Dict[str, Any]] = None
+_catalog_mtime = 0.0
+# monotonic() may be below CATALOG_TTL on a freshly booted host, so the first call must always load
+_catalog_checked = float('-inf')
+_manifests: Dict[str, Dict[str, Any]] = {}
+_members: 'OrderedDict[Tuple[str, str], Tuple[List[list], List[Tuple[datetime, int]]]]' = OrderedDict()
+
+
+def conversation_key(channel_id: Optional[int], dm_low: Optional[int] = None, dm_high: Optional[int] = None) -> str:
+    return f'c:{int(channel_id)}' if channel_id is not None else f'd:{int(dm_low)}:{int(dm_high)}'
+
+
+def catalog() -> Optional[Dict[str, Any]]:
+    """Archive catalog, re-read when catalog.json changes (checked at most every CATALOG_TTL seconds)"""
+    global _catalog, _catalog_mtime, _catalog_checked
+    if not ARCHIVE_DIR:
+        return None
+    now = time.monotonic()
+    if now - _catalog_checked < CATALOG_TTL:
+        return _catalog
+    with _lock:
+        _catalog_checked = now
+        path = os.path.join(ARCHIVE_DIR, CATALOG_FILE)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            _catalog = None
+            return None
+        if mtime != _catalog_mtime:
+            with open(path, encoding='utf-8') as f:
+                _catalog = json.load(f)
+            _catalog_mtime = mtime
+            _manifests.clear()
+            _members.clear()
+    return _catalog
+
+
+def hot_from() -> Optional[datetime]:
+    """Everything created before this instant lives in the archive; None when nothing is archived"""
+    current = catalog()
+    if not current or not current.get('partitions'):
+        return None
+    return datetime.fromisoformat(current['hotFrom'])
+
+
+def has_rows(key: str, before: Optional[datetime]) -> bool:
+    """Whether an archived partition starting before `before` (any, when None) holds rows of the
+    conversation; answered from the manifests, without inflating a member"""
+    current = catalog()
+    if not current:
+        return False
+    for partition in current['partitions']:
+        if before is not None and datetime.fromisoformat(partition['from']) >= before:
+            continue
+        if key in _manifest(partition['name'])['members']:
+            return True
+    return False
+
+
+def read(cursor, key: str, keyset: Optional[Tuple[datetime, int]], count: int, descending: bool,
+         senders: bool = True) -> List[Tuple]:
+    """Up to count archived rows of one conversation past keyset, in history-query row shape;
+    with senders=False the profile columns are left NULL, as hot_history does for the users map"""
+    current = catalog()
+    if not current or count <= 0:
+        return []
+    partitions = sorted(current['partitions'], key=lambda p: p['from'], reverse=descending)
+
+    found: List[list] = []
+    for partition in partitions:
+        start, end = datetime.fromisoformat(partition['from']), datetime.fromisoformat(partition['to'])
+        if keyset is not None and (start > keyset[0] if descending else end <= keyset[0]):
+            continue
+        rows, positions = _member(partition['name'], key)
+        wanted = count - len(found)
+        if descending:
+            stop = bisect_left(positions, keyset) if keyset is not None else len(rows)
+            found.extend(reversed(rows[max(stop - wanted, 0):stop]))
+        else:
+            first = bisect_right(positions, keyset) if keyset is not None else 0
+            found.extend(rows[first:first + wanted])
+        if len(found) == count:
+            break
+    return _with_senders(cursor, found) if senders else _without_senders(found)
+
+
+def _manifest(partition: str) -> Dict[str, Any]:
+    with _lock:
+        manifest = _manifests.get(partition)
+    if manifest is None:
+        with open(os.path.join(ARCHIVE_DIR, f'{partition}.json'), encoding='utf-8') as f:
+            manifest = json.load(f)
+        with _lock:
+            _manifests[partition] = manifest
+    return manifest
+
+
+def _member(partition: str, key: str) -> Tuple[List[list], List[Tuple[datetime, int]]]:
+    """Rows of one member, oldest first, with their (createdAt, id) positions for bisection"""
+    with _lock:
+        cached = _members.get((partition, key))
+        if cached is not None:
+            _members.move_to_end((partition, key))
+            return cached
+
+    entry = _manifest(partition)['members'].get(key)
+    rows: List[list] = []
+    if entry is not None:
+        offset, length, _ = entry
+        with open(os.path.join(ARCHIVE_DIR, f'{partition}.ndjson.gz'), 'rb') as f:
+            f.seek(offset)
+            raw = gzip.decompress(f.read(length))
+        rows = [json.loads(line) for line in raw.splitlines() if line]
+    member = (rows, [(datetime.fromisoformat(row[1]), row[0]) for row in rows])
+
+    with _lock:
+        _members[(partition, key)] = member
+        if len(_members) > MEMBER_CACHE_SIZE:
+            _members.popitem(last=False)
+    return member
+
+
+def _with_senders(cursor, rows: List[list]) -> List[Tuple]:
+    """Attach sender profiles, which stay in the hot users table, in one lookup"""
+    if not rows:
+        return []
+    cursor.execute(
+        "SELECT id, username, discriminator, avatar_url FROM users WHERE id = ANY(%s)",
+        (list({row[2] for row in rows if row[2] is not None}),)
+    )
+    senders = {row[0]: row for row in cursor.fetchall()}
+    result = []
+    for message_id, created_at, sender_id, content, edited_at in rows:
+        # Same as the inner join of the hot query: rows without a known sender are left out
+        sender = senders.get(sender_id)
+        if sender is None:
+            continue
+        result.append((
+            message_id, content, datetime.fromisoformat(created_at),
+            sender[0], sender[1], sender[2], sender[3],
+            datetime.fromisoformat(edited_at) if edited_at else None
+        ))
+    return result
+
+
+def _without_senders(rows: List[list]) -> List[Tuple]:
+    return [
+        (message_id, content, datetime.fromisoformat(created_at), sender_id, None, None, None,
+         datetime.fromisoformat(edited_at) if edited_at else None)
+        for message_id, created_at, sender_id, content, edited_at in rows
+    ]
@@ -5,81 +5,1086 @@ Args: event - dict with httpMethod, body, queryStringParameters
 Returns: HTTP response dict with messages or error
 '''
 
+import io
 import json
-import os
-import psycopg2
-from typing import Dict, Any
+import base64
+import time
+import psycopg2.errors
+import db
+import instrument
+import response
+import admission
+import archive
+import profiles
+import tokens
+from datetime import datetime, timezone
+from psycopg2.extras import execute_values
+from typing import Dict, Any, List, Optional, Tuple
 
+MAX_BATCH_SIZE = 500
+MAX_SYNC_SIZE = 500
+EVENTS_CHANNEL = 'incordes_events'
+MAX_EVENT_BYTES = 7900
+UNREAD_CAP = 100
+DM_UNREAD_WINDOW = 1000
+MAX_SEARCH_SIZE = 50
+# Only the newest matches are ranked: ranking every match of a common term costs seconds at 10M rows
+SEARCH_CANDIDATES = 1000
+EXPORT_CHUNK_SIZE = 5000
+MAX_EXPORT_CHUNK_SIZE = 20000
+# One JSON document per output line: CSV with quote and delimiter bytes that JSON text never contains
+EXPORT_COPY_OPTIONS = "FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02'"
+DEFAULT_HISTORY_SIZE = 50
+MAX_HISTORY_SIZE = 100
+# Bulk deletes commit every PURGE_BATCH_SIZE rows so locks and WAL per transaction stay bounded
+PURGE_BATCH_SIZE = 1000
+MAX_BULK_DELETE_IDS = 5000
+# A purge request deletes for this long, then leaves the rest of the job to tools/purge or resumePurge
+PURGE_REQUEST_SECONDS = 5.0
+MODERATOR_ROLES = ['owner', 'moderator']
+# Channels the user may moderate: owner_id, then user_id and the roles of a server_members row
+MODERATED_CHANNELS_SQL = """
+    SELECT c.id FROM channels c
+    WHERE c.server_id IN (SELECT s.id FROM servers s WHERE s.owner_id = %s
+                          UNION
+                          SELECT sm.server_id FROM server_members sm WHERE sm.user_id = %s AND sm.role = ANY(%s))
+"""
+PURGE_JOB_COLUMNS = ("id, server_id, channel_id, sender_id, from_ts, to_ts, state, deleted, batches, error, "
+                     "created_at, updated_at, finished_at, last_created_at, last_id")
+# Per user: requests per second and burst; heavy queries also cap how many run at once
+ADMISSION_RULES = {
+    '*': admission.Rule(10, 30),
+    'GET': admission.Rule(10, 40),
+    'POST': admission.Rule(5, 20),
+    'POST:sendBatch': admission.Rule(1, 5),
+    'GET:sync': admission.Rule(2, 10),
+    'GET:unread': admission.Rule(1, 5, concurrency=8),
+    'GET:search': admission.Rule(0.5, 5, concurrency=4),
+    'GET:export': admission.Rule(2, 10, concurrency=2),
+    'POST:bulkDelete': admission.Rule(1, 5, concurrency=2),
+    'POST:purge': admission.Rule(0.2, 3, concurrency=1),
+    'POST:resumePurge': admission.Rule(0.5, 3, concurrency=1)
+}
+
+def encode_cursor(created_at: datetime, message_id: int) -> str:
+    """Opaque keyset cursor for the (created_at, id) position of a message"""
+    raw = f"{created_at.isoformat()}|{message_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """Parse a cursor from encode_cursor, raising ValueError when malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, message_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(created_at), int(message_id)
+    except (UnicodeDecodeError, TypeError, ValueError) as exc:
+        raise ValueError('Invalid cursor') from exc
+
+def encode_search_cursor(rank: float, message_id: int) -> str:
+    """Opaque keyset cursor for the (rank, id) position of a search result"""
+    raw = f"{rank!r}|{message_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_search_cursor(cursor: str) -> Tuple[float, int]:
+    """Parse a cursor from encode_search_cursor, raising ValueError when malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        rank, message_id = raw.rsplit('|', 1)
+        return float(rank), int(message_id)
+    except (UnicodeDecodeError, TypeError, ValueError) as exc:
+        raise ValueError('Invalid cursor') from exc
+
+def encode_change_cursor(change_xid: int, change_seq: int) -> str:
+    """Sync cursor for the (change_xid, change_seq) position of a change"""
+    return f"{change_xid}.{change_seq}"
+
+def decode_change_cursor(cursor: str) -> Tuple[int, int]:
+    """Parse a sync cursor, raising ValueError when malformed; a bare change_seq from older clients means xid 0"""
+    change_xid, _, change_seq = cursor.rpartition('.')
+    position = (int(change_xid or 0), int(change_seq))
+    if min(position) < 0:
+        raise ValueError('Invalid cursor')
+    return position
+
+def dm_key(user_a: Any, user_b: Any) -> Tuple[int, int]:
+    """Canonical (low, high) conversation key for a direct message pair"""
+    low, high = sorted((int(user_a), int(user_b)))
+    return low, high
+
+def message_event(kind: str, row: Tuple, sender_id: Any = None, content: Optional[str] = None) -> Dict[str, Any]:
+    """Compact push event from a (id, timestamp, change_seq, channel_id, dm_low, dm_high, change_xid) row"""
+    event = {
+        't': kind,
+        'id': row[0],
+        'q': row[2],
+        'x': int(row[6]),
+        'c': row[3],
+        'd': [row[4], row[5]] if row[4] is not None else None
+    }
+    if kind != 'del':
+        event['s'] = int(sender_id)
+        event['at'] = row[1].isoformat() if row[1] else None
+        event['b'] = content
+    return event
+
+def publish_events(cursor, events: List[Dict[str, Any]]) -> None:
+    """Queue events for the push gateway; Postgres delivers them only if the transaction commits"""
+    payloads = []
+    for event in events:
+        payload = json.dumps(event, ensure_ascii=False, separators=(',', ':'))
+        if len(payload.encode()) > MAX_EVENT_BYTES:
+            # NOTIFY payloads are capped at 8000 bytes, clients fetch the content through sync
+            event = dict(event, b=None)
+            payload = json.dumps(event, ensure_ascii=False, separators=(',', ':'))
+        payloads.append(payload)
+    if payloads:
+        cursor.execute(
+            "SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload",
+            (EVENTS_CHANNEL, payloads)
+        )
+
+def validate_message(content: Any, channel_id: Any, recipient_id: Any) -> Optional[str]:
+    """Return a validation error for an outgoing message, or None if it can be sent"""
+    if not content or not isinstance(content, str):
+        return 'Message content required'
+    if not channel_id and not recipient_id:
+        return 'Channel ID or recipient ID required'
+    return None
+
+def insert_messages(conn, cursor, values: List[Tuple]) -> List[Tuple]:
+    """Multi-row insert; when a row's month has no partition yet, create the missing ones and retry once"""
+    def insert() -> List[Tuple]:
+        return execute_values(cursor, """
+            INSERT INTO messages (sender_id, channel_id, recipient_id, content)
+            VALUES %s RETURNING id, created_at, change_seq, channel_id, dm_low, dm_high, change_xid::text
+        """, values, page_size=len(values), fetch=True)
+    
+    try:
+        return insert()
+    except psycopg2.errors.CheckViolation as exc:
+        if 'no partition' not in str(exc):
+            raise
+        conn.rollback()
+        cursor.execute("SELECT ensure_messages_partitions()")
+        conn.commit()
+        return insert()
+
+def parse_id(value: Any) -> Optional[int]:
+    """Positive integer id from a JSON number or numeric string, None when it cannot be one"""
+    if isinstance(value, bool):
+        return None
+    try:
+        parsed = int(value)
+    except (TypeError, ValueError):
+        return None
+    return parsed if 0 < parsed < 2 ** 31 else None
+
+def send_batch(conn, user_id: str, items: Any) -> Dict[str, Any]:
+    """Insert many messages with one multi-row INSERT in a single transaction"""
+    if not isinstance(items, list) or not items:
+        return response.error(400, 'Messages array required')
+    
+    if len(items) > MAX_BATCH_SIZE:
+        return response.error(400, f'At most {MAX_BATCH_SIZE} messages per batch')
+    
+    results: List[Dict[str, Any]] = []
+    candidates = []
+    for item in items:
+        item = item if isinstance(item, dict) else {}
+        content = item.get('content')
+        channel_id = item.get('channelId')
+        recipient_id = item.get('recipientId')
+        error = validate_message(content, channel_id, recipient_id)
+        if not error and channel_id and parse_id(channel_id) is None:
+            error = 'Invalid channel ID'
+        if not error and recipient_id and parse_id(recipient_id) is None:
+            error = 'Invalid recipient ID'
+        results.append({'error': error} if error else {})
+        candidates.append(None if error else (parse_id(channel_id), parse_id(recipient_id), content))
+    
+    cursor = conn.cursor()
+    # One query per kind of target: a missing channel or user would otherwise fail the whole INSERT
+    channel_ids = list({c[0] for c in candidates if c and c[0]})
+    recipient_ids = list({c[1] for c in candidates if c and c[1]})
+    allowed_channels = set()
+    if channel_ids:
+        cursor.execute("""
+            SELECT c.id FROM channels c
+            JOIN server_members sm ON sm.server_id = c.server_id AND sm.user_id = %s
+            WHERE c.id = ANY(%s)
+        """, (user_id, channel_ids))
+        allowed_channels = {row[0] for row in cursor.fetchall()}
+    known_users = set()
+    if recipient_ids:
+        cursor.execute("SELECT id FROM users WHERE id = ANY(%s)", (recipient_ids,))
+        known_users = {row[0] for row in cursor.fetchall()}
+    
+    values = []
+    for result, candidate in zip(results, candidates):
+        if candidate is None:
+            continue
+        channel_id, recipient_id, content = candidate
+        if channel_id and channel_id not in allowed_channels:
+            result['error'] = 'Channel not found or not a member'
+        elif recipient_id and recipient_id not in known_users:
+            result['error'] = 'Recipient not found'
+        else:
+            values.append((user_id, channel_id, recipient_id, content))
+    
+    if values:
+        inserted = insert_messages(conn, cursor, values)
+        
+        # Serial ids are handed out in VALUES order, so sorting restores request order
+        inserted.sort(key=lambda row: row[0])
+        publish_events(cursor, [
+            message_event('new', row, user_id, value[3]) for row, value in zip(inserted, values)
+        ])
+        conn.commit()
+        
+        pending = iter(inserted)
+        for result in results:
+            if 'error' not in result:
+                row = next(pending)
+                result['id'] = row[0]
+                result['createdAt'] = row[1].isoformat() if row[1] else None
+    else:
+        conn.rollback()
+    
+    return response.json(200, {
+        'results': results,
+        'sent': len(values),
+        'failed': len(results) - len(values)
+    })
+
+def sync_changes(conn, user_id: str, params: Dict[str, Any]) -> Dict[str, Any]:
+    """Every message change visible to the user after a (change_xid, change_seq) cursor"""
+    cursor = conn.cursor()
+    limit = admission.page_size(params, 200, MAX_SYNC_SIZE)
+    since = params.get('cursor')
+    
+    # change_seq is taken at write time, so a transaction can commit after others with higher numbers.
+    # Every transaction below the snapshot xmin has finished and every one still running is at or
+    # above it: changes are handed out only below it, in (change_xid, change_seq) order, so nothing
+    # that commits later can land behind a cursor already returned
+    cursor.execute("SELECT pg_snapshot_xmin(pg_current_snapshot())::text")
+    settled = int(cursor.fetchone()[0])
+    
+    if since is None:
+        return response.json(200, {
+            'messages': [], 'deleted': [], 'cursor': encode_change_cursor(settled, 0), 'hasMore': False
+        })
+    
+    try:
+        since_xid, since_seq = decode_change_cursor(str(since))
+    except ValueError:
+        return response.error(400, 'Invalid cursor')
+    
+    uid = int(user_id)
+    
+    cursor.execute("""
+        SELECT m.change_seq, m.id, m.content, m.created_at, m.edited_at, m.channel_id, m.dm_low, m.dm_high,
+               u.id, u.username, u.discriminator, u.avatar_url, m.change_xid::text
+        FROM messages m
+        JOIN users u ON m.sender_id = u.id
+        WHERE (m.change_xid, m.change_seq) > (%s::xid8, %s) AND m.change_xid < %s::xid8
+          AND (m.channel_id IN (SELECT c.id FROM channels c
+                                JOIN server_members sm ON sm.server_id = c.server_id
+                                WHERE sm.user_id = %s)
+               OR m.dm_low = %s OR m.dm_high = %s)
+        ORDER BY m.change_xid, m.change_seq
+        LIMIT %s
+    """, (str(since_xid), since_seq, str(settled), uid, uid, uid, limit + 1))
+    changed = [('message', row) for row in cursor.fetchall()]
+    
+    cursor.execute("""
+        SELECT t.change_seq, t.message_id, t.channel_id, t.dm_low, t.dm_high, t.change_xid::text
+        FROM message_tombstones t
+        WHERE (t.change_xid, t.change_seq) > (%s::xid8, %s) AND t.change_xid < %s::xid8
+          AND (t.channel_id IN (SELECT c.id FROM channels c
+                                JOIN server_members sm ON sm.server_id = c.server_id
+                                WHERE sm.user_id = %s)
+               OR t.dm_low = %s OR t.dm_high = %s)
+        ORDER BY t.change_xid, t.change_seq
+        LIMIT %s
+    """, (str(since_xid), since_seq, str(settled), uid, uid, uid, limit + 1))
+    changed += [('deleted', row) for row in cursor.fetchall()]
+    
+    # Both streams share message_change_seq and the xid, so the merged order is the global change order
+    changed.sort(key=lambda change: (int(change[1][-1]), change[1][0]))
+    has_more = len(changed) > limit
+    changed = changed[:limit]
+    
+    if has_more:
+        position = (int(changed[-1][1][-1]), changed[-1][1][0])
+    else:
+        # Everything settled past the cursor was returned; the next call starts at the watermark
+        position = max((settled, 0), (since_xid, since_seq))
+    
+    messages = []
+    deleted = []
+    for kind, row in changed:
+        if kind == 'deleted':
+            deleted.append({
+                'id': row[1],
+                'channelId': row[2],
+                'peerId': peer_of(uid, row[3], row[4])
+            })
+            continue
+        messages.append({
+            'id': row[1],
+            'content': row[2],
+            'createdAt': row[3].isoformat() if row[3] else None,
+            'editedAt': row[4].isoformat() if row[4] else None,
+            'channelId': row[5],
+            'peerId': peer_of(uid, row[6], row[7]),
+            'sender': {
+                'id': row[8],
+                'username': row[9],
+                'discriminator': row[10],
+                'avatarUrl': row[11]
+            }
+        })
+    
+    return response.json(200, {
+        'messages': messages,
+        'deleted': deleted,
+        'cursor': encode_change_cursor(*position),
+        'hasMore': has_more
+    })
+
+def ack_read(conn, user_id: str, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Move the user's read marker forward in a channel or DM; never moves it back"""
+    channel_id = parse_id(body_data['channelId']) if body_data.get('channelId') else None
+    recipient_id = parse_id(body_data['recipientId']) if body_data.get('recipientId') else None
+    message_id = parse_id(body_data['messageId']) if body_data.get('messageId') else None
+    
+    if not body_data.get('messageId') or not (body_data.get('channelId') or body_data.get('recipientId')):
+        return response.error(400, 'Message ID and channel ID or recipient ID required')
+    if any(body_data.get(key) and value is None
+           for key, value in (('messageId', message_id), ('channelId', channel_id), ('recipientId', recipient_id))):
+        return response.error(400, 'Invalid message, channel or recipient ID')
+    
+    cursor = conn.cursor()
+    if channel_id:
+        cursor.execute("""
+            SELECT 1 FROM channels c
+            JOIN server_members sm ON sm.server_id = c.server_id
+            WHERE c.id = %s AND sm.user_id = %s
+        """, (channel_id, user_id))
+        if not cursor.fetchone():
+            return response.error(403, 'Not a member of this channel')
+        cursor.execute("""
+            INSERT INTO read_markers (user_id, channel_id, last_read_message_id)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (user_id, channel_id) WHERE channel_id IS NOT NULL
+            DO UPDATE SET last_read_message_id = GREATEST(read_markers.last_read_message_id, EXCLUDED.last_read_message_id),
+                          updated_at = CURRENT_TIMESTAMP
+        """, (user_id, channel_id, message_id))
+    else:
+        cursor.execute("SELECT 1 FROM users WHERE id = %s", (recipient_id,))
+        if not cursor.fetchone():
+            return response.error(404, 'Recipient not found')
+        cursor.execute("""
+            INSERT INTO read_markers (user_id, peer_id, last_read_message_id)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (user_id, peer_id) WHERE peer_id IS NOT NULL
+            DO UPDATE SET last_read_message_id = GREATEST(read_markers.last_read_message_id, EXCLUDED.last_read_message_id),
+                          updated_at = CURRENT_TIMESTAMP
+        """, (user_id, recipient_id, message_id))
+    conn.commit()
+    
+    return response.json(200, {'message': 'Marked as read'})
+
+def unread_counts(conn, user_id: str) -> Dict[str, Any]:
+    """Unread counts (capped at UNREAD_CAP) and mention flags for all channels and DMs of the user;
+    DM counts come from the last DM_UNREAD_WINDOW incoming messages and say when they may be short"""
+    cursor = conn.cursor()
+    mention = f"%<@{int(user_id)}>%"
+    
+    # Each channel costs one short backward walk on (channel_id, id), bounded by the marker and the cap
+    cursor.execute("""
+        SELECT c.id, counts.unread, counts.mentioned
+        FROM server_members sm
+        JOIN channels c ON c.server_id = sm.server_id
+        LEFT JOIN read_markers r ON r.user_id = sm.user_id AND r.channel_id = c.id
+        CROSS JOIN LATERAL (
+            SELECT count(*) AS unread, COALESCE(bool_or(w.content LIKE %s), FALSE) AS mentioned
+            FROM (
+                SELECT m.content FROM messages m
+                WHERE m.channel_id = c.id
+                  AND m.id > COALESCE(r.last_read_message_id, 0)
+                  AND m.sender_id <> sm.user_id
+                ORDER BY m.id DESC
+                LIMIT %s
+            ) w
+        ) counts
+        WHERE sm.user_id = %s AND counts.unread > 0
+    """, (mention, UNREAD_CAP, user_id))
+    
+    channels = []
+    for row in cursor.fetchall():
+        channels.append({
+            'channelId': row[0],
+            'unread': row[1],
+            'mentioned': row[2]
+        })
+    
+    # DMs are found from the most recent incoming messages rather than a conversation list
+    cursor.execute("""
+        WITH w AS (
+            SELECT m.id, m.sender_id, m.content FROM messages m
+            WHERE m.recipient_id = %s
+            ORDER BY m.id DESC
+            LIMIT %s
+        )
+        SELECT w.sender_id,
+               LEAST(count(*) FILTER (WHERE s.unread), %s),
+               COALESCE(bool_or(w.content LIKE %s) FILTER (WHERE s.unread), FALSE),
+               -- A full window may have cut off older unread messages, unless a read one of the peer is inside it
+               (SELECT count(*) FROM w) >= %s AND bool_and(s.unread)
+        FROM w
+        LEFT JOIN read_markers r ON r.user_id = %s AND r.peer_id = w.sender_id
+        CROSS JOIN LATERAL (SELECT w.id > COALESCE(r.last_read_message_id, 0) AS unread) s
+        GROUP BY w.sender_id
+        HAVING bool_or(s.unread)
+    """, (user_id, DM_UNREAD_WINDOW, UNREAD_CAP, mention, DM_UNREAD_WINDOW, user_id))
+    
+    dms = []
+    for row in cursor.fetchall():
+        dms.append({
+            'peerId': row[0],
+            'unread': row[1],
+            'mentioned': row[2],
+            'capped': row[3]
+        })
+    
+    return response.json(200, {'channels': channels, 'dms': dms, 'cap': UNREAD_CAP})
+
+def peer_of(user_id: int, dm_low: Optional[int], dm_high: Optional[int]) -> Optional[int]:
+    """The other participant of a DM conversation key, None for channel messages"""
+    if dm_low is None:
+        return None
+    return dm_high if dm_low == user_id else dm_low
+
+def search_messages(conn, user_id: str, params: Dict[str, Any]) -> Dict[str, Any]:
+    """Ranked full-text search over channels and DMs the user can read, keyset-paginated by (rank, id);
+    only the newest SEARCH_CANDIDATES matches are ranked"""
+    query = (params.get('q') or '').strip()
+    limit = admission.page_size(params, 20, MAX_SEARCH_SIZE)
+    channel_id = params.get('channelId')
+    
+    if not query:
+        return response.error(400, 'Search query required')
+    
+    try:
+        keyset = decode_search_cursor(params['cursor']) if params.get('cursor') else None
+    except ValueError:
+        return response.error(400, 'Invalid cursor')
+    
+    uid = int(user_id)
+    cursor = conn.cursor()
+    # A literal id list and the indexed sender/recipient columns (dm_low/dm_high are derived from them) let a
+    # narrow scope or a rare term use bitmap scans instead of walking every partition's newest rows backwards
+    cursor.execute("""
+        SELECT c.id FROM channels c
+        JOIN server_members sm ON sm.server_id = c.server_id
+        WHERE sm.user_id = %s
+    """, (uid,))
+    readable = [row[0] for row in cursor.fetchall()]
+    scope_sql = "(m.channel_id = ANY(%s) OR m.recipient_id = %s OR (m.sender_id = %s AND m.recipient_id IS NOT NULL))"
+    args: List[Any] = [query, query, query, query, readable, uid, uid]
+    if channel_id:
+        scope_sql += " AND m.channel_id = %s"
+        args.append(channel_id)
+    args.append(SEARCH_CANDIDATES)
+    keyset_sql = ''
+    if keyset:
+        # Ranks are real; comparing as real keeps the cursor row exactly on the boundary
+        keyset_sql = "WHERE (m.rank, m.id) < (%s::real, %s)"
+        args.extend(keyset)
+    args.append(limit + 1)
+    
+    cursor.execute(f"""
+        WITH q AS (
+            SELECT websearch_to_tsquery('russian', %s) || websearch_to_tsquery('english', %s) AS query
+        ), candidates AS (
+            -- Spelled out rather than joined from q, so the planner can estimate how many rows the term matches
+            SELECT m.id, m.content, m.created_at, m.channel_id, m.dm_low, m.dm_high, m.sender_id, m.search_tsv
+            FROM messages m
+            WHERE m.search_tsv @@ (websearch_to_tsquery('russian', %s) || websearch_to_tsquery('english', %s))
+              AND {scope_sql}
+            ORDER BY m.id DESC
+            LIMIT %s
+        ), ranked AS (
+            SELECT c.*, ts_rank(c.search_tsv, q.query) AS rank, count(*) OVER () AS total
+            FROM candidates c, q
+        )
+        SELECT m.id, m.content, m.created_at, m.channel_id, m.dm_low, m.dm_high,
+               u.id, u.username, u.discriminator, u.avatar_url, m.rank, m.total
+        FROM ranked m
+        JOIN users u ON m.sender_id = u.id
+        {keyset_sql}
+        ORDER BY m.rank DESC, m.id DESC
+        LIMIT %s
+    """, args)
+    
+    rows = cursor.fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    
+    results = []
+    for row in rows:
+        results.append({
+            'id': row[0],
+            'content': row[1],
+            'createdAt': row[2].isoformat() if row[2] else None,
+            'channelId': row[3],
+            'peerId': peer_of(uid, row[4], row[5]),
+            'sender': {
+                'id': row[6],
+                'username': row[7],
+                'discriminator': row[8],
+                'avatarUrl': row[9]
+            },
+            'rank': row[10]
+        })
+    
+    return response.json(200, {
+        'results': results,
+        'nextCursor': encode_search_cursor(rows[-1][10], rows[-1][0]) if has_more else None,
+        # Older matches beyond the newest SEARCH_CANDIDATES were not ranked
+        'capped': bool(rows) and rows[0][11] >= SEARCH_CANDIDATES
+    })
+
+def archived_lines(cursor, rows: List[Tuple], dm_pair: Optional[Tuple[int, int]]) -> str:
+    """Export lines, in the same shape COPY produces, for rows read back from the archive"""
+    ids = {row[3] for row in rows} | set(dm_pair or ())
+    cursor.execute("SELECT id, incordes_id FROM users WHERE id = ANY(%s)", (list(ids),))
+    incordes = dict(cursor.fetchall())
+    lines = []
+    for message_id, content, created_at, sender_id, _, _, _, edited_at in rows:
+        lines.append(response.dumps({
+            'id': message_id,
+            'createdAt': created_at,
+            'editedAt': edited_at,
+            'content': content,
+            'sender': incordes.get(sender_id),
+            'recipient': incordes.get(peer_of(sender_id, *dm_pair)) if dm_pair else None
+        }) + '\n')
+    return ''.join(lines)
+
+def export_history(conn, user_id: str, params: Dict[str, Any]) -> Dict[str, Any]:
+    """One NDJSON chunk of a channel or DM history, oldest first; X-Next-Cursor fetches the next one"""
+    cursor = conn.cursor()
+    uid = int(user_id)
+    limit = admission.page_size(params, EXPORT_CHUNK_SIZE, MAX_EXPORT_CHUNK_SIZE)
+    channel_id = params.get('channelId')
+    recipient_id = params.get('recipientId')
+    dm_pair = None
+    
+    if channel_id:
+        cursor.execute("""
+            SELECT 1 FROM channels c
+            JOIN server_members sm ON sm.server_id = c.server_id
+            WHERE c.id = %s AND sm.user_id = %s
+        """, (channel_id, uid))
+        if not cursor.fetchone():
+            return response.error(403, 'Not a member of this channel')
+        scope_sql = "m.channel_id = %s"
+        scope_args = (int(channel_id),)
+        archive_key = archive.conversation_key(int(channel_id))
+    elif recipient_id:
+        dm_pair = dm_key(uid, recipient_id)
+        scope_sql = "m.dm_low = %s AND m.dm_high = %s"
+        scope_args = dm_pair
+        archive_key = archive.conversation_key(None, *dm_pair)
+    else:
+        return response.error(400, 'Channel ID or recipient ID required')
+    
+    try:
+        last = decode_cursor(params['cursor']) if params.get('cursor') else None
+    except ValueError:
+        return response.error(400, 'Invalid cursor')
+    
+    # Only this chunk is ever held in memory, however long the history is
+    out = io.StringIO()
+    rows = 0
+    archived_before = archive.hot_from()
+    if archived_before is not None and (last is None or last[0] < archived_before):
+        with instrument.phase('archive'):
+            archived = archive.read(cursor, archive_key, last, limit, descending=False, senders=False)
+        if archived:
+            out.write(archived_lines(cursor, archived, dm_pair))
+            rows = len(archived)
+            last = (archived[-1][2], archived[-1][0])
+    
+    if rows < limit:
+        keyset_sql = ''
+        keyset_args: Tuple = ()
+        if last:
+            keyset_sql = " AND m.created_at >= %s AND (m.created_at, m.id) > (%s, %s)"
+            keyset_args = (last[0],) + tuple(last)
+        statement = cursor.mogrify(f"""
+            SELECT row_to_json(e) FROM (
+                SELECT m.id, m.created_at AS "createdAt", m.edited_at AS "editedAt", m.content,
+                       s.incordes_id AS sender, r.incordes_id AS recipient
+                FROM messages m
+                JOIN users s ON s.id = m.sender_id
+                LEFT JOIN users r ON r.id = m.recipient_id
+                WHERE {scope_sql}{keyset_sql}
+                ORDER BY m.created_at, m.id
+                LIMIT %s
+            ) e
+        """, scope_args + keyset_args + (limit - rows,)).decode()
+        start = out.tell()
+        with instrument.phase('copy'):
+            cursor.copy_expert(f"COPY ({statement}) TO STDOUT WITH ({EXPORT_COPY_OPTIONS})", out)
+        body = out.getvalue()
+        copied = body.count('\n', start)
+        if copied:
+            tail = json.loads(body[body.rfind('\n', 0, len(body) - 1) + 1:])
+            last = (datetime.fromisoformat(tail['createdAt']), tail['id'])
+            rows += copied
+    else:
+        body = out.getvalue()
+    
+    headers = {'X-Export-Rows': str(rows), 'Access-Control-Expose-Headers': 'X-Next-Cursor, X-Export-Rows'}
+    if rows == limit:
+        headers['X-Next-Cursor'] = encode_cursor(last[0], last[1])
+    return response.text(200, body, 'application/x-ndjson', headers)
+
+def hot_history(cursor, scope_sql: str, scope_args: Tuple, keyset: Optional[Tuple[datetime, int]],
+                ascending: bool, count: int, senders: bool = True) -> List[Tuple]:
+    """One history page from the partitioned table; the created_at bound lets the planner prune partitions"""
+    keyset_sql = ''
+    keyset_args: Tuple = ()
+    if keyset:
+        if ascending:
+            keyset_sql = " AND m.created_at >= %s AND (m.created_at, m.id) > (%s, %s)"
+        else:
+            keyset_sql = " AND m.created_at <= %s AND (m.created_at, m.id) < (%s, %s)"
+        keyset_args = (keyset[0],) + tuple(keyset)
+    order = 'ASC' if ascending else 'DESC'
+    
+    if senders:
+        columns = "u.id, u.username, u.discriminator, u.avatar_url"
+        join_sql = "JOIN users u ON m.sender_id = u.id"
+    else:
+        # Profiles come from the profile cache; the row shape stays the same
+        columns = "m.sender_id, NULL, NULL, NULL"
+        join_sql = ""
+    
+    cursor.execute(f"""
+        SELECT m.id, m.content, m.created_at,
+               {columns}, m.edited_at
+        FROM messages m
+        {join_sql}
+        WHERE {scope_sql}{keyset_sql}
+        ORDER BY m.created_at {order}, m.id {order}
+        LIMIT %s
+    """, scope_args + keyset_args + (count,))
+    return cursor.fetchall()
+
+def read_history(cursor, scope_sql: str, scope_args: Tuple, archive_key: str,
+                 keyset: Optional[Tuple[datetime, int]], ascending: bool, count: int,
+                 senders: bool = True) -> List[Tuple]:
+    """History page that continues into the cold archive only once the hot partitions run out"""
+    archived_before = archive.hot_from()
+    if archived_before is None:
+        return hot_history(cursor, scope_sql, scope_args, keyset, ascending, count, senders)
+    
+    if ascending:
+        rows = []
+        if keyset is not None and keyset[0] < archived_before:
+            with instrument.phase('archive'):
+                rows = archive.read(cursor, archive_key, keyset, count, descending=False, senders=senders)
+        if len(rows) < count:
+            edge = (rows[-1][2], rows[-1][0]) if rows else keyset
+            rows += hot_history(cursor, scope_sql, scope_args, edge, True, count - len(rows), senders)
+        return rows
+    
+    rows = hot_history(cursor, scope_sql, scope_args, keyset, False, count, senders)
+    if len(rows) < count:
+        # Hot rows are exhausted; older ones can only be in the archive, and only if a month before the edge holds the conversation
+        edge = (rows[-1][2], rows[-1][0]) if rows else keyset
+        with instrument.phase('archive'):
+            if archive.has_rows(archive_key, edge[0] if edge else None):
+                rows += archive.read(cursor, archive_key, edge, count - len(rows), descending=True, senders=senders)
+    return rows
+
+def history_with_users(cursor, rows: List[Tuple]) -> Dict[str, Any]:
+    """Messages carrying only senderId, plus each distinct sender's profile once in a users map"""
+    with instrument.phase('profiles'):
+        users = profiles.get_many(cursor, {row[3] for row in rows})
+    messages = []
+    for row in rows:
+        # Same as the inner join of the other shape: messages of unknown senders are left out
+        if row[3] not in users:
+            continue
+        messages.append({
+            'id': row[0],
+            'content': row[1],
+            'createdAt': row[2].isoformat() if row[2] else None,
+            'editedAt': row[7].isoformat() if row[7] else None,
+            'senderId': row[3]
+        })
+    return {'messages': messages, 'users': {str(user_id): profile for user_id, profile in users.items()}}
+
+def parse_time(value: Any) -> Optional[datetime]:
+    """Naive UTC timestamp from an ISO 8601 string, None when absent, ValueError when malformed"""
+    if value is None or value == '':
+        return None
+    parsed = datetime.fromisoformat(str(value))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def moderates(cursor, user_id: int, server_id: Any) -> bool:
+    """Whether the user owns the server or is a member with a moderator role"""
+    cursor.execute("""
+        SELECT 1 FROM servers s
+        WHERE s.id = %s
+          AND (s.owner_id = %s
+               OR EXISTS (SELECT 1 FROM server_members sm
+                          WHERE sm.server_id = s.id AND sm.user_id = %s AND sm.role = ANY(%s)))
+    """, (server_id, user_id, user_id, MODERATOR_ROLES))
+    return cursor.fetchone() is not None
+
+def delete_batch(cursor, scope_sql: str, scope_args: Tuple, limit: int,
+                 after: Optional[Tuple[datetime, int]] = None) -> Tuple[int, Optional[Tuple[datetime, int]]]:
+    """Delete up to limit matching messages past the (created_at, id) position, oldest first, leaving
+    tombstones and queueing 'del' events; returns the count and the last position examined"""
+    keyset_sql = " AND (m.created_at, m.id) > (%s, %s)" if after else ""
+    cursor.execute(f"""
+        SELECT m.created_at, m.id FROM messages m
+        WHERE {scope_sql}{keyset_sql}
+        ORDER BY m.created_at, m.id
+        LIMIT %s
+    """, scope_args + (after or ()) + (limit,))
+    batch = cursor.fetchall()
+    if not batch:
+        return 0, None
+    
+    # Deleting the key range of the batch keeps the scope's index and partition pruning; a join
+    # on the selected keys is planned as a hash join over every partition
+    cursor.execute(f"""
+        WITH removed AS (
+            DELETE FROM messages m
+            WHERE {scope_sql} AND (m.created_at, m.id) >= (%s, %s) AND (m.created_at, m.id) <= (%s, %s)
+            RETURNING m.id, m.channel_id, m.dm_low, m.dm_high
+        )
+        INSERT INTO message_tombstones (message_id, channel_id, dm_low, dm_high)
+        SELECT id, channel_id, dm_low, dm_high FROM removed
+        RETURNING message_id, deleted_at, change_seq, channel_id, dm_low, dm_high, change_xid::text
+    """, scope_args + batch[0] + batch[-1])
+    rows = cursor.fetchall()
+    publish_events(cursor, [message_event('del', row) for row in rows])
+    return len(rows), batch[-1]
+
+def bulk_delete(conn, user_id: str, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Delete listed messages the user sent or moderates, committing every PURGE_BATCH_SIZE ids"""
+    ids = body_data.get('messageIds')
+    
+    if not isinstance(ids, list) or not ids:
+        return response.error(400, 'Message IDs array required')
+    
+    if len(ids) > MAX_BULK_DELETE_IDS:
+        return response.error(400, f'At most {MAX_BULK_DELETE_IDS} messages per request')
+    
+    try:
+        ids = sorted({int(message_id) for message_id in ids})
+    except (TypeError, ValueError):
+        return response.error(400, 'Message IDs must be integers')
+    
+    cursor = conn.cursor()
+    uid = int(user_id)
+    deleted = 0
+    batches = 0
+    for start in range(0, len(ids), PURGE_BATCH_SIZE):
+        chunk = ids[start:start + PURGE_BATCH_SIZE]
+        with instrument.phase('purge'):
+            deleted += delete_batch(
+                cursor,
+                f"m.id = ANY(%s) AND (m.sender_id = %s OR m.channel_id IN ({MODERATED_CHANNELS_SQL}))",
+                (chunk, uid, uid, uid, MODERATOR_ROLES),
+                len(chunk)
+            )[0]
+        conn.commit()
+        batches += 1
+    instrument.annotate('deleted', deleted)
+    
+    return response.json(200, {'deleted': deleted, 'skipped': len(ids) - deleted, 'batches': batches})
+
+def purge_job(row: Tuple) -> Dict[str, Any]:
+    """Client view of a purge_jobs row selected with PURGE_JOB_COLUMNS"""
+    return {
+        'jobId': row[0],
+        'serverId': row[1],
+        'channelId': row[2],
+        'senderId': row[3],
+        'from': row[4].isoformat() if row[4] else None,
+        'to': row[5].isoformat() if row[5] else None,
+        'state': row[6],
+        'deleted': row[7],
+        'batches': row[8],
+        'error': row[9],
+        'createdAt': row[10].isoformat() if row[10] else None,
+        'updatedAt': row[11].isoformat() if row[11] else None,
+        'finishedAt': row[12].isoformat() if row[12] else None
+    }
+
+def purge_scope(row: Tuple) -> Tuple[str, Tuple]:
+    """WHERE clause over messages m for the job in a purge_jobs row"""
+    _, server_id, channel_id, sender_id, from_ts, to_ts = row[:6]
+    if channel_id:
+        clauses = ["m.channel_id = %s"]
+        args: List[Any] = [channel_id]
+    else:
+        clauses = ["m.channel_id IN (SELECT c.id FROM channels c WHERE c.server_id = %s)"]
+        args = [server_id]
+    if sender_id:
+        clauses.append("m.sender_id = %s")
+        args.append(sender_id)
+    if from_ts:
+        clauses.append("m.created_at >= %s")
+        args.append(from_ts)
+    # Always set (V0016): the job's cutoff, at the latest the moment it was created
+    clauses.append("m.created_at < %s")
+    args.append(to_ts)
+    return ' AND '.join(clauses), tuple(args)
+
+def run_purge(conn, job_id: int, seconds: float, pause: float = 0.0) -> Optional[Dict[str, Any]]:
+    """Continue a purge job for up to `seconds`, one committed batch at a time; None if another runner holds it"""
+    cursor = conn.cursor()
+    # Session-level lock: survives the per-batch commits, released by the server if the runner dies
+    cursor.execute("SELECT pg_try_advisory_lock(hashtext('purge_jobs'), %s)", (job_id,))
+    if not cursor.fetchone()[0]:
+        conn.rollback()
+        return None
+    
+    try:
+        cursor.execute(f"SELECT {PURGE_JOB_COLUMNS} FROM purge_jobs WHERE id = %s", (job_id,))
+        row = cursor.fetchone()
+        if row is None or row[6] == 'done':
+            conn.rollback()
+            return purge_job(row) if row else None
+        
+        scope_sql, scope_args = purge_scope(row)
+        cursor.execute("""
+            UPDATE purge_jobs SET state = 'running', error = NULL, updated_at = CURRENT_TIMESTAMP WHERE id = %s
+        """, (job_id,))
+        conn.commit()
+        
+        # The position is stored with each batch: starting from the oldest row again would walk
+        # the index entries of every row deleted so far, which vacuum has not removed yet
+        position = (row[13], row[14]) if row[13] else None
+        deadline = time.monotonic() + seconds
+        finished = False
+        try:
+            while not finished and time.monotonic() < deadline:
+                with instrument.phase('purge'):
+                    deleted, position = delete_batch(cursor, scope_sql, scope_args, PURGE_BATCH_SIZE, position)
+                finished = position is None
+                if not finished:
+                    cursor.execute("""
+                        UPDATE purge_jobs
+                        SET deleted = deleted + %s, batches = batches + 1, last_created_at = %s, last_id = %s,
+                            updated_at = CURRENT_TIMESTAMP
+                        WHERE id = %s
+                    """, (deleted, position[0], position[1], job_id))
+                conn.commit()
+                if pause and not finished:
+                    time.sleep(pause)
+        except psycopg2.Error as exc:
+            conn.rollback()
+            cursor.execute("""
+                UPDATE purge_jobs SET state = 'failed', error = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s
+            """, (str(exc).strip()[:500], job_id))
+            conn.commit()
+            raise
+        
+        cursor.execute(f"""
+            UPDATE purge_jobs
+            SET state = %s, updated_at = CURRENT_TIMESTAMP, finished_at = CASE WHEN %s THEN CURRENT_TIMESTAMP END
+            WHERE id = %s
+            RETURNING {PURGE_JOB_COLUMNS}
+        """, ('done' if finished else 'pending', finished, job_id))
+        updated = cursor.fetchone()
+        conn.commit()
+        # The job row goes away with its channel or server (ON DELETE CASCADE), and so does what it was purging
+        return purge_job(updated) if updated else dict(purge_job(row), state='done')
+    finally:
+        conn.rollback()
+        cursor.execute("SELECT pg_advisory_unlock(hashtext('purge_jobs'), %s)", (job_id,))
+        conn.commit()
+
+def purge_response(job: Dict[str, Any]) -> Dict[str, Any]:
+    """200 with a finished job, 202 while batches remain"""
+    instrument.annotate('purge', {'jobId': job['jobId'], 'state': job['state'], 'deleted': job['deleted']})
+    return response.json(200 if job['state'] == 'done' else 202, job)
+
+def moderated_job(cursor, user_id: int, job_id: Any) -> Optional[Tuple]:
+    """The purge_jobs row, if it exists and the user moderates its server"""
+    try:
+        job_id = int(job_id)
+    except (TypeError, ValueError):
+        return None
+    cursor.execute(f"SELECT {PURGE_JOB_COLUMNS} FROM purge_jobs WHERE id = %s", (job_id,))
+    row = cursor.fetchone()
+    if row is None or not moderates(cursor, user_id, row[1]):
+        return None
+    return row
+
+def start_purge(conn, user_id: str, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Purge a channel, or one sender's messages in a channel or server, optionally within [from, to);
+    the job never reaches past the moment it was started, however late it is resumed"""
+    channel_id = parse_id(body_data['channelId']) if body_data.get('channelId') else None
+    server_id = parse_id(body_data['serverId']) if body_data.get('serverId') else None
+    sender_id = parse_id(body_data['senderId']) if body_data.get('senderId') else None
+    if any(body_data.get(key) and value is None
+           for key, value in (('channelId', channel_id), ('serverId', server_id), ('senderId', sender_id))):
+        return response.error(400, 'Invalid channel, server or sender ID')
+    
+    try:
+        from_ts = parse_time(body_data.get('from'))
+        to_ts = parse_time(body_data.get('to'))
+    except ValueError:
+        return response.error(400, 'Invalid from or to timestamp')
+    
+    if not channel_id and not (server_id and sender_id):
+        return response.error(400, 'Channel ID, or server ID and sender ID required')
+    
+    cursor = conn.cursor()
+    uid = int(user_id)
+    if channel_id:
+        cursor.execute("SELECT server_id FROM channels WHERE id = %s", (channel_id,))
+        channel = cursor.fetchone()
+        if not channel:
+            return response.error(404, 'Channel not found')
+        server_id = channel[0]
+    
+    if not moderates(cursor, uid, server_id):
+        return response.error(403, 'Only server moderators can purge messages')
+    
+    # Not committed here: run_purge commits the job together with its 'running' state.
+    # to_ts is capped at now, so messages sent after the purge started are never in its scope
+    cursor.execute("""
+        INSERT INTO purge_jobs (server_id, channel_id, sender_id, from_ts, to_ts, requested_by)
+        VALUES (%s, %s, %s, %s, LEAST(%s::timestamp, LOCALTIMESTAMP), %s)
+        RETURNING id
+    """, (server_id, channel_id, sender_id, from_ts, to_ts, uid))
+    job_id = cursor.fetchone()[0]
+    
+    return purge_response(run_purge(conn, job_id, PURGE_REQUEST_SECONDS))
+
+def resume_purge(conn, user_id: str, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Continue an unfinished or failed purge job for another request's worth of batches"""
+    cursor = conn.cursor()
+    row = moderated_job(cursor, int(user_id), body_data.get('jobId'))
+    conn.rollback()
+    
+    if row is None:
+        return response.error(404, 'Purge job not found')
+    
+    job = run_purge(conn, row[0], PURGE_REQUEST_SECONDS)
+    if job is None:
+        return response.error(409, 'Purge job is already running')
+    
+    return purge_response(job)
+
+def purge_status(conn, user_id: str, params: Dict[str, Any]) -> Dict[str, Any]:
+    """Progress of a purge job: state, messages deleted so far and the last error"""
+    row = moderated_job(conn.cursor(), int(user_id), params.get('jobId'))
+    
+    if row is None:
+        return response.error(404, 'Purge job not found')
+    
+    return response.json(200, purge_job(row))
+
+@instrument.instrumented
+@response.negotiated
+@admission.admitted('messages', ADMISSION_RULES)
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
+        return response.preflight('GET, POST, PUT, DELETE, OPTIONS', 'Content-Type, X-User-Id, X-Auth-Token')
     
-    headers_dict = event.get('headers', {})
-    user_id = headers_dict.get('X-User-Id') or headers_dict.get('x-user-id')
+    user_id = tokens.authenticate(event)
     
     if not user_id:
-        return {
-            'statusCode': 401,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'User ID required'})
-        }
+        return response.error(401, 'User ID required')
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    with instrument.phase('connect'):
+        conn = db.getconn()
     
     try:
         cursor = conn.cursor()
         
         if method == 'GET':
             params = event.get('queryStringParameters', {})
+            
+            if params.get('action') == 'sync':
+                return sync_changes(conn, user_id, params)
+            
+            if params.get('action') == 'unread':
+                return unread_counts(conn, user_id)
+            
+            if params.get('action') == 'search':
+                return search_messages(conn, user_id, params)
+            
+            if params.get('action') == 'export':
+                return export_history(conn, user_id, params)
+            
+            if params.get('action') == 'purgeStatus':
+                return purge_status(conn, user_id, params)
+            
             channel_id = params.get('channelId')
             recipient_id = params.get('recipientId')
-            limit = int(params.get('limit', 50))
+            limit = admission.page_size(params, DEFAULT_HISTORY_SIZE, MAX_HISTORY_SIZE)
+            before = params.get('before')
+            after = params.get('after')
+            users_map = params.get('users') == 'map'
             
             if channel_id:
-                cursor.execute("""
-                    SELECT m.id, m.content, m.created_at,
-                           u.id, u.username, u.discriminator, u.avatar_url
-                    FROM messages m
-                    JOIN users u ON m.sender_id = u.id
-                    WHERE m.channel_id = %s
-                    ORDER BY m.created_at DESC
-                    LIMIT %s
-                """, (channel_id, limit))
+                scope_sql = "m.channel_id = %s"
+                scope_args = (channel_id,)
+                archive_key = archive.conversation_key(int(channel_id))
             elif recipient_id:
-                cursor.execute("""
-                    SELECT m.id, m.content, m.created_at,
-                           u.id, u.username, u.discriminator, u.avatar_url
-                    FROM messages m
-                    JOIN users u ON m.sender_id = u.id
-                    WHERE ((m.sender_id = %s AND m.recipient_id = %s) OR 
-                           (m.sender_id = %s AND m.recipient_id = %s))
-                    ORDER BY m.created_at DESC
-                    LIMIT %s
-                """, (user_id, recipient_id, recipient_id, user_id, limit))
+                scope_sql = "m.dm_low = %s AND m.dm_high = %s"
+                scope_args = dm_key(user_id, recipient_id)
+                archive_key = archive.conversation_key(None, *scope_args)
             else:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Channel ID or recipient ID required'})
-                }
+                return response.error(400, 'Channel ID or recipient ID required')
+            
+            try:
+                keyset = decode_cursor(after or before) if (after or before) else None
+            except ValueError:
+                return response.error(400, 'Invalid cursor')
+            
+            rows = read_history(cursor, scope_sql, scope_args, archive_key, keyset, bool(after), limit + 1,
+                                senders=not users_map)
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+            if not after:
+                rows.reverse()
+            
+            older_exist = has_more if not after else bool(rows)
+            next_cursor = encode_cursor(rows[0][2], rows[0][0]) if rows and older_exist else None
+            prev_cursor = encode_cursor(rows[-1][2], rows[-1][0]) if rows else after
+            
+            if users_map:
+                page = history_with_users(cursor, rows)
+                page.update({'nextCursor': next_cursor, 'prevCursor': prev_cursor, 'hasMore': has_more})
+                return response.json(200, page)
             
             messages = []
-            for row in cursor.fetchall():
+            for row in rows:
                 messages.append({
                     'id': row[0],
                     'content': row[1],
                     'createdAt': row[2].isoformat() if row[2] else None,
+                    'editedAt': row[7].isoformat() if row[7] else None,
                     'sender': {
                         'id': row[3],
                         'username': row[4],
@@ -88,73 +1093,103 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     }
                 })
             
-            messages.reverse()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'messages': messages})
-            }
+            return response.json(200, {
+                'messages': messages,
+                'nextCursor': next_cursor,
+                'prevCursor': prev_cursor,
+                'hasMore': has_more
+            })
         
         elif method == 'POST':
             body_data = json.loads(event.get('body', '{}'))
+            
+            if body_data.get('action') == 'sendBatch':
+                return send_batch(conn, user_id, body_data.get('messages'))
+            
+            if body_data.get('action') == 'ack':
+                return ack_read(conn, user_id, body_data)
+            
+            if body_data.get('action') == 'bulkDelete':
+                return bulk_delete(conn, user_id, body_data)
+            
+            if body_data.get('action') == 'purge':
+                return start_purge(conn, user_id, body_data)
+            
+            if body_data.get('action') == 'resumePurge':
+                return resume_purge(conn, user_id, body_data)
+            
             content = body_data.get('content')
             channel_id = body_data.get('channelId')
             recipient_id = body_data.get('recipientId')
+            error = validate_message(content, channel_id, recipient_id)
             
-            if not content:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Message content required'})
-                }
+            if error:
+                return response.error(400, error)
             
-            if not channel_id and not recipient_id:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Channel ID or recipient ID required'})
-                }
+            result = insert_messages(conn, cursor, [(user_id, channel_id, recipient_id, content)])[0]
+            publish_events(cursor, [message_event('new', result, user_id, content)])
+            conn.commit()
             
-            cursor.execute("""
-                INSERT INTO messages (sender_id, channel_id, recipient_id, content)
-                VALUES (%s, %s, %s, %s) RETURNING id, created_at
-            """, (user_id, channel_id, recipient_id, content))
+            return response.json(200, {
+                'id': result[0],
+                'createdAt': result[1].isoformat() if result[1] else None,
+                'message': 'Message sent'
+            })
+        
+        elif method == 'PUT':
+            body_data = json.loads(event.get('body', '{}'))
+            message_id = body_data.get('messageId')
+            content = body_data.get('content')
+            
+            if not message_id or not content:
+                return response.error(400, 'Message ID and content required')
             
+            cursor.execute("""
+                UPDATE messages
+                SET content = %s, edited_at = CURRENT_TIMESTAMP, change_seq = nextval('message_change_seq'),
+                    change_xid = pg_current_xact_id()
+                WHERE id = %s AND sender_id = %s
+                RETURNING id, edited_at, change_seq, channel_id, dm_low, dm_high, change_xid::text
+            """, (content, message_id, user_id))
             result = cursor.fetchone()
+            if result:
+                publish_events(cursor, [message_event('edit', result, user_id, content)])
             conn.commit()
             
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'id': result[0],
-                    'createdAt': result[1].isoformat() if result[1] else None,
-                    'message': 'Message sent'
-                })
-            }
+            if not result:
+                return response.error(404, 'Message not found')
+            
+            return response.json(200, {
+                'id': result[0],
+                'editedAt': result[1].isoformat() if result[1] else None,
+                'message': 'Message edited'
+            })
         
         elif method == 'DELETE':
             params = event.get('queryStringParameters', {})
             message_id = params.get('messageId')
             
             cursor.execute("""
-                DELETE FROM messages
-                WHERE id = %s AND sender_id = %s
+                WITH removed AS (
+                    DELETE FROM messages
+                    WHERE id = %s AND sender_id = %s
+                    RETURNING id, channel_id, dm_low, dm_high
+                )
+                INSERT INTO message_tombstones (message_id, channel_id, dm_low, dm_high)
+                SELECT id, channel_id, dm_low, dm_high FROM removed
+                RETURNING message_id, deleted_at, change_seq, channel_id, dm_low, dm_high, change_xid::text
             """, (message_id, user_id))
+            removed = cursor.fetchall()
+            if not removed:
+                # Someone else's, already deleted, or moved to the read-only archive
+                conn.rollback()
+                return response.error(404, 'Message not found')
+            publish_events(cursor, [message_event('del', row) for row in removed])
             conn.commit()
             
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'message': 'Message deleted'})
-            }
+            return response.json(200, {'message': 'Message deleted'})
         
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'})
-        }
+        return response.error(405, 'Method not allowed')
     
     finally:
-        conn.close()
+        db.putconn(conn)
@@ -0,0 +1,86 @@
+'''
+In-process cache of the sender profiles shown next to messages (username, discriminator,
+avatar), keyed by user id.
+
+Entries are kept LRU up to PROFILE_CACHE_SIZE and dropped PROFILE_CACHE_TTL seconds after
+they were loaded. users.profile_version is bumped by a trigger whenever one of those fields
+changes (V0011), so an entry older than PROFILE_REVALIDATE_INTERVAL is checked against it:
+one query for all such ids of a page, returning the fields only for profiles that changed.
+A rename therefore shows up on every instance within the revalidate interval.
+'''
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Iterable, List, Tuple
+
+CACHE_SIZE = int(os.environ.get('PROFILE_CACHE_SIZE', '10000'))
+CACHE_TTL = float(os.environ.get('PROFILE_CACHE_TTL', '300'))
+REVALIDATE_INTERVAL = float(os.environ.get('PROFILE_REVALIDATE_INTERVAL', '10'))
+
+_lock = threading.Lock()
+# user id -> (profile, version, loaded at, checked at)
+_entries: 'OrderedDict[int, Tuple[Dict[str, Any], int, float, float]]' = OrderedDict()
+_stats = {'hits': 0, 'revalidated': 0, 'loaded': 0}
+
+
+def stats() -> Dict[str, int]:
+    with _lock:
+        return dict(_stats, size=len(_entries))
+
+
+def clear() -> None:
+    with _lock:
+        _entries.clear()
+
+
+def get_many(cursor, ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+    """Profiles of the given users; ids that do not exist are left out of the result"""
+    now = time.monotonic()
+    found: Dict[int, Dict[str, Any]] = {}
+    # Users to look up, with the version already known (0 when not cached)
+    stale: List[Tuple[int, int]] = []
+    known_profiles: Dict[int, Dict[str, Any]] = {}
+    with _lock:
+        for user_id in set(ids):
+            entry = _entries.get(user_id)
+            if entry is None or now - entry[2] >= CACHE_TTL:
+                stale.append((user_id, 0))
+                continue
+            _entries.move_to_end(user_id)
+            if now - entry[3] < REVALIDATE_INTERVAL:
+                found[user_id] = entry[0]
+                _stats['hits'] += 1
+            else:
+                stale.append((user_id, entry[1]))
+                known_profiles[user_id] = entry[0]
+    if not stale:
+        return found
+
+    cursor.execute("""
+        SELECT u.id, u.profile_version, u.profile_version <> v.known,
+               CASE WHEN u.profile_version <> v.known THEN u.username END,
+               CASE WHEN u.profile_version <> v.known THEN u.discriminator END,
+               CASE WHEN u.profile_version <> v.known THEN u.avatar_url END
+        FROM unnest(%s::int[], %s::bigint[]) AS v(id, known)
+        JOIN users u ON u.id = v.id
+    """, ([user_id for user_id, _ in stale], [known for _, known in stale]))
+    rows = cursor.fetchall()
+
+    with _lock:
+        for user_id, version, changed, username, discriminator, avatar_url in rows:
+            if changed:
+                profile = {'id': user_id, 'username': username, 'discriminator': discriminator, 'avatarUrl': avatar_url}
+                _entries[user_id] = (profile, version, now, now)
+                _stats['loaded'] += 1
+            else:
+                # Unchanged: keep the original load time, so the hard TTL still applies
+                entry = _entries.get(user_id)
+                profile = known_profiles[user_id]
+                _entries[user_id] = (profile, version, entry[2] if entry else now, now)
+                _stats['revalidated'] += 1
+            found[user_id] = profile
+        while len(_entries) > CACHE_SIZE:
+            _entries.popitem(last=False)
+    return found
@@ -6,36 +6,252 @@ Returns: HTTP response dict with server/channel data or error
 '''
 
 import json
-import os
-import psycopg2
-from typing import Dict, Any
+import base64
+import db
+import instrument
+import response
+import admission
+import tokens
+import presence
+import versions
+from datetime import datetime
+from typing import Dict, Any, Optional
 
+BOOTSTRAP_FRIENDS = 100
+# Channel positions are sparse NUMERIC keys: appends step by POSITION_STEP, moves take the midpoint.
+# Responses carry them as strings, since a JSON number would round a deep midpoint to a float
+POSITION_STEP = 1024
+# Digits after the point past which a server's channels are renumbered to whole steps again
+MAX_POSITION_SCALE = 20
+MAX_REORDER_CHANNELS = 500
+ADMISSION_RULES = {
+    '*': admission.Rule(10, 30),
+    'POST': admission.Rule(0.5, 10),
+    'GET:bootstrap': admission.Rule(0.5, 5, concurrency=8)
+}
+
+def encode_friends_cursor(created_at: datetime, peer_id: int) -> str:
+    """Cursor in the friends function's format, so the client continues the list there"""
+    raw = f"{created_at.isoformat()}|{peer_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def bootstrap(conn, user_id: str) -> Dict[str, Any]:
+    """Servers, their channels with latest message ids, and friends in three set-based queries"""
+    cursor = conn.cursor()
+    
+    cursor.execute("""
+        SELECT s.id, s.name, s.icon_url, s.owner_id
+        FROM servers s
+        JOIN server_members sm ON s.id = sm.server_id
+        WHERE sm.user_id = %s
+        ORDER BY s.created_at DESC
+    """, (user_id,))
+    
+    servers = []
+    by_id = {}
+    for row in cursor.fetchall():
+        server = {
+            'id': row[0],
+            'name': row[1],
+            'iconUrl': row[2],
+            'ownerId': row[3],
+            'channels': []
+        }
+        servers.append(server)
+        by_id[row[0]] = server
+    
+    cursor.execute("""
+        SELECT c.server_id, c.id, c.name, c.icon_url, c.description, latest.id
+        FROM server_members sm
+        JOIN channels c ON c.server_id = sm.server_id
+        LEFT JOIN LATERAL (
+            SELECT m.id FROM messages m
+            WHERE m.channel_id = c.id
+            ORDER BY m.created_at DESC, m.id DESC
+            LIMIT 1
+        ) latest ON TRUE
+        WHERE sm.user_id = %s
+        ORDER BY c.server_id, c.position, c.id
+    """, (user_id,))
+    
+    for row in cursor.fetchall():
+        server = by_id.get(row[0])
+        if server is not None:
+            server['channels'].append({
+                'id': row[1],
+                'name': row[2],
+                'iconUrl': row[3],
+                'description': row[4],
+                'latestMessageId': row[5]
+            })
+    
+    cursor.execute("""
+        SELECT u.id, u.incordes_id, u.username, u.discriminator, u.avatar_url, u.status, e.state, e.created_at
+        FROM friend_edges e
+        JOIN users u ON u.id = e.peer_id
+        WHERE e.user_id = %s
+        ORDER BY e.created_at DESC, e.peer_id DESC
+        LIMIT %s
+    """, (user_id, BOOTSTRAP_FRIENDS + 1))
+    rows = cursor.fetchall()
+    
+    friends = []
+    for row in rows[:BOOTSTRAP_FRIENDS]:
+        friends.append({
+            'id': row[0],
+            'incordesId': row[1],
+            'username': row[2],
+            'discriminator': row[3],
+            'avatarUrl': row[4],
+            'status': row[5],
+            'friendStatus': 'accepted' if row[6] == 'friends' else 'pending',
+            'direction': None if row[6] == 'friends' else row[6]
+        })
+    
+    live = presence.lookup([friend['id'] for friend in friends])
+    for friend in friends:
+        friend['status'] = live.get(friend['id'], 'offline' if presence.store.authoritative else friend['status'])
+    
+    friends_cursor = None
+    if len(rows) > BOOTSTRAP_FRIENDS:
+        friends_cursor = encode_friends_cursor(rows[BOOTSTRAP_FRIENDS - 1][7], rows[BOOTSTRAP_FRIENDS - 1][0])
+    
+    return response.json(200, {'servers': servers, 'friends': friends, 'friendsNextCursor': friends_cursor})
+
+def lock_server(cursor, server_id: Any) -> Optional[int]:
+    """Lock the server row, which serializes position changes of its channels; returns the owner id"""
+    cursor.execute("SELECT owner_id FROM servers WHERE id = %s FOR UPDATE", (server_id,))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def renumber_channels(cursor, server_id: Any) -> None:
+    """Spread the server's channels back to whole POSITION_STEP multiples, keeping their order"""
+    cursor.execute("""
+        UPDATE channels c SET position = r.rn * %s
+        FROM (
+            SELECT id, row_number() OVER (ORDER BY position, id) AS rn
+            FROM channels
+            WHERE server_id = %s
+        ) r
+        WHERE c.id = r.id
+    """, (POSITION_STEP, server_id))
+
+def move_channel(conn, user_id: str, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Place one channel right after afterChannelId (first when omitted); only that channel's row changes"""
+    cursor = conn.cursor()
+    server_id = body_data.get('serverId')
+    channel_id = body_data.get('channelId')
+    after_id = body_data.get('afterChannelId')
+    
+    if not server_id or not channel_id:
+        return response.error(400, 'Server ID and channel ID required')
+    if after_id is not None and str(after_id) == str(channel_id):
+        return response.error(400, 'Channel cannot be placed after itself')
+    
+    owner_id = lock_server(cursor, server_id)
+    if owner_id is None:
+        return response.error(404, 'Server not found')
+    if owner_id != int(user_id):
+        return response.error(403, 'Only the server owner can reorder channels')
+    
+    cursor.execute("SELECT 1 FROM channels WHERE id = %s AND server_id = %s", (channel_id, server_id))
+    if not cursor.fetchone():
+        return response.error(404, 'Channel not found')
+    
+    previous = None
+    if after_id is not None:
+        cursor.execute("SELECT position FROM channels WHERE id = %s AND server_id = %s", (after_id, server_id))
+        row = cursor.fetchone()
+        if not row:
+            return response.error(404, 'Channel not found')
+        previous = row[0]
+    
+    cursor.execute("""
+        SELECT position FROM channels
+        WHERE server_id = %s AND id <> %s AND (%s::numeric IS NULL OR position > %s)
+        ORDER BY position
+        LIMIT 1
+    """, (server_id, channel_id, previous, previous))
+    row = cursor.fetchone()
+    following = row[0] if row else None
+    
+    # The midpoint is computed by the database: numeric multiplication by 0.5 is exact
+    if previous is not None and following is not None:
+        position_sql, args = "trim_scale((%s::numeric + %s::numeric) * 0.5)", (previous, following)
+    elif previous is not None:
+        position_sql, args = "%s::numeric + %s", (previous, POSITION_STEP)
+    elif following is not None:
+        position_sql, args = "%s::numeric - %s", (following, POSITION_STEP)
+    else:
+        position_sql, args = "%s::numeric", (POSITION_STEP,)
+    cursor.execute(f"""
+        UPDATE channels SET position = {position_sql}
+        WHERE id = %s
+        RETURNING scale(position)
+    """, args + (channel_id,))
+    if cursor.fetchone()[0] > MAX_POSITION_SCALE:
+        renumber_channels(cursor, server_id)
+    
+    cursor.execute("SELECT position::text FROM channels WHERE id = %s", (channel_id,))
+    position = cursor.fetchone()[0]
+    versions.bump(cursor, [versions.channels_key(server_id)])
+    conn.commit()
+    
+    return response.json(200, {'channelId': int(channel_id), 'position': position, 'message': 'Channel moved'})
+
+def reorder_channels(conn, user_id: str, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Apply a complete new channel order of a server in one statement"""
+    cursor = conn.cursor()
+    server_id = body_data.get('serverId')
+    channel_ids = body_data.get('channelIds')
+    
+    if not server_id or not isinstance(channel_ids, list) or not channel_ids:
+        return response.error(400, 'Server ID and channelIds required')
+    if len(channel_ids) > MAX_REORDER_CHANNELS:
+        return response.error(400, f'At most {MAX_REORDER_CHANNELS} channels per reorder')
+    try:
+        channel_ids = [int(channel_id) for channel_id in channel_ids]
+    except (TypeError, ValueError):
+        return response.error(400, 'channelIds must be integers')
+    
+    owner_id = lock_server(cursor, server_id)
+    if owner_id is None:
+        return response.error(404, 'Server not found')
+    if owner_id != int(user_id):
+        return response.error(403, 'Only the server owner can reorder channels')
+    
+    cursor.execute("SELECT id FROM channels WHERE server_id = %s", (server_id,))
+    existing = {row[0] for row in cursor.fetchall()}
+    if len(channel_ids) != len(existing) or set(channel_ids) != existing:
+        return response.error(400, 'channelIds must list every channel of the server exactly once')
+    
+    positions = [(i + 1) * POSITION_STEP for i in range(len(channel_ids))]
+    cursor.execute("""
+        UPDATE channels c SET position = v.position
+        FROM unnest(%s::int[], %s::numeric[]) AS v(id, position)
+        WHERE c.id = v.id AND c.server_id = %s AND c.position <> v.position
+    """, (channel_ids, positions, server_id))
+    versions.bump(cursor, [versions.channels_key(server_id)])
+    conn.commit()
+    
+    return response.json(200, {'channelIds': channel_ids, 'message': 'Channels reordered'})
+
+@instrument.instrumented
+@response.negotiated
+@admission.admitted('servers', ADMISSION_RULES)
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
+        return response.preflight('GET, POST, DELETE, OPTIONS', 'Content-Type, X-User-Id, X-Auth-Token, If-None-Match')
     
-    headers_dict = event.get('headers', {})
-    user_id = headers_dict.get('X-User-Id') or headers_dict.get('x-user-id')
+    user_id = tokens.authenticate(event)
     
     if not user_id:
-        return {
-            'statusCode': 401,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'User ID required'})
-        }
+        return response.error(401, 'User ID required')
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    with instrument.phase('connect'):
+        conn = db.getconn()
     
     try:
         cursor = conn.cursor()
@@ -44,12 +260,21 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             params = event.get('queryStringParameters', {})
             server_id = params.get('serverId')
             
+            if params.get('action') == 'bootstrap':
+                return bootstrap(conn, user_id)
+            
             if server_id:
+                key = versions.channels_key(server_id)
+                with instrument.phase('version'):
+                    tag = versions.etag(key, versions.current(cursor, key))
+                if versions.not_modified(event, tag):
+                    return response.empty(304, versions.cache_headers(tag))
+                
                 cursor.execute("""
                     SELECT id, name, icon_url, description
                     FROM channels
                     WHERE server_id = %s
-                    ORDER BY position, created_at
+                    ORDER BY position, id
                 """, (server_id,))
                 
                 channels = []
@@ -61,12 +286,14 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'description': row[3]
                     })
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'channels': channels})
-                }
+                return response.json(200, {'channels': channels}, versions.cache_headers(tag))
             else:
+                key = versions.servers_key(user_id)
+                with instrument.phase('version'):
+                    tag = versions.etag(key, versions.current(cursor, key))
+                if versions.not_modified(event, tag):
+                    return response.empty(304, versions.cache_headers(tag))
+                
                 cursor.execute("""
                     SELECT s.id, s.name, s.icon_url, s.owner_id
                     FROM servers s
@@ -84,11 +311,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'ownerId': row[3]
                     })
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'servers': servers})
-                }
+                return response.json(200, {'servers': servers}, versions.cache_headers(tag))
         
         elif method == 'POST':
             body_data = json.loads(event.get('body', '{}'))
@@ -99,11 +322,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 icon_url = body_data.get('iconUrl')
                 
                 if not name:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Server name required'})
-                    }
+                    return response.error(400, 'Server name required')
                 
                 cursor.execute("""
                     INSERT INTO servers (name, icon_url, owner_id)
@@ -119,15 +338,12 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 cursor.execute("""
                     INSERT INTO channels (server_id, name, type, position)
                     VALUES (%s, %s, %s, %s)
-                """, (server_id, 'общий', 'text', 0))
+                """, (server_id, 'общий', 'text', POSITION_STEP))
                 
+                versions.bump(cursor, [versions.servers_key(user_id), versions.channels_key(server_id)])
                 conn.commit()
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'serverId': server_id, 'message': 'Server created'})
-                }
+                return response.json(200, {'serverId': server_id, 'message': 'Server created'})
             
             elif action == 'createChannel':
                 server_id = body_data.get('serverId')
@@ -135,35 +351,31 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 channel_type = body_data.get('type', 'text')
                 
                 if not name or not server_id:
-                    return {
-                        'statusCode': 400,
-                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                        'body': json.dumps({'error': 'Server ID and channel name required'})
-                    }
+                    return response.error(400, 'Server ID and channel name required')
                 
-                cursor.execute("""
-                    SELECT COUNT(*) FROM channels WHERE server_id = %s
-                """, (server_id,))
-                position = cursor.fetchone()[0]
+                # Concurrent creates in one server queue on the server row instead of reading the same max
+                if lock_server(cursor, server_id) is None:
+                    return response.error(404, 'Server not found')
                 
                 cursor.execute("""
                     INSERT INTO channels (server_id, name, type, position)
-                    VALUES (%s, %s, %s, %s) RETURNING id
-                """, (server_id, name, channel_type, position))
-                channel_id = cursor.fetchone()[0]
+                    SELECT %s, %s, %s, COALESCE(max(position), 0) + %s
+                    FROM channels WHERE server_id = %s
+                    RETURNING id, position::text
+                """, (server_id, name, channel_type, POSITION_STEP, server_id))
+                channel_id, position = cursor.fetchone()
+                versions.bump(cursor, [versions.channels_key(server_id)])
                 conn.commit()
                 
-                return {
-                    'statusCode': 200,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'channelId': channel_id, 'message': 'Channel created'})
-                }
+                return response.json(200, {'channelId': channel_id, 'position': position, 'message': 'Channel created'})
+            
+            elif action == 'moveChannel':
+                return move_channel(conn, user_id, body_data)
+            
+            elif action == 'reorderChannels':
+                return reorder_channels(conn, user_id, body_data)
         
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Method not allowed'})
-        }
+        return response.error(405, 'Method not allowed')
     
     finally:
-        conn.close()
+        db.putconn(conn)
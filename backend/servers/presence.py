@@ -0,0 +1,171 @@
+'''
+Presence: heartbeats land in a TTL store and only status changes reach Postgres,
+written in batches with one UPDATE ... FROM (VALUES ...) per flush.
+
+The store is shared (Redis) when PRESENCE_REDIS_URL is set and the redis package is
+installed; otherwise an in-process stand-in with the same interface is used, and
+lookups fall back to users.status for users this instance has not seen.
+Identical copy lives in every backend function folder that reads or writes presence.
+'''
+
+import heapq
+import os
+import threading
+import time
+from psycopg2.extras import execute_values
+from typing import Dict, Iterable, List, Optional, Tuple
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+PRESENCE_TTL = float(os.environ.get('PRESENCE_TTL', '60'))
+PRESENCE_FLUSH_INTERVAL = float(os.environ.get('PRESENCE_FLUSH_INTERVAL', '5'))
+PRESENCE_REDIS_URL = os.environ.get('PRESENCE_REDIS_URL')
+STATUSES = ('online', 'idle', 'dnd', 'offline')
+MAX_LOOKUP = 1000
+
+
+class LocalStore:
+    """In-process stand-in for the shared store: user id -> (status, expires at)"""
+
+    authoritative = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries: Dict[int, Tuple[str, float]] = {}
+        self._expiry: List[Tuple[float, int]] = []
+
+    def touch(self, user_id: int, status: str, expires_at: float) -> Optional[str]:
+        """Store a live status and return the previous one, None if the user was not live"""
+        with self._lock:
+            previous = self._entries.get(user_id)
+            self._entries[user_id] = (status, expires_at)
+            heapq.heappush(self._expiry, (expires_at, user_id))
+        return previous[0] if previous and previous[1] > time.time() else None
+
+    def remove(self, user_id: int) -> Optional[str]:
+        with self._lock:
+            previous = self._entries.pop(user_id, None)
+        return previous[0] if previous else None
+
+    def get_many(self, user_ids: Iterable[int]) -> Dict[int, str]:
+        now = time.time()
+        entries = self._entries
+        found = {}
+        for user_id in user_ids:
+            entry = entries.get(user_id)
+            if entry is not None and entry[1] > now:
+                found[user_id] = entry[0]
+        return found
+
+    def pop_expired(self, now: float) -> List[int]:
+        """Users whose last heartbeat is older than the TTL, each returned once"""
+        expired = []
+        with self._lock:
+            while self._expiry and self._expiry[0][0] <= now:
+                expires_at, user_id = heapq.heappop(self._expiry)
+                entry = self._entries.get(user_id)
+                # Older heap items of users that heartbeated since are skipped
+                if entry is not None and entry[1] == expires_at:
+                    del self._entries[user_id]
+                    expired.append(user_id)
+        return expired
+
+
+class RedisStore:
+    """Shared store: one expiring key per live user plus a sorted set of expiry times"""
+
+    authoritative = True
+
+    def __init__(self, url: str):
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+
+    def touch(self, user_id: int, status: str, expires_at: float) -> Optional[str]:
+        pipe = self._redis.pipeline()
+        pipe.set(f'presence:{user_id}', status, ex=max(int(expires_at - time.time()), 1) + 1, get=True)
+        pipe.zadd('presence:expiry', {str(user_id): expires_at})
+        return pipe.execute()[0]
+
+    def remove(self, user_id: int) -> Optional[str]:
+        pipe = self._redis.pipeline()
+        pipe.getdel(f'presence:{user_id}')
+        pipe.zrem('presence:expiry', str(user_id))
+        return pipe.execute()[0]
+
+    def get_many(self, user_ids: Iterable[int]) -> Dict[int, str]:
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        values = self._redis.mget([f'presence:{user_id}' for user_id in user_ids])
+        return {user_id: value for user_id, value in zip(user_ids, values) if value is not None}
+
+    def pop_expired(self, now: float) -> List[int]:
+        """Claim expired users with ZREM so only one instance writes each of them offline"""
+        candidates = self._redis.zrangebyscore('presence:expiry', '-inf', now, start=0, num=MAX_LOOKUP)
+        if not candidates:
+            return []
+        pipe = self._redis.pipeline()
+        for member in candidates:
+            pipe.zrem('presence:expiry', member)
+        return [int(member) for member, removed in zip(candidates, pipe.execute()) if removed]
+
+
+store = RedisStore(PRESENCE_REDIS_URL) if PRESENCE_REDIS_URL and redis is not None else LocalStore()
+
+_lock = threading.Lock()
+_pending: Dict[int, str] = {}
+_last_flush = 0.0
+
+
+def heartbeat(user_id: int, status: str = 'online') -> bool:
+    """Record a heartbeat; returns True when it changed the status and queued a write"""
+    if status == 'offline':
+        store.remove(user_id)
+        changed = True
+    else:
+        changed = store.touch(user_id, status, time.time() + PRESENCE_TTL) != status
+    if changed:
+        with _lock:
+            _pending[user_id] = status
+    return changed
+
+
+def lookup(user_ids: Iterable[int]) -> Dict[int, str]:
+    """Live statuses of the given users; users missing from the store are offline only if it is shared"""
+    return store.get_many(user_ids)
+
+
+def flush_due() -> bool:
+    return time.time() - _last_flush >= PRESENCE_FLUSH_INTERVAL
+
+
+def flush(cursor) -> int:
+    """Write queued status changes and TTL expiries in one statement; the caller commits"""
+    global _last_flush
+    now = time.time()
+    _last_flush = now
+    expired = store.pop_expired(now)
+    with _lock:
+        for user_id in expired:
+            _pending.setdefault(user_id, 'offline')
+        # Sorted so concurrent flushes from other instances lock rows in the same order
+        batch = sorted(_pending.items())
+        _pending.clear()
+    if not batch:
+        return 0
+    try:
+        execute_values(cursor, """
+            UPDATE users AS u SET status = v.status
+            FROM (VALUES %s) AS v(id, status)
+            WHERE u.id = v.id AND u.status IS DISTINCT FROM v.status
+        """, batch, template='(%s::int, %s::varchar)', page_size=len(batch))
+    except Exception:
+        # Keep the batch for the next flush unless newer heartbeats replaced it
+        with _lock:
+            for user_id, status in batch:
+                _pending.setdefault(user_id, status)
+        raise
+    return len(batch)
+
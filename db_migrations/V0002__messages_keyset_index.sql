@@ -0,0 +1,5 @@
+-- Составной индекс для keyset-пагинации истории канала по (created_at, id)
+CREATE INDEX IF NOT EXISTS idx_messages_channel_created ON messages(channel_id, created_at, id);
+
+-- Старый индекс по channel_id полностью покрывается новым
+DROP INDEX IF EXISTS idx_messages_channel_id;
@@ -0,0 +1,15 @@
+-- Колонки отправителя и получателя, которые использует backend/messages
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS sender_id INTEGER REFERENCES users(id);
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS recipient_id INTEGER REFERENCES users(id);
+
+-- Канонический ключ личного диалога: (меньший id, больший id).
+-- Генерируемые колонки заполняются для существующих строк при добавлении.
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS dm_low INTEGER
+    GENERATED ALWAYS AS (CASE WHEN recipient_id IS NOT NULL THEN LEAST(sender_id, recipient_id) END) STORED;
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS dm_high INTEGER
+    GENERATED ALWAYS AS (CASE WHEN recipient_id IS NOT NULL THEN GREATEST(sender_id, recipient_id) END) STORED;
+
+-- История диалога читается одним проходом по индексу
+CREATE INDEX IF NOT EXISTS idx_messages_dm_created ON messages(dm_low, dm_high, created_at, id)
+    WHERE dm_low IS NOT NULL;
+
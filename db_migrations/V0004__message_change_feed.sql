@@ -0,0 +1,19 @@
+-- Глобальный монотонный счётчик изменений сообщений для синхронизации
+CREATE SEQUENCE IF NOT EXISTS message_change_seq;
+
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS edited_at TIMESTAMP;
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS change_seq BIGINT NOT NULL DEFAULT nextval('message_change_seq');
+
+CREATE INDEX IF NOT EXISTS idx_messages_change_seq ON messages(change_seq);
+
+-- Надгробия удалённых сообщений, чтобы клиенты узнавали об удалениях через sync
+CREATE TABLE IF NOT EXISTS message_tombstones (
+    message_id INTEGER PRIMARY KEY,
+    channel_id INTEGER,
+    dm_low INTEGER,
+    dm_high INTEGER,
+    change_seq BIGINT NOT NULL DEFAULT nextval('message_change_seq'),
+    deleted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_message_tombstones_change_seq ON message_tombstones(change_seq);
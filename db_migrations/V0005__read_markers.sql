@@ -0,0 +1,17 @@
+-- Отметки о прочтении: последний прочитанный id в канале или личном диалоге
+CREATE TABLE IF NOT EXISTS read_markers (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    channel_id INTEGER REFERENCES channels(id),
+    peer_id INTEGER REFERENCES users(id),
+    last_read_message_id INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    CHECK ((channel_id IS NULL) <> (peer_id IS NULL))
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS ux_read_markers_channel ON read_markers(user_id, channel_id) WHERE channel_id IS NOT NULL;
+CREATE UNIQUE INDEX IF NOT EXISTS ux_read_markers_peer ON read_markers(user_id, peer_id) WHERE peer_id IS NOT NULL;
+
+-- Подсчёт непрочитанного идёт по id сообщения от отметки
+CREATE INDEX IF NOT EXISTS idx_messages_channel_id_id ON messages(channel_id, id);
+CREATE INDEX IF NOT EXISTS idx_messages_recipient_id ON messages(recipient_id, id) WHERE recipient_id IS NOT NULL;
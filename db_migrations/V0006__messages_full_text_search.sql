@@ -0,0 +1,7 @@
+-- Полнотекстовый поиск по сообщениям: русская и английская конфигурации
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_tsv tsvector
+    GENERATED ALWAYS AS (
+        to_tsvector('russian'::regconfig, content) || to_tsvector('english'::regconfig, content)
+    ) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_messages_search ON messages USING GIN (search_tsv);
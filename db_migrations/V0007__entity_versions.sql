@@ -0,0 +1,6 @@
+-- Счётчики версий списков (серверы пользователя, каналы сервера, друзья пользователя) для ETag
+CREATE TABLE IF NOT EXISTS entity_versions (
+    key VARCHAR(64) PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 1,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
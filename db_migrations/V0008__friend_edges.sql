@@ -0,0 +1,35 @@
+-- Симметричная дружба: по строке на каждое направление, список пользователя читается по user_id
+CREATE TABLE IF NOT EXISTS friend_edges (
+    user_id INTEGER NOT NULL REFERENCES users(id),
+    peer_id INTEGER NOT NULL REFERENCES users(id),
+    state VARCHAR(10) NOT NULL CHECK (state IN ('friends', 'incoming', 'outgoing')),
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, peer_id),
+    CHECK (user_id <> peer_id)
+);
+
+-- Постраничный список по статусу и общий список, новые сверху
+CREATE INDEX IF NOT EXISTS idx_friend_edges_state ON friend_edges(user_id, state, created_at DESC, peer_id DESC);
+CREATE INDEX IF NOT EXISTS idx_friend_edges_created ON friend_edges(user_id, created_at DESC, peer_id DESC);
+
+-- Перенос существующих связей из friendships: заявка даёт outgoing у отправителя и incoming у получателя,
+-- встречные записи одной пары сливаются (принятая побеждает, отправителем считается более ранняя)
+WITH pairs AS (
+    SELECT LEAST(user_id, friend_id) AS low,
+           GREATEST(user_id, friend_id) AS high,
+           bool_or(status = 'accepted') AS accepted,
+           (array_agg(user_id ORDER BY created_at, id))[1] AS requester,
+           COALESCE(min(created_at), CURRENT_TIMESTAMP) AS created_at
+    FROM friendships
+    WHERE user_id IS NOT NULL AND friend_id IS NOT NULL AND user_id <> friend_id
+    GROUP BY 1, 2
+)
+INSERT INTO friend_edges (user_id, peer_id, state, created_at)
+SELECT requester, low + high - requester,
+       CASE WHEN accepted THEN 'friends' ELSE 'outgoing' END, created_at
+FROM pairs
+UNION ALL
+SELECT low + high - requester, requester,
+       CASE WHEN accepted THEN 'friends' ELSE 'incoming' END, created_at
+FROM pairs
+ON CONFLICT (user_id, peer_id) DO NOTHING;
@@ -0,0 +1,25 @@
+-- Повторяющиеся пары (username, discriminator) получают свободный дискриминатор; первая по id пара сохраняется
+WITH dupes AS (
+    SELECT id, username, row_number() OVER (PARTITION BY username ORDER BY id) AS slot
+    FROM (
+        SELECT id, username, row_number() OVER (PARTITION BY username, discriminator ORDER BY id) AS rn
+        FROM users
+    ) ranked
+    WHERE rn > 1
+),
+free AS (
+    SELECT n.username, f.d, row_number() OVER (PARTITION BY n.username ORDER BY random()) AS slot
+    FROM (SELECT DISTINCT username FROM dupes) n
+    CROSS JOIN LATERAL (
+        SELECT to_char(g, 'FM0000') AS d FROM generate_series(0, 9999) g
+        EXCEPT
+        SELECT discriminator FROM users u WHERE u.username = n.username
+    ) f
+)
+UPDATE users u SET discriminator = free.d, updated_at = CURRENT_TIMESTAMP
+FROM dupes
+JOIN free ON free.username = dupes.username AND free.slot = dupes.slot
+WHERE u.id = dupes.id;
+
+-- Уникальность тега; индекс же обслуживает поиск свободного дискриминатора при регистрации
+CREATE UNIQUE INDEX IF NOT EXISTS ux_users_username_discriminator ON users(username, discriminator);
@@ -0,0 +1,91 @@
+-- Месячные секции messages_pYYYYMM по created_at: создаёт недостающие секции на интервал [from_ts, to_ts].
+-- Вызывается миграцией, инструментом tools/archive и обработчиком messages, если вставка не нашла секцию.
+CREATE OR REPLACE FUNCTION ensure_messages_partitions(
+    from_ts TIMESTAMP DEFAULT LOCALTIMESTAMP,
+    to_ts TIMESTAMP DEFAULT LOCALTIMESTAMP + INTERVAL '2 months'
+) RETURNS INTEGER LANGUAGE plpgsql AS $$
+DECLARE
+    month_start TIMESTAMP := date_trunc('month', from_ts);
+    part TEXT;
+    created INTEGER := 0;
+BEGIN
+    -- Параллельные вызовы не должны создавать одну и ту же секцию дважды
+    PERFORM pg_advisory_xact_lock(hashtext('ensure_messages_partitions'));
+    WHILE month_start <= to_ts LOOP
+        part := 'messages_p' || to_char(month_start, 'YYYYMM');
+        IF to_regclass(part) IS NULL THEN
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+                part, month_start, month_start + INTERVAL '1 month'
+            );
+            created := created + 1;
+        END IF;
+        month_start := month_start + INTERVAL '1 month';
+    END LOOP;
+    RETURN created;
+END $$;
+
+-- Перенос: старая таблица переименовывается, данные копируются в секционированную, старая удаляется.
+-- id сохраняются, последовательности messages_id_seq и message_change_seq продолжают работать.
+DO $$
+DECLARE
+    id_seq TEXT;
+    oldest TIMESTAMP;
+    con TEXT;
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_class WHERE relname = 'messages' AND relkind = 'p') THEN
+        RETURN;
+    END IF;
+
+    id_seq := pg_get_serial_sequence('messages', 'id');
+    EXECUTE format('ALTER SEQUENCE %s OWNED BY NONE', id_seq);
+    ALTER TABLE messages RENAME TO messages_unpartitioned;
+    -- Имена ограничений (messages_pkey, messages_*_fkey) освобождаются для новой таблицы
+    FOR con IN SELECT conname FROM pg_constraint WHERE conrelid = 'messages_unpartitioned'::regclass LOOP
+        EXECUTE format('ALTER TABLE messages_unpartitioned RENAME CONSTRAINT %I TO %I', con, 'old_' || con);
+    END LOOP;
+
+    EXECUTE format($sql$
+        CREATE TABLE messages (
+            id INTEGER NOT NULL DEFAULT nextval(%L::regclass),
+            channel_id INTEGER REFERENCES channels(id),
+            user_id INTEGER REFERENCES users(id),
+            content TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            sender_id INTEGER REFERENCES users(id),
+            recipient_id INTEGER REFERENCES users(id),
+            dm_low INTEGER
+                GENERATED ALWAYS AS (CASE WHEN recipient_id IS NOT NULL THEN LEAST(sender_id, recipient_id) END) STORED,
+            dm_high INTEGER
+                GENERATED ALWAYS AS (CASE WHEN recipient_id IS NOT NULL THEN GREATEST(sender_id, recipient_id) END) STORED,
+            edited_at TIMESTAMP,
+            change_seq BIGINT NOT NULL DEFAULT nextval('message_change_seq'),
+            search_tsv tsvector
+                GENERATED ALWAYS AS (
+                    to_tsvector('russian'::regconfig, content) || to_tsvector('english'::regconfig, content)
+                ) STORED,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+    $sql$, id_seq);
+
+    SELECT min(created_at) INTO oldest FROM messages_unpartitioned;
+    PERFORM ensure_messages_partitions(COALESCE(oldest, LOCALTIMESTAMP), LOCALTIMESTAMP + INTERVAL '2 months');
+
+    INSERT INTO messages (id, channel_id, user_id, content, created_at, sender_id, recipient_id, edited_at, change_seq)
+    SELECT id, channel_id, user_id, content, COALESCE(created_at, LOCALTIMESTAMP), sender_id, recipient_id, edited_at, change_seq
+    FROM messages_unpartitioned;
+
+    DROP TABLE messages_unpartitioned;
+    EXECUTE format('ALTER SEQUENCE %s OWNED BY messages.id', id_seq);
+END $$;
+
+-- Индексы создаются на родительской таблице и наследуются каждой секцией
+CREATE INDEX IF NOT EXISTS idx_messages_channel_created ON messages(channel_id, created_at, id);
+CREATE INDEX IF NOT EXISTS idx_messages_dm_created ON messages(dm_low, dm_high, created_at, id)
+    WHERE dm_low IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_messages_change_seq ON messages(change_seq);
+CREATE INDEX IF NOT EXISTS idx_messages_channel_id_id ON messages(channel_id, id);
+CREATE INDEX IF NOT EXISTS idx_messages_recipient_id ON messages(recipient_id, id) WHERE recipient_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_messages_search ON messages USING GIN (search_tsv);
+
+ANALYZE messages;
@@ -0,0 +1,19 @@
+-- Версия профиля: растёт при каждом изменении полей, которые показываются рядом с сообщениями.
+-- По ней кэш профилей в функции messages понимает, что запись устарела.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS profile_version BIGINT NOT NULL DEFAULT 1;
+
+CREATE OR REPLACE FUNCTION bump_profile_version() RETURNS TRIGGER LANGUAGE plpgsql AS $$
+BEGIN
+    NEW.profile_version := OLD.profile_version + 1;
+    RETURN NEW;
+END $$;
+
+-- Статус присутствия и прочие поля версию не меняют: они в истории сообщений не отображаются
+DROP TRIGGER IF EXISTS trg_users_profile_version ON users;
+CREATE TRIGGER trg_users_profile_version
+    BEFORE UPDATE OF username, discriminator, avatar_url ON users
+    FOR EACH ROW
+    WHEN (OLD.username IS DISTINCT FROM NEW.username
+          OR OLD.discriminator IS DISTINCT FROM NEW.discriminator
+          OR OLD.avatar_url IS DISTINCT FROM NEW.avatar_url)
+    EXECUTE FUNCTION bump_profile_version();
@@ -0,0 +1,17 @@
+-- Разреженные ключи порядка каналов: новый канал получает max + 1024, перенос — середину между соседями,
+-- так что вставка и перемещение меняют одну строку. NUMERIC не исчерпывает точность при делении пополам.
+ALTER TABLE channels ALTER COLUMN position DROP DEFAULT;
+ALTER TABLE channels ALTER COLUMN position TYPE NUMERIC USING position::numeric;
+
+-- Перенумерация: прежний порядок (position, created_at) сохраняется, дубли после удалений исчезают
+UPDATE channels c SET position = r.rn * 1024
+FROM (
+    SELECT id, row_number() OVER (PARTITION BY server_id ORDER BY position NULLS LAST, created_at, id) AS rn
+    FROM channels
+) r
+WHERE c.id = r.id AND c.position IS DISTINCT FROM r.rn * 1024;
+
+ALTER TABLE channels ALTER COLUMN position SET NOT NULL;
+
+-- Список каналов сервера и max(position) при добавлении читаются упорядоченным сканированием индекса
+CREATE INDEX IF NOT EXISTS idx_channels_server_position ON channels(server_id, position);
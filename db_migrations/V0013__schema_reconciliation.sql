@@ -0,0 +1,30 @@
+-- Сверка схемы с запросами обработчиков (проверяется tools/plancheck).
+-- Столбцы могли быть добавлены вручную на части баз, поэтому всё через IF NOT EXISTS.
+
+-- Роль участника: createServer записывает 'owner', остальные участники — 'member'
+ALTER TABLE server_members ADD COLUMN IF NOT EXISTS role VARCHAR(20);
+ALTER TABLE server_members ALTER COLUMN role SET DEFAULT 'member';
+UPDATE server_members sm
+SET role = CASE WHEN EXISTS (SELECT 1 FROM servers s WHERE s.id = sm.server_id AND s.owner_id = sm.user_id)
+                THEN 'owner' ELSE 'member' END
+WHERE sm.role IS NULL;
+ALTER TABLE server_members ALTER COLUMN role SET NOT NULL;
+
+-- Иконка и описание канала отдаются в списке каналов и в bootstrap
+ALTER TABLE channels ADD COLUMN IF NOT EXISTS icon_url TEXT;
+ALTER TABLE channels ADD COLUMN IF NOT EXISTS description TEXT;
+
+-- Сообщения из первой схемы хранили автора в user_id; обработчики читают sender_id
+UPDATE messages SET sender_id = user_id WHERE sender_id IS NULL AND user_id IS NOT NULL;
+
+-- Серверы пользователя: уникальный индекс (server_id, user_id) не подходит для поиска по user_id
+CREATE INDEX IF NOT EXISTS idx_server_members_user ON server_members(user_id, server_id);
+
+-- Индексы под внешние ключи: без них удаление пользователя или сервера сканирует дочерние таблицы целиком
+CREATE INDEX IF NOT EXISTS idx_friendships_friend ON friendships(friend_id);
+CREATE INDEX IF NOT EXISTS idx_friend_edges_peer ON friend_edges(peer_id);
+CREATE INDEX IF NOT EXISTS idx_servers_owner ON servers(owner_id);
+CREATE INDEX IF NOT EXISTS idx_read_markers_channel ON read_markers(channel_id) WHERE channel_id IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_read_markers_peer ON read_markers(peer_id) WHERE peer_id IS NOT NULL;
+-- Сообщения автора по времени: внешний ключ sender_id и выборки по отправителю за интервал
+CREATE INDEX IF NOT EXISTS idx_messages_sender_created ON messages(sender_id, created_at);
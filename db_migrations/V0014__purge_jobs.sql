@@ -0,0 +1,28 @@
+-- Массовое удаление сообщений модератором: очистка канала или сообщений автора за интервал.
+-- Удаление идёт пакетами от старых к новым с фиксацией после каждого; счётчик и позиция последней
+-- просмотренной строки обновляются в той же транзакции, поэтому прерванное задание продолжается
+-- с того же места (tools/purge или action resumePurge), не проходя заново по уже удалённым строкам.
+CREATE TABLE IF NOT EXISTS purge_jobs (
+    id SERIAL PRIMARY KEY,
+    server_id INTEGER NOT NULL REFERENCES servers(id) ON DELETE CASCADE,
+    -- NULL: все каналы сервера (только вместе с sender_id)
+    channel_id INTEGER REFERENCES channels(id) ON DELETE CASCADE,
+    sender_id INTEGER REFERENCES users(id),
+    from_ts TIMESTAMP,
+    to_ts TIMESTAMP,
+    requested_by INTEGER NOT NULL REFERENCES users(id),
+    state VARCHAR(10) NOT NULL DEFAULT 'pending' CHECK (state IN ('pending', 'running', 'done', 'failed')),
+    deleted BIGINT NOT NULL DEFAULT 0,
+    batches INTEGER NOT NULL DEFAULT 0,
+    last_created_at TIMESTAMP,
+    last_id INTEGER,
+    error TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP,
+    CHECK (channel_id IS NOT NULL OR sender_id IS NOT NULL)
+);
+
+-- Очередь фонового обработчика: незавершённые задания по порядку создания
+CREATE INDEX IF NOT EXISTS idx_purge_jobs_unfinished ON purge_jobs(id) WHERE state IN ('pending', 'running');
+CREATE INDEX IF NOT EXISTS idx_purge_jobs_server ON purge_jobs(server_id);
@@ -0,0 +1,12 @@
+-- Курсор sync: change_seq выдаётся при записи, а не при фиксации, поэтому транзакция с меньшим номером
+-- может зафиксироваться позже и оказаться позади курсора клиента. Теперь курсор — позиция
+-- (change_xid, change_seq), и sync отдаёт только изменения транзакций младше pg_snapshot_xmin:
+-- все они уже завершены, а любая ещё не зафиксированная транзакция имеет xid не меньше.
+-- Константа по умолчанию не переписывает таблицы; старые строки получают xid 0 и идут первыми.
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS change_xid xid8 NOT NULL DEFAULT '0';
+ALTER TABLE messages ALTER COLUMN change_xid SET DEFAULT pg_current_xact_id();
+ALTER TABLE message_tombstones ADD COLUMN IF NOT EXISTS change_xid xid8 NOT NULL DEFAULT '0';
+ALTER TABLE message_tombstones ALTER COLUMN change_xid SET DEFAULT pg_current_xact_id();
+
+CREATE INDEX IF NOT EXISTS idx_messages_change_xid ON messages(change_xid, change_seq);
+CREATE INDEX IF NOT EXISTS idx_message_tombstones_change_xid ON message_tombstones(change_xid, change_seq);
@@ -0,0 +1,6 @@
+-- Верхняя граница задания очистки: без to_ts задание удаляло и сообщения, отправленные после его
+-- запуска, если оно продолжалось позже (resumePurge, tools/purge). Теперь граница фиксируется при
+-- создании — не позже момента запуска — и применяется всегда; старым заданиям ставится время создания.
+UPDATE purge_jobs SET to_ts = created_at WHERE to_ts IS NULL OR to_ts > created_at;
+ALTER TABLE purge_jobs ALTER COLUMN to_ts SET DEFAULT LOCALTIMESTAMP;
+ALTER TABLE purge_jobs ALTER COLUMN to_ts SET NOT NULL;
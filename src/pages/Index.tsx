@@ -25,7 +25,6 @@ interface Friend {
   username: string;
   discriminator: string;
   avatarUrl?: string;
-  status: string;
   friendStatus: string;
 }
 
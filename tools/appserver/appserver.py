@@ -0,0 +1,297 @@
+'''
+Self-hosted HTTP server that runs the auth, friends, messages and servers handlers in
+one process per worker, for deployments outside the cloud-function platform.
+
+Every function is mounted under the path of its URL in backend/func2url.json and under
+/<name>, so clients only swap the host. An asyncio loop parses HTTP/1.1 (keep-alive,
+Content-Length bodies) and builds the same event dict the platform passes; the handler
+runs unchanged on a bounded thread pool, since it does blocking psycopg2 work. Requests
+beyond --max-pending get 503 with Retry-After instead of queueing without bound.
+Each handler keeps its own module-level connection pool, sized to --threads.
+
+--workers N forks N processes that share the port through SO_REUSEPORT; the parent
+restarts a worker that dies and stops them all on SIGTERM/SIGINT. GET /healthz returns
+the worker's counters.
+
+Usage:
+    DATABASE_URL=... AUTH_TOKEN_KEYS=... python tools/appserver/appserver.py --port 8080 --workers 4 --threads 16
+'''
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import signal
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from typing import Dict, Any, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'bench'))
+# common turns admission control off for benchmarks; a server keeps it on unless told otherwise
+os.environ.setdefault('ADMISSION_ENABLED', '1')
+from common import BACKEND_DIR, load_handler  # noqa: E402
+
+FUNCTIONS = ['auth', 'friends', 'messages', 'servers']
+MAX_HEADERS = 100
+
+
+class Context:
+    """The attributes handlers read from the platform's context object"""
+
+    def __init__(self, function_name: str):
+        self.request_id = uuid.uuid4().hex
+        self.function_name = function_name
+
+
+class BadRequest(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def load_routes(functions: List[str]) -> Dict[str, str]:
+    """First path segment -> function name, from func2url.json plus /<name>"""
+    with open(os.path.join(BACKEND_DIR, 'func2url.json'), encoding='utf-8') as f:
+        urls = json.load(f)
+    routes = {}
+    for name in functions:
+        routes[name] = name
+        if name in urls:
+            routes[urlsplit(urls[name]).path.strip('/').split('/')[0]] = name
+    return routes
+
+
+def header_name(raw: str) -> str:
+    """Canonical casing (x-user-id -> X-User-Id), which is how the handlers look headers up"""
+    return '-'.join(part.capitalize() for part in raw.strip().split('-'))
+
+
+class AppServer:
+    def __init__(self, functions: List[str], threads: int, max_pending: int, max_body: int):
+        self.routes = load_routes(functions)
+        self.handlers = {name: load_handler(name).handler for name in functions}
+        self.threads = threads
+        self.max_pending = max_pending
+        self.max_body = max_body
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.pending = 0
+        self.stats: Dict[str, Any] = {'requests': 0, 'rejected': 0, 'errors': 0, 'connections': 0, 'statuses': {}}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.stats['connections'] += 1
+        peer = writer.get_extra_info('peername')
+        source_ip = peer[0] if peer else None
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader)
+                except BadRequest as exc:
+                    await self.respond(writer, exc.status, {'Content-Type': 'application/json'},
+                                       json.dumps({'error': str(exc)}).encode(), False)
+                    return
+                if request is None:
+                    return
+                method, target, headers, body, keep_alive = request
+                status, out_headers, payload = await self.dispatch(method, target, headers, body, source_ip)
+                await self.respond(writer, status, out_headers, payload, keep_alive)
+                if not keep_alive:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.stats['connections'] -= 1
+            writer.close()
+
+    async def read_request(self, reader: asyncio.StreamReader) -> Optional[Tuple]:
+        line = await reader.readline()
+        if not line:
+            return None
+        parts = line.decode('latin-1').split()
+        if len(parts) != 3 or not parts[2].startswith('HTTP/1.'):
+            raise BadRequest(400, 'Malformed request line')
+        method, target, version = parts
+
+        headers: Dict[str, str] = {}
+        while True:
+            raw = await reader.readline()
+            if raw in (b'\r\n', b'\n', b''):
+                break
+            if len(headers) >= MAX_HEADERS:
+                raise BadRequest(431, 'Too many headers')
+            name, sep, value = raw.decode('latin-1').partition(':')
+            if not sep:
+                raise BadRequest(400, 'Malformed header')
+            headers[header_name(name)] = value.strip()
+
+        if 'chunked' in headers.get('Transfer-Encoding', '').lower():
+            raise BadRequest(411, 'Content-Length required')
+        try:
+            length = int(headers.get('Content-Length', '0'))
+        except ValueError:
+            raise BadRequest(400, 'Invalid Content-Length')
+        if length > self.max_body:
+            raise BadRequest(413, 'Request body too large')
+        body = await reader.readexactly(length) if length else b''
+
+        connection = headers.get('Connection', '').lower()
+        keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+        return method, target, headers, body, keep_alive
+
+    async def dispatch(self, method: str, target: str, headers: Dict[str, str], body: bytes,
+                       source_ip: Optional[str]) -> Tuple[int, Dict[str, str], bytes]:
+        url = urlsplit(target)
+        segment = url.path.strip('/').split('/')[0]
+        if segment == 'healthz':
+            return 200, {'Content-Type': 'application/json'}, json.dumps(dict(self.stats, pid=os.getpid(), pending=self.pending)).encode()
+        name = self.routes.get(segment)
+        if name is None:
+            return 404, {'Content-Type': 'application/json'}, b'{"error":"Not found"}'
+        if self.pending >= self.max_pending:
+            self.stats['rejected'] += 1
+            return 503, {'Content-Type': 'application/json', 'Retry-After': '1'}, b'{"error":"Server busy"}'
+
+        try:
+            text, encoded = body.decode('utf-8'), False
+        except UnicodeDecodeError:
+            text, encoded = base64.b64encode(body).decode(), True
+        event = {
+            'httpMethod': method,
+            'path': url.path,
+            'headers': headers,
+            'queryStringParameters': dict(parse_qsl(url.query, keep_blank_values=True)),
+            'body': text,
+            'isBase64Encoded': encoded,
+            'requestContext': {'identity': {'sourceIp': source_ip}}
+        }
+
+        self.pending += 1
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.handlers[name], event, Context(name)
+            )
+        except Exception as exc:
+            self.stats['errors'] += 1
+            print(json.dumps({'event': 'appserver_handler_error', 'function': name, 'error': repr(exc)}), flush=True)
+            return 500, {'Content-Type': 'application/json'}, b'{"error":"Internal server error"}'
+        finally:
+            self.pending -= 1
+
+        status = int(result.get('statusCode', 200))
+        self.stats['requests'] += 1
+        self.stats['statuses'][str(status)] = self.stats['statuses'].get(str(status), 0) + 1
+        payload = result.get('body') or ''
+        payload = base64.b64decode(payload) if result.get('isBase64Encoded') else payload.encode()
+        return status, dict(result.get('headers') or {}), payload
+
+    async def respond(self, writer: asyncio.StreamWriter, status: int, headers: Dict[str, str],
+                      payload: bytes, keep_alive: bool) -> None:
+        try:
+            reason = HTTPStatus(status).phrase
+        except ValueError:
+            reason = ''
+        headers['Content-Length'] = str(len(payload))
+        headers['Connection'] = 'keep-alive' if keep_alive else 'close'
+        head = f'HTTP/1.1 {status} {reason}\r\n' + ''.join(f'{k}: {v}\r\n' for k, v in headers.items()) + '\r\n'
+        writer.write(head.encode('latin-1') + payload)
+        await writer.drain()
+
+    async def report(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            print(json.dumps({'event': 'appserver_stats', 'pid': os.getpid(), 'ts': time.time(),
+                              'pending': self.pending, **self.stats}), flush=True)
+
+
+async def serve(app: AppServer, host: str, port: int, stats_interval: float) -> None:
+    app.executor = ThreadPoolExecutor(max_workers=app.threads, thread_name_prefix='handler')
+    server = await asyncio.start_server(app.handle, host, port, backlog=4096, reuse_port=True)
+    tasks = [asyncio.create_task(app.report(stats_interval))] if stats_interval else []
+    stop = asyncio.get_running_loop().create_future()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(sig, lambda: stop.done() or stop.set_result(None))
+    async with server:
+        await stop
+    for task in tasks:
+        task.cancel()
+    app.executor.shutdown(wait=True)
+
+
+def run_worker(app: AppServer, args) -> None:
+    asyncio.run(serve(app, args.host, args.port, args.stats_interval))
+
+
+def supervise(app: AppServer, args) -> None:
+    """Fork the workers after the handlers are imported; connection pools open lazily in each child"""
+    children: Dict[int, int] = {}
+    stopping = False
+
+    def spawn(slot: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            try:
+                run_worker(app, args)
+            finally:
+                os._exit(0)
+        children[pid] = slot
+
+    def stop(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for slot in range(args.workers):
+        spawn(slot)
+    print(json.dumps({'event': 'appserver_started', 'port': args.port, 'workers': args.workers,
+                      'threads': args.threads, 'routes': app.routes}), flush=True)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        slot = children.pop(pid, None)
+        if slot is not None and not stopping:
+            print(json.dumps({'event': 'appserver_worker_exit', 'pid': pid, 'status': status}), flush=True)
+            time.sleep(0.5)
+            spawn(slot)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=1, help='processes sharing the port')
+    parser.add_argument('--threads', type=int, default=16, help='handler threads per worker')
+    parser.add_argument('--max-pending', type=int, help='requests in flight per worker before 503 (default 8 x threads)')
+    parser.add_argument('--max-body', type=int, default=10 * 1024 * 1024)
+    parser.add_argument('--functions', default=','.join(FUNCTIONS), help='comma-separated functions to mount')
+    parser.add_argument('--stats-interval', type=float, default=60.0, help='seconds between stats lines, 0 for none')
+    args = parser.parse_args()
+
+    # Every handler thread may hold one connection of the function it is running
+    os.environ.setdefault('DB_POOL_MAX_SIZE', str(args.threads))
+    functions = [name.strip() for name in args.functions.split(',') if name.strip()]
+    app = AppServer(functions, args.threads, args.max_pending or args.threads * 8, args.max_body)
+    if args.workers > 1:
+        supervise(app, args)
+    else:
+        run_worker(app, args)
+
+
+if __name__ == '__main__':
+    main()
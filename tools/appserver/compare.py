@@ -0,0 +1,235 @@
+'''
+Throughput of the handlers under three hosting models, driven by the same request mix.
+
+    invocation    a fresh process per request: import, connect, handle one event, exit
+                  (what every cold start of the per-invocation model pays)
+    per-function  one single-threaded process per function, requests handled one at a
+                  time with blocking psycopg2 (the current on-prem layout)
+    appserver     tools/appserver/appserver.py with --workers and --threads
+
+Requests are the tests.json entries of every function filled from the seed.py fixture,
+weighted like tools/bench/run_handlers.py. Admission control is off in the servers
+under test unless --admission is given, since the fixture users would hit its limits.
+
+Usage:
+    DATABASE_URL=... python tools/bench/seed.py --fixture bench_fixture.json
+    DATABASE_URL=... python tools/appserver/compare.py --fixture bench_fixture.json \
+        --concurrency 32 --duration 20 --workers 4 --threads 16 --out results/appserver.json
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, Any, List, Optional
+from urllib.parse import urlencode
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'bench'))
+from common import percentiles  # noqa: E402
+from run_handlers import FUNCTIONS, build_event, load_scenarios  # noqa: E402
+
+import appserver  # noqa: E402
+
+
+class Load:
+    """Pre-built requests and the results collected while replaying them"""
+
+    def __init__(self, scenarios: List, users: List[Dict[str, Any]]):
+        self.scenarios = scenarios
+        self.weights = [s[2] for s in scenarios]
+        self.users = users
+        self.latencies: List[float] = []
+        self.statuses: Dict[str, int] = {}
+
+    def next(self, rng: random.Random):
+        key, test, _ = rng.choices(self.scenarios, weights=self.weights)[0]
+        return key.split(':', 1)[0], build_event(test, rng.choice(self.users), self.users)
+
+    def record(self, started: float, status: Any) -> None:
+        self.latencies.append((time.perf_counter() - started) * 1000)
+        self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+
+    def report(self, elapsed: float) -> Dict[str, Any]:
+        return {
+            'requests': len(self.latencies),
+            'seconds': round(elapsed, 2),
+            'throughput': round(len(self.latencies) / elapsed, 1),
+            'latencyMs': percentiles(self.latencies),
+            'statuses': self.statuses
+        }
+
+
+def encode_request(name: str, event: Dict[str, Any]) -> bytes:
+    query = urlencode(event.get('queryStringParameters') or {})
+    body = (event.get('body') or '').encode() if event['httpMethod'] != 'GET' else b''
+    headers = dict(event.get('headers') or {}, Host='localhost', **{'Content-Length': str(len(body))})
+    if body:
+        headers.setdefault('Content-Type', 'application/json')
+    head = f"{event['httpMethod']} /{name}{'?' + query if query else ''} HTTP/1.1\r\n"
+    head += ''.join(f'{k}: {v}\r\n' for k, v in headers.items()) + '\r\n'
+    return head.encode() + body
+
+
+async def read_response(reader: asyncio.StreamReader) -> int:
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+    await reader.readexactly(length)
+    return status
+
+
+async def http_client(load: Load, ports: Dict[str, int], deadline: float, seed: int) -> None:
+    rng = random.Random(seed)
+    connections: Dict[int, Any] = {}
+    try:
+        while time.monotonic() < deadline:
+            name, event = load.next(rng)
+            port = ports[name]
+            if port not in connections:
+                connections[port] = await asyncio.open_connection('127.0.0.1', port)
+            reader, writer = connections[port]
+            started = time.perf_counter()
+            try:
+                writer.write(encode_request(name, event))
+                await writer.drain()
+                load.record(started, await read_response(reader))
+            except (ConnectionError, asyncio.IncompleteReadError, IndexError, ValueError) as exc:
+                load.record(started, type(exc).__name__)
+                writer.close()
+                del connections[port]
+    finally:
+        for _, writer in connections.values():
+            writer.close()
+
+
+async def invocation_client(load: Load, deadline: float, seed: int) -> None:
+    rng = random.Random(seed)
+    while time.monotonic() < deadline:
+        name, event = load.next(rng)
+        started = time.perf_counter()
+        child = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), '--invoke', name,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE
+        )
+        out, _ = await child.communicate(json.dumps(event).encode())
+        load.record(started, out.decode().strip() or f'exit {child.returncode}')
+
+
+async def drive(load: Load, concurrency: int, duration: float, ports: Optional[Dict[str, int]]) -> float:
+    deadline = time.monotonic() + duration
+    started = time.monotonic()
+    if ports is None:
+        clients = [invocation_client(load, deadline, i) for i in range(concurrency)]
+    else:
+        clients = [http_client(load, ports, deadline, i) for i in range(concurrency)]
+    await asyncio.gather(*clients)
+    return time.monotonic() - started
+
+
+def start_servers(commands: List[List[str]], ports: List[int], env: Dict[str, str]) -> List[subprocess.Popen]:
+    servers = [subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL) for command in commands]
+    deadline = time.monotonic() + 30
+    for port in ports:
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f'server on port {port} did not start')
+                time.sleep(0.1)
+    return servers
+
+
+def run_mode(mode: str, args, load: Load) -> Dict[str, Any]:
+    env = dict(os.environ, REQUEST_LOG='0', ADMISSION_ENABLED='1' if args.admission else '0')
+    script = os.path.join(HERE, 'appserver.py')
+    servers: List[subprocess.Popen] = []
+    ports: Optional[Dict[str, int]] = None
+    if mode == 'per-function':
+        ports = {name: args.port + i for i, name in enumerate(FUNCTIONS)}
+        servers = start_servers([
+            [sys.executable, script, '--port', str(port), '--functions', name,
+             '--threads', '1', '--max-pending', str(args.concurrency * 2), '--stats-interval', '0']
+            for name, port in ports.items()
+        ], list(ports.values()), env)
+    elif mode == 'appserver':
+        ports = {name: args.port for name in FUNCTIONS}
+        servers = start_servers([[
+            sys.executable, script, '--port', str(args.port), '--workers', str(args.workers),
+            '--threads', str(args.threads), '--max-pending', str(args.concurrency * 2), '--stats-interval', '0'
+        ]], [args.port], env)
+    else:
+        os.environ.update(env)
+    try:
+        elapsed = asyncio.run(drive(load, args.concurrency, args.duration, ports))
+    finally:
+        for server in servers:
+            server.terminate()
+        for server in servers:
+            server.wait()
+    result = load.report(elapsed)
+    if mode == 'appserver':
+        result['config'] = {'workers': args.workers, 'threads': args.threads}
+    return result
+
+
+def invoke(name: str) -> None:
+    """Child of the invocation model: handle the event on stdin and print the status"""
+    event = json.loads(sys.stdin.read())
+    print(appserver.load_handler(name).handler(event, appserver.Context(name))['statusCode'])
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fixture', default='bench_fixture.json')
+    parser.add_argument('--modes', default='invocation,per-function,appserver')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds per mode')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--weight', action='append', default=[], help='"function:test name=weight" or "function=weight"')
+    parser.add_argument('--admission', action='store_true', help='keep admission control on in the servers')
+    parser.add_argument('--out', help='write the JSON report here')
+    parser.add_argument('--invoke', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.invoke:
+        invoke(args.invoke)
+        return
+
+    with open(args.fixture, encoding='utf-8') as f:
+        users = json.load(f)['users']
+    weights = {}
+    for spec in args.weight:
+        key, value = spec.rsplit('=', 1)
+        weights[key] = float(value)
+    scenarios = load_scenarios(weights)
+
+    report = {'concurrency': args.concurrency, 'weights': weights, 'modes': {}}
+    for mode in args.modes.split(','):
+        report['modes'][mode] = run_mode(mode, args, Load(scenarios, users))
+        print(json.dumps({mode: report['modes'][mode]}), flush=True)
+
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
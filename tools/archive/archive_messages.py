@@ -0,0 +1,243 @@
+'''
+Maintenance for the monthly messages partitions: create upcoming ones and move
+old ones into the compressed local archive that backend/messages reads.
+
+    ensure   create partitions for the current month and --months-ahead more
+    list     show attached partitions and what is already archived
+    archive  export every attached partition that ends on or before --before,
+             then detach and drop it (oldest first, so the archive stays contiguous)
+
+Archive layout (see backend/messages/archive.py): <partition>.ndjson.gz is a
+sequence of gzip members, one per conversation, rows oldest first;
+<partition>.json maps each conversation key to [offset, length, rows]; catalog.json
+lists archived partitions and hotFrom. The catalog is updated before the partition
+is detached, so reads never see a gap. If rows changed between export and detach,
+the export is redone from the detached table, which no longer takes writes.
+
+Usage:
+    DATABASE_URL=... python tools/archive/archive_messages.py ensure --months-ahead 3
+    DATABASE_URL=... MESSAGES_ARCHIVE_DIR=/var/lib/incordes/archive \
+        python tools/archive/archive_messages.py archive --before 2026-01
+'''
+
+import argparse
+import gzip
+import json
+import os
+import re
+import sys
+import time
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+
+import psycopg2
+
+# Layout constants and conversation keys come from the reader the messages function uses
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'backend', 'messages'))
+import archive  # noqa: E402
+
+BOUND_RE = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+FETCH_SIZE = 20_000
+
+
+def connect():
+    return psycopg2.connect(os.environ['DATABASE_URL'])
+
+
+def attached_partitions(conn) -> List[Dict[str, Any]]:
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid), c.reltuples::bigint, pg_total_relation_size(c.oid)
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'messages'::regclass
+    """)
+    partitions = []
+    for name, bound, estimate, size in cursor.fetchall():
+        match = BOUND_RE.search(bound or '')
+        if not match:
+            continue
+        partitions.append({
+            'name': name,
+            'from': datetime.fromisoformat(match.group(1)),
+            'to': datetime.fromisoformat(match.group(2)),
+            'estimatedRows': max(estimate, 0),
+            'bytes': size
+        })
+    conn.rollback()
+    return sorted(partitions, key=lambda p: p['from'])
+
+
+def load_catalog(directory: str) -> Dict[str, Any]:
+    path = os.path.join(directory, archive.CATALOG_FILE)
+    if not os.path.exists(path):
+        return {'version': 1, 'hotFrom': None, 'partitions': []}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_json(path: str, value: Any) -> None:
+    """Write through a temp file and rename, so readers never see half a file"""
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(value, f, ensure_ascii=False, separators=(',', ':'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def export(conn, table: str, directory: str, name: str) -> Dict[str, Any]:
+    """Write one partition as per-conversation gzip members plus its manifest"""
+    data_path = os.path.join(directory, f'{name}.ndjson.gz')
+    cursor = conn.cursor(name=f'export_{name}')
+    cursor.itersize = FETCH_SIZE
+    cursor.execute(f"""
+        SELECT id, created_at, sender_id, content, edited_at, channel_id, dm_low, dm_high, change_seq
+        FROM {table}
+        WHERE channel_id IS NOT NULL OR dm_low IS NOT NULL
+        ORDER BY channel_id NULLS LAST, dm_low, dm_high, created_at, id
+    """)
+
+    members: Dict[str, List[int]] = {}
+    rows = 0
+    max_seq = 0
+    with open(data_path + '.tmp', 'wb') as out:
+        key: Optional[str] = None
+        lines: List[bytes] = []
+
+        def flush_member() -> None:
+            if key is None or not lines:
+                return
+            packed = gzip.compress(b''.join(lines), compresslevel=6)
+            members[key] = [out.tell(), len(packed), len(lines)]
+            out.write(packed)
+
+        for message_id, created_at, sender_id, content, edited_at, channel_id, dm_low, dm_high, change_seq in cursor:
+            row_key = archive.conversation_key(channel_id, dm_low, dm_high)
+            if row_key != key:
+                flush_member()
+                key, lines = row_key, []
+            lines.append(json.dumps(
+                [message_id, created_at.isoformat(), sender_id, content, edited_at.isoformat() if edited_at else None],
+                ensure_ascii=False, separators=(',', ':')
+            ).encode() + b'\n')
+            rows += 1
+            max_seq = max(max_seq, change_seq)
+        flush_member()
+        out.flush()
+        os.fsync(out.fileno())
+    cursor.close()
+    conn.commit()
+
+    os.replace(data_path + '.tmp', data_path)
+    write_json(os.path.join(directory, f'{name}.json'), {'partition': name, 'rows': rows, 'members': members})
+    return {'rows': rows, 'maxSeq': max_seq, 'bytes': os.path.getsize(data_path), 'conversations': len(members)}
+
+
+def table_fingerprint(conn, table: str) -> Tuple[int, int]:
+    cursor = conn.cursor()
+    cursor.execute(f"""
+        SELECT count(*), COALESCE(max(change_seq), 0) FROM {table}
+        WHERE channel_id IS NOT NULL OR dm_low IS NOT NULL
+    """)
+    result = cursor.fetchone()
+    conn.commit()
+    return result
+
+
+def record_in_catalog(directory: str, partition: Dict[str, Any], exported: Dict[str, Any]) -> None:
+    """Add or replace the partition's catalog entry with the figures of its latest export"""
+    catalog = load_catalog(directory)
+    catalog['partitions'] = [p for p in catalog['partitions'] if p['name'] != partition['name']] + [{
+        'name': partition['name'],
+        'from': partition['from'].isoformat(),
+        'to': partition['to'].isoformat(),
+        'rows': exported['rows'],
+        'bytes': exported['bytes'],
+        'archivedAt': datetime.now().isoformat(timespec='seconds')
+    }]
+    catalog['partitions'].sort(key=lambda p: p['from'])
+    catalog['hotFrom'] = max(p['to'] for p in catalog['partitions'])
+    write_json(os.path.join(directory, archive.CATALOG_FILE), catalog)
+
+
+def archive_partition(conn, partition: Dict[str, Any], directory: str, keep_detached: bool) -> Dict[str, Any]:
+    name = partition['name']
+    started = time.perf_counter()
+    exported = export(conn, name, directory, name)
+
+    record_in_catalog(directory, partition, exported)
+
+    conn.autocommit = True
+    try:
+        conn.cursor().execute(f'ALTER TABLE messages DETACH PARTITION {name} CONCURRENTLY')
+    finally:
+        conn.autocommit = False
+
+    reexported = False
+    if table_fingerprint(conn, name) != (exported['rows'], exported['maxSeq']):
+        exported = export(conn, name, directory, name)
+        record_in_catalog(directory, partition, exported)
+        reexported = True
+
+    if not keep_detached:
+        conn.cursor().execute(f'DROP TABLE {name}')
+        conn.commit()
+
+    return {
+        'partition': name,
+        'rows': exported['rows'],
+        'conversations': exported['conversations'],
+        'archiveBytes': exported['bytes'],
+        'tableBytes': partition['bytes'],
+        'reexported': reexported,
+        'dropped': not keep_detached,
+        'seconds': round(time.perf_counter() - started, 2)
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest='command', required=True)
+    ensure = sub.add_parser('ensure')
+    ensure.add_argument('--months-ahead', type=int, default=2)
+    listing = sub.add_parser('list')
+    listing.add_argument('--dir', default=os.environ.get('MESSAGES_ARCHIVE_DIR'))
+    run = sub.add_parser('archive')
+    run.add_argument('--before', required=True, help='YYYY-MM; partitions ending on or before this month start are archived')
+    run.add_argument('--dir', default=os.environ.get('MESSAGES_ARCHIVE_DIR'))
+    run.add_argument('--keep-detached', action='store_true', help='detach but do not drop the archived tables')
+    args = parser.parse_args()
+
+    conn = connect()
+    if args.command == 'ensure':
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT ensure_messages_partitions(LOCALTIMESTAMP, LOCALTIMESTAMP + make_interval(months => %s))
+        """, (args.months_ahead,))
+        created = cursor.fetchone()[0]
+        conn.commit()
+        print(json.dumps({'created': created}))
+        return
+
+    if args.command == 'list':
+        attached = attached_partitions(conn)
+        report = {
+            'attached': [dict(p, **{'from': p['from'].isoformat(), 'to': p['to'].isoformat()}) for p in attached],
+            'archived': load_catalog(args.dir)['partitions'] if args.dir else []
+        }
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+        return
+
+    if not args.dir:
+        parser.error('--dir or MESSAGES_ARCHIVE_DIR is required')
+    os.makedirs(args.dir, exist_ok=True)
+    cutoff = datetime.strptime(args.before, '%Y-%m')
+    for partition in attached_partitions(conn):
+        if partition['to'] > cutoff:
+            break
+        print(json.dumps(archive_partition(conn, partition, args.dir, args.keep_detached)), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+'''
+Helpers shared by the benchmark scripts: migrations, timing and percentiles.
+'''
+
+import glob
+import importlib.util
+import os
+import sys
+import time
+from types import ModuleType
+from typing import Dict, List
+
+import psycopg2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+MIGRATIONS_DIR = os.path.join(ROOT, 'db_migrations')
+BACKEND_DIR = os.path.join(ROOT, 'backend')
+
+# Benchmarks drive one user far past the production rate limits; set ADMISSION_ENABLED=1 to measure them
+os.environ.setdefault('ADMISSION_ENABLED', '0')
+
+
+def connect(dsn: str = None):
+    return psycopg2.connect(dsn or os.environ['DATABASE_URL'])
+
+
+def load_handler(name: str) -> ModuleType:
+    """Import backend/<name>/index.py with its sibling modules, isolated from the other functions"""
+    folder = os.path.join(BACKEND_DIR, name)
+    siblings = [f[:-3] for f in os.listdir(folder) if f.endswith('.py') and f != 'index.py']
+    for sibling in siblings:
+        sys.modules.pop(sibling, None)
+    sys.path.insert(0, folder)
+    try:
+        spec = importlib.util.spec_from_file_location(f'incordes_{name}', os.path.join(folder, 'index.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(folder)
+        for sibling in siblings:
+            sys.modules.pop(sibling, None)
+    return module
+
+
+def apply_migrations(conn) -> List[str]:
+    """Apply db_migrations/V*.sql in version order, each once, the way the platform does on deploy"""
+    applied = []
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS bench_schema_history (
+            script VARCHAR(200) PRIMARY KEY,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    cursor.execute('SELECT script FROM bench_schema_history')
+    done = {row[0] for row in cursor.fetchall()}
+    for path in sorted(glob.glob(os.path.join(MIGRATIONS_DIR, 'V*.sql'))):
+        script = os.path.basename(path)
+        if script in done:
+            continue
+        with open(path, encoding='utf-8') as f:
+            cursor.execute(f.read())
+        cursor.execute('INSERT INTO bench_schema_history (script) VALUES (%s)', (script,))
+        applied.append(script)
+    conn.commit()
+    return applied
+
+
+def percentiles(samples_ms: List[float]) -> Dict[str, float]:
+    if not samples_ms:
+        return {'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'max': 0.0}
+    ordered = sorted(samples_ms)
+
+    def pick(pct: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))], 3)
+
+    return {'p50': pick(50), 'p95': pick(95), 'p99': pick(99), 'max': round(ordered[-1], 3)}
+
+
+def timed(cursor, sql: str, args=None) -> float:
+    """Run a statement to completion and return its wall time in milliseconds"""
+    started = time.perf_counter()
+    cursor.execute(sql, args)
+    if cursor.description is not None:
+        cursor.fetchall()
+    return (time.perf_counter() - started) * 1000
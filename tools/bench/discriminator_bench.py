@@ -0,0 +1,129 @@
+'''
+Registration benchmark against usernames whose discriminators are 90% taken.
+
+Fills a few usernames to --fill of the 10000 tags, then registers users with those
+names through backend/auth in-process and reports allocation and registration
+latency and failures. The same names are also run through the old ten-SELECT allocator,
+which shows how often it fell back to a tag that was already taken. Every run
+uses fresh usernames and leaves its rows behind, so point it at a scratch database.
+
+Usage:
+    DATABASE_URL=postgresql://localhost/incordes_bench python tools/bench/discriminator_bench.py \
+        --usernames 10 --fill 0.9 --registrations 500
+'''
+
+import argparse
+import json
+import os
+import random
+import secrets
+import time
+import uuid
+
+from common import apply_migrations, connect, load_handler, percentiles
+
+PREFIX = 'discbench-' + uuid.uuid4().hex[:8]
+
+
+def fill(conn, usernames: int, ratio: float) -> list:
+    names = [f'{PREFIX}-{i}' for i in range(usernames)]
+    cursor = conn.cursor()
+    for name in names:
+        cursor.execute("""
+            INSERT INTO users (incordes_id, email, username, discriminator, password_hash)
+            SELECT %(name)s || '-' || d, %(name)s || '-' || d || '@example.com', %(name)s, d, 'x'
+            FROM (
+                SELECT to_char(g, 'FM0000') AS d FROM generate_series(0, 9999) g
+                ORDER BY random() LIMIT %(count)s
+            ) taken
+        """, {'name': name, 'count': int(10000 * ratio)})
+    conn.commit()
+    return names
+
+
+def legacy_discriminator(cursor, username: str) -> str:
+    """The allocator this replaces: ten random probes, then an unchecked guess"""
+    for _ in range(10):
+        disc = f"{secrets.randbelow(10000):04d}"
+        cursor.execute("SELECT id FROM users WHERE username = %s AND discriminator = %s", (username, disc))
+        if not cursor.fetchone():
+            return disc
+    return f"{secrets.randbelow(10000):04d}"
+
+
+def run_legacy(conn, names: list, count: int) -> dict:
+    cursor = conn.cursor()
+    samples = []
+    collisions = 0
+    for _ in range(count):
+        name = random.choice(names)
+        started = time.perf_counter()
+        disc = legacy_discriminator(cursor, name)
+        samples.append((time.perf_counter() - started) * 1000)
+        cursor.execute("SELECT 1 FROM users WHERE username = %s AND discriminator = %s", (name, disc))
+        collisions += cursor.fetchone() is not None
+    conn.rollback()
+    return {'allocationMs': percentiles(samples), 'collisions': collisions, 'collisionRate': round(collisions / count, 4)}
+
+
+def run_allocator(auth, conn, names: list, count: int) -> dict:
+    """The new single-query allocator on its own, without the insert and commit"""
+    samples = []
+    for _ in range(count):
+        started = time.perf_counter()
+        auth.generate_discriminator(random.choice(names), conn)
+        samples.append((time.perf_counter() - started) * 1000)
+    conn.rollback()
+    return {'allocationMs': percentiles(samples)}
+
+
+def run_handler(auth, names: list, count: int) -> dict:
+    samples = []
+    statuses = {}
+    for _ in range(count):
+        event = {
+            'httpMethod': 'POST',
+            'headers': {},
+            'body': json.dumps({
+                'action': 'register',
+                'email': f'{PREFIX}-{uuid.uuid4().hex}@example.com',
+                'username': random.choice(names),
+                'password': 'bench'
+            })
+        }
+        started = time.perf_counter()
+        status = auth.handler(event, None)['statusCode']
+        samples.append((time.perf_counter() - started) * 1000)
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {'registerMs': percentiles(samples), 'statuses': statuses}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--usernames', type=int, default=10)
+    parser.add_argument('--fill', type=float, default=0.9)
+    parser.add_argument('--registrations', type=int, default=500)
+    args = parser.parse_args()
+
+    os.environ.setdefault('REQUEST_LOG', '0')
+    conn = connect()
+    apply_migrations(conn)
+    names = fill(conn, args.usernames, args.fill)
+    auth = load_handler('auth')
+    report = {
+        'usernames': args.usernames,
+        'fill': args.fill,
+        'legacy': run_legacy(conn, names, args.registrations),
+        'allocator': run_allocator(auth, conn, names, args.registrations),
+        'register': run_handler(auth, names, args.registrations)
+    }
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT count(*) - count(DISTINCT (username, discriminator)) FROM users WHERE username = ANY(%s)
+    """, (names,))
+    report['duplicateTags'] = cursor.fetchone()[0]
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
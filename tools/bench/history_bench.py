@@ -0,0 +1,149 @@
+'''
+History read, insert and vacuum benchmark for the messages table, partitioned or not.
+
+Samples the busiest channels, builds cursors at several depths of their history and
+times backend/messages history pages from each depth in-process. Also times single
+message inserts, and VACUUM (ANALYZE) of the table that takes new rows: the newest
+partition when messages is partitioned, the whole table otherwise. Run it on the
+commit before the partitioning migration and after it, on the same seed, to compare.
+
+Usage:
+    DATABASE_URL=... python tools/bench/seed.py --messages-per-channel 12500 --history-days 540
+    DATABASE_URL=... python tools/bench/history_bench.py --channels 20 --pages 50 --out results/history.json
+'''
+
+import argparse
+import json
+import os
+import random
+import time
+
+from common import connect, load_handler, percentiles
+
+DEPTHS = [0.0, 0.25, 0.5, 0.9]
+
+
+def layout(conn) -> dict:
+    cursor = conn.cursor()
+    cursor.execute("SELECT relkind = 'p' FROM pg_class WHERE relname = 'messages'")
+    partitioned = cursor.fetchone()[0]
+    cursor.execute("""
+        SELECT count(*), COALESCE(sum(GREATEST(c.reltuples, 0)), 0)::bigint
+        FROM pg_class c
+        WHERE c.oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = 'messages'::regclass)
+           OR (c.relname = 'messages' AND c.relkind = 'r')
+    """)
+    tables, rows = cursor.fetchone()
+    # New rows go to the partition of the current month
+    cursor.execute("SELECT 'messages_p' || to_char(LOCALTIMESTAMP, 'YYYYMM')")
+    current = cursor.fetchone()[0]
+    conn.rollback()
+    return {
+        'partitioned': partitioned,
+        'partitions': tables if partitioned else 0,
+        'estimatedRows': rows,
+        'writeTable': current if partitioned else 'messages'
+    }
+
+
+def sample_cursors(conn, channels: int) -> list:
+    """(channel id, depth, cursor) for the busiest channels at each depth of their history"""
+    messages = load_handler('messages')
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT channel_id, count(*) FROM messages
+        WHERE channel_id IS NOT NULL
+        GROUP BY channel_id ORDER BY count(*) DESC LIMIT %s
+    """, (channels,))
+    samples = []
+    for channel_id, total in cursor.fetchall():
+        for depth in DEPTHS:
+            if depth == 0:
+                samples.append((channel_id, depth, None))
+                continue
+            cursor.execute("""
+                SELECT created_at, id FROM messages WHERE channel_id = %s
+                ORDER BY created_at DESC, id DESC OFFSET %s LIMIT 1
+            """, (channel_id, int(total * depth)))
+            row = cursor.fetchone()
+            if row:
+                samples.append((channel_id, depth, messages.encode_cursor(row[0], row[1])))
+    conn.rollback()
+    return samples
+
+
+def bench_history(samples: list, pages: int, sender: int) -> dict:
+    messages = load_handler('messages')
+    by_depth = {depth: [] for depth in DEPTHS}
+    for _ in range(pages):
+        for channel_id, depth, cursor in samples:
+            params = {'channelId': str(channel_id), 'limit': '50'}
+            if cursor:
+                params['before'] = cursor
+            event = {'httpMethod': 'GET', 'headers': {'X-User-Id': str(sender)}, 'queryStringParameters': params}
+            started = time.perf_counter()
+            status = messages.handler(event, None)['statusCode']
+            by_depth[depth].append((time.perf_counter() - started) * 1000)
+            if status != 200:
+                raise RuntimeError(f'history returned {status} for channel {channel_id}')
+    return {f'depth{int(depth * 100)}': percentiles(samples_ms) for depth, samples_ms in by_depth.items()}
+
+
+def bench_inserts(channel_id: int, sender: int, count: int) -> dict:
+    messages = load_handler('messages')
+    samples = []
+    for i in range(count):
+        event = {
+            'httpMethod': 'POST',
+            'headers': {'X-User-Id': str(sender)},
+            'body': json.dumps({'channelId': channel_id, 'content': f'history bench {i}'})
+        }
+        started = time.perf_counter()
+        messages.handler(event, None)
+        samples.append((time.perf_counter() - started) * 1000)
+    return percentiles(samples)
+
+
+def bench_vacuum(conn, table: str) -> float:
+    conn.autocommit = True
+    try:
+        started = time.perf_counter()
+        conn.cursor().execute(f'VACUUM (ANALYZE) {table}')
+        return round(time.perf_counter() - started, 2)
+    finally:
+        conn.autocommit = False
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--channels', type=int, default=20)
+    parser.add_argument('--pages', type=int, default=20, help='rounds over every channel and depth')
+    parser.add_argument('--inserts', type=int, default=500)
+    parser.add_argument('--no-vacuum', action='store_true')
+    parser.add_argument('--out', help='write the JSON report here')
+    args = parser.parse_args()
+
+    os.environ.setdefault('REQUEST_LOG', '0')
+    conn = connect()
+    report = {'layout': layout(conn)}
+    samples = sample_cursors(conn, args.channels)
+    cursor = conn.cursor()
+    cursor.execute('SELECT min(id) FROM users')
+    sender = cursor.fetchone()[0]
+    conn.rollback()
+
+    report['historyMs'] = bench_history(samples, args.pages, sender)
+    report['insertMs'] = bench_inserts(random.choice(samples)[0], sender, args.inserts)
+    if not args.no_vacuum:
+        table = report['layout']['writeTable']
+        report['vacuum'] = {'table': table, 'seconds': bench_vacuum(conn, table)}
+
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
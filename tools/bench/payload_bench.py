@@ -0,0 +1,96 @@
+'''
+Serialization and compression benchmark for a 500-message history page.
+
+Compares the old json.dumps path with the shared response layer (orjson when
+installed, compact stdlib json otherwise) and reports body sizes and timings for
+identity, gzip and brotli encodings, and the size of the same page in the users=map
+shape (senderId per message plus one profile per distinct sender). Needs no database.
+
+Usage: python tools/bench/payload_bench.py --messages 500 --runs 200
+'''
+
+import argparse
+import gzip
+import json
+import random
+import time
+from datetime import datetime, timedelta
+
+from common import load_handler, percentiles
+
+WORDS = ['привет', 'всем', 'как', 'дела', 'сегодня', 'релиз', 'сервер', 'упал', 'ok', 'thanks',
+         'see', 'you', 'tomorrow', 'the', 'build', 'is', 'green', 'again', 'lol', 'https://example.com/x']
+
+
+def build_page(count: int) -> dict:
+    rng = random.Random(42)
+    senders = [
+        {'id': i, 'username': f'user{i}', 'discriminator': f'{i:04d}', 'avatarUrl': f'https://cdn.example.com/a/{i}.png'}
+        for i in range(1, 9)
+    ]
+    started = datetime(2026, 1, 1, 12, 0, 0)
+    messages = []
+    for i in range(count):
+        messages.append({
+            'id': 1_000_000 + i,
+            'content': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(4, 30))),
+            'createdAt': (started + timedelta(seconds=i * 17)).isoformat(),
+            'editedAt': None,
+            'sender': dict(rng.choice(senders))
+        })
+    return {'messages': messages, 'nextCursor': 'MjAyNi0wMS0wMVQxMjowMDowMHwxMDAwMDAw', 'prevCursor': None, 'hasMore': True}
+
+
+def with_users_map(page: dict) -> dict:
+    """The same page as history returns it with users=map"""
+    users = {}
+    messages = []
+    for message in page['messages']:
+        sender = message['sender']
+        users[str(sender['id'])] = sender
+        messages.append(dict({k: v for k, v in message.items() if k != 'sender'}, senderId=sender['id']))
+    return dict(page, messages=messages, users=users)
+
+
+def measure(fn, runs: int):
+    samples = []
+    result = None
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return result, percentiles(samples)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=500)
+    parser.add_argument('--runs', type=int, default=200)
+    args = parser.parse_args()
+
+    response = load_handler('messages').response
+    page = build_page(args.messages)
+    report = {'messages': args.messages, 'encoder': 'orjson' if response.orjson is not None else 'stdlib json'}
+
+    old_body, report['serializeMsOld'] = measure(lambda: json.dumps(page), args.runs)
+    new_body, report['serializeMsNew'] = measure(lambda: response.dumps(page), args.runs)
+    raw = new_body.encode()
+    report['bytes'] = {'old': len(old_body.encode()), 'new': len(raw)}
+
+    gz, report['gzipMs'] = measure(lambda: gzip.compress(raw, compresslevel=response.GZIP_LEVEL), args.runs)
+    report['bytes']['gzip'] = len(gz)
+    if response.brotli is not None:
+        br, report['brotliMs'] = measure(lambda: response.brotli.compress(raw, quality=response.BROTLI_QUALITY), args.runs)
+        report['bytes']['br'] = len(br)
+
+    mapped = response.dumps(with_users_map(page)).encode()
+    report['bytes']['usersMap'] = len(mapped)
+    report['bytes']['usersMapGzip'] = len(gzip.compress(mapped, compresslevel=response.GZIP_LEVEL))
+
+    event = {'headers': {'Accept-Encoding': 'gzip, deflate, br'}}
+    _, report['endToEndMs'] = measure(lambda: response.compress(event, response.json(200, page)), args.runs)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
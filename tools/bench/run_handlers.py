@@ -0,0 +1,243 @@
+'''
+Replay weighted mixes of the tests.json requests against the real handlers, in-process.
+
+Each backend/<name>/index.py is imported with load_handler and called with the
+same event dicts the platform builds. Requests are filled from the fixture written
+by seed.py (user id, channel, peer, incordes id) so they hit seeded data. Every
+connection the handler pools open uses a counting cursor layered over the
+function's own cursor factory, which gives queries per request without touching
+handler code. Per-request log lines are off unless REQUEST_LOG=1.
+
+Usage:
+    DATABASE_URL=... python tools/bench/run_handlers.py --fixture bench_fixture.json \
+        --concurrency 16 --requests 20000 --weight "messages:Get messages=10" --out results/HEAD.json
+    python tools/bench/run_handlers.py --compare results/base.json results/HEAD.json
+'''
+
+import argparse
+import copy
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple
+
+import psycopg2.extensions
+
+from common import BACKEND_DIR, ROOT, load_handler, percentiles
+
+FUNCTIONS = ['auth', 'friends', 'messages', 'servers']
+
+_local = threading.local()
+
+
+class CountingMixin:
+    """Cursor mixin that counts statements executed on the current thread"""
+
+    def execute(self, query, vars=None):
+        _local.queries = getattr(_local, 'queries', 0) + 1
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        _local.queries = getattr(_local, 'queries', 0) + 1
+        return super().executemany(query, vars_list)
+
+
+class Context:
+    def __init__(self, function_name: str):
+        self.request_id = uuid.uuid4().hex
+        self.function_name = function_name
+
+
+def instrument_pool(module) -> None:
+    """Make the function's pool hand out connections whose cursors also count statements"""
+    pool = module.db.get_pool()
+    base = pool.cursor_factory or psycopg2.extensions.cursor
+    pool.cursor_factory = type('CountingCursor', (CountingMixin, base), {})
+
+
+def load_scenarios(weights: Dict[str, float]) -> List[Tuple[str, Dict[str, Any], float]]:
+    scenarios = []
+    for name in FUNCTIONS:
+        with open(os.path.join(BACKEND_DIR, name, 'tests.json'), encoding='utf-8') as f:
+            for test in json.load(f)['tests']:
+                key = f"{name}:{test['name']}"
+                weight = weights.get(key, weights.get(name, 1.0))
+                if weight > 0:
+                    scenarios.append((key, test, weight))
+    return scenarios
+
+
+def build_event(test: Dict[str, Any], user: Dict[str, Any], users: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Turn a tests.json entry into a platform event aimed at seeded rows"""
+    headers = dict(test.get('headers', {}))
+    if 'X-User-Id' in headers:
+        headers['X-User-Id'] = str(user['id'])
+    params = copy.deepcopy(test.get('queryStringParameters', {}))
+    body = copy.deepcopy(test.get('body'))
+
+    def fill(values: Dict[str, Any]) -> None:
+        if 'channelId' in values:
+            values['channelId'] = str(random.choice(user['channels']))
+        if 'serverId' in values:
+            values['serverId'] = str(random.choice(user['servers']))
+        if 'recipientId' in values and user['peers']:
+            values['recipientId'] = str(random.choice(user['peers']))
+        if 'incordesId' in values:
+            values['incordesId'] = random.choice(users)['incordesId']
+        if 'email' in values:
+            values['email'] = f"bench-{uuid.uuid4().hex}@example.com"
+        for item in values.get('messages') or []:
+            if isinstance(item, dict):
+                fill(item)
+
+    fill(params)
+    if isinstance(body, dict):
+        fill(body)
+    return {
+        'httpMethod': test.get('method', 'GET'),
+        'headers': headers,
+        'queryStringParameters': params,
+        'body': json.dumps(body) if body is not None else '{}',
+        'isBase64Encoded': False
+    }
+
+
+def run(args) -> Dict[str, Any]:
+    os.environ.setdefault('DB_POOL_MAX_SIZE', str(args.concurrency))
+    os.environ.setdefault('REQUEST_LOG', '0')
+    modules = {name: load_handler(name) for name in FUNCTIONS}
+    for module in modules.values():
+        instrument_pool(module)
+
+    with open(args.fixture, encoding='utf-8') as f:
+        users = json.load(f)['users']
+    weights = {}
+    for spec in args.weight:
+        key, value = spec.rsplit('=', 1)
+        weights[key] = float(value)
+    scenarios = load_scenarios(weights)
+    total_weight = [s[2] for s in scenarios]
+
+    samples: Dict[str, Dict[str, Any]] = {
+        key: {'latencies': [], 'queries': 0, 'statuses': {}} for key, _, _ in scenarios
+    }
+    lock = threading.Lock()
+    remaining = [args.requests]
+    deadline = time.monotonic() + args.duration if args.duration else None
+
+    def worker() -> None:
+        rng = random.Random()
+        while True:
+            with lock:
+                if remaining[0] <= 0 or (deadline and time.monotonic() > deadline):
+                    return
+                remaining[0] -= 1
+            key, test, _ = rng.choices(scenarios, weights=total_weight)[0]
+            name = key.split(':', 1)[0]
+            event = build_event(test, rng.choice(users), users)
+            _local.queries = 0
+            started = time.perf_counter()
+            try:
+                status = modules[name].handler(event, Context(name))['statusCode']
+            except Exception as exc:
+                status = type(exc).__name__
+            elapsed = (time.perf_counter() - started) * 1000
+            with lock:
+                bucket = samples[key]
+                bucket['latencies'].append(elapsed)
+                bucket['queries'] += _local.queries
+                bucket['statuses'][str(status)] = bucket['statuses'].get(str(status), 0) + 1
+
+    for _ in range(args.warmup):
+        key, test, _ = random.choice(scenarios)
+        name = key.split(':', 1)[0]
+        modules[name].handler(build_event(test, random.choice(users), users), Context(name))
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for _ in range(args.concurrency):
+            pool.submit(worker)
+    elapsed = time.monotonic() - started
+
+    actions = {}
+    for key, bucket in samples.items():
+        count = len(bucket['latencies'])
+        if not count:
+            continue
+        actions[key] = {
+            'requests': count,
+            'throughput': round(count / elapsed, 1),
+            'latencyMs': percentiles(bucket['latencies']),
+            'queriesPerRequest': round(bucket['queries'] / count, 2),
+            'statuses': bucket['statuses']
+        }
+    return {
+        'commit': _git_commit(),
+        'config': {'concurrency': args.concurrency, 'requests': args.requests, 'weights': weights},
+        'elapsedSeconds': round(elapsed, 2),
+        'throughput': round(sum(a['requests'] for a in actions.values()) / elapsed, 1),
+        'actions': actions,
+        'pools': {name: module.db.stats() for name, module in modules.items()}
+    }
+
+
+def compare(base_path: str, head_path: str) -> Dict[str, Any]:
+    """Relative change of p50/p95/p99 and queries per request between two saved runs"""
+    with open(base_path, encoding='utf-8') as f:
+        base = json.load(f)
+    with open(head_path, encoding='utf-8') as f:
+        head = json.load(f)
+    diff = {}
+    for key, now in head['actions'].items():
+        before = base['actions'].get(key)
+        if not before:
+            continue
+        entry = {}
+        for pct in ('p50', 'p95', 'p99'):
+            old, new = before['latencyMs'][pct], now['latencyMs'][pct]
+            entry[pct] = f"{old} -> {new} ms ({(new - old) / old * 100:+.1f}%)" if old else f"{old} -> {new} ms"
+        entry['queriesPerRequest'] = f"{before['queriesPerRequest']} -> {now['queriesPerRequest']}"
+        diff[key] = entry
+    return {'base': base.get('commit'), 'head': head.get('commit'), 'actions': diff}
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fixture', default='bench_fixture.json')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=10_000)
+    parser.add_argument('--duration', type=float, default=0, help='stop after N seconds even if requests remain')
+    parser.add_argument('--warmup', type=int, default=50)
+    parser.add_argument('--weight', action='append', default=[],
+                        help='"function=W" or "function:test name=W"; 0 disables a request')
+    parser.add_argument('--out', help='write the JSON report here')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'HEAD'), help='compare two saved reports')
+    args = parser.parse_args()
+
+    if args.compare:
+        print(json.dumps(compare(*args.compare), indent=2, ensure_ascii=False))
+        return
+
+    report = run(args)
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
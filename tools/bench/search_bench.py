@@ -0,0 +1,144 @@
+'''
+Full-text search benchmark: seeds a scratch database with mixed Russian/English messages
+and times backend/messages search requests in-process at several result depths
+(the first page, then pages reached by following nextCursor).
+
+Usage:
+    DATABASE_URL=postgresql://localhost/incordes_bench python tools/bench/search_bench.py --messages 10000000
+'''
+
+import argparse
+import json
+import os
+import time
+
+from common import apply_migrations, connect, load_handler, percentiles
+
+WORDS = [
+    'привет', 'сервер', 'канал', 'сообщение', 'игра', 'музыка', 'встреча', 'завтра', 'проект', 'релиз',
+    'ошибка', 'поиск', 'друзья', 'голос', 'стрим', 'обновление', 'новости', 'погода', 'кофе', 'код',
+    'hello', 'server', 'channel', 'message', 'game', 'music', 'meeting', 'tomorrow', 'project', 'release',
+    'bug', 'search', 'friends', 'voice', 'stream', 'update', 'news', 'weather', 'coffee', 'deploy'
+]
+
+QUERIES = ['релиз', 'ошибка сервер', 'deploy release', 'музыка OR music', '"новости проект"', 'coffee -tomorrow']
+
+PAGES = [1, 5, 20]
+
+
+def seed(conn, messages: int, users: int, channels: int, batch: int) -> float:
+    cursor = conn.cursor()
+    started = time.perf_counter()
+    cursor.execute("""
+        INSERT INTO users (incordes_id, email, username, discriminator, password_hash)
+        SELECT 'BENCH-' || g, 'bench' || g || '@example.com', 'bench' || g, lpad((g %% 10000)::text, 4, '0'), 'x'
+        FROM generate_series(1, %s) g
+        ON CONFLICT DO NOTHING
+    """, (users,))
+    cursor.execute("INSERT INTO servers (name, owner_id) SELECT 'bench', min(id) FROM users RETURNING id")
+    server_id = cursor.fetchone()[0]
+    cursor.execute("""
+        INSERT INTO server_members (server_id, user_id) SELECT %s, id FROM users ON CONFLICT DO NOTHING
+    """, (server_id,))
+    cursor.execute("""
+        INSERT INTO channels (server_id, name, position)
+        SELECT %s, 'bench-' || g, g FROM generate_series(1, %s) g
+    """, (server_id, channels))
+    conn.commit()
+
+    cursor.execute("SELECT array_agg(id) FROM channels WHERE server_id = %s", (server_id,))
+    channel_ids = cursor.fetchone()[0]
+    cursor.execute("SELECT array_agg(id) FROM users")
+    user_ids = cursor.fetchone()[0]
+    cursor.execute("SELECT to_regproc('ensure_messages_partitions') IS NOT NULL")
+    # Messages go back one second apiece, so the monthly partitions must reach back that far first
+    if cursor.fetchone()[0]:
+        cursor.execute("""
+            SELECT ensure_messages_partitions(LOCALTIMESTAMP - make_interval(secs => %s), LOCALTIMESTAMP + INTERVAL '1 month')
+        """, (messages,))
+    conn.commit()
+
+    done = 0
+    while done < messages:
+        size = min(batch, messages - done)
+        cursor.execute("""
+            INSERT INTO messages (channel_id, sender_id, content, created_at)
+            SELECT (%(channels)s::int[])[1 + (g %% array_length(%(channels)s::int[], 1))],
+                   (%(users)s::int[])[1 + ((g * 7) %% array_length(%(users)s::int[], 1))],
+                   (SELECT string_agg((%(words)s::text[])[1 + floor(random() * array_length(%(words)s::text[], 1))::int], ' ')
+                    FROM generate_series(1, 6 + (g %% 10)) w),
+                   now() - (g || ' seconds')::interval
+            FROM generate_series(%(start)s, %(end)s) g
+        """, {'channels': channel_ids, 'users': user_ids, 'words': WORDS, 'start': done, 'end': done + size - 1})
+        conn.commit()
+        done += size
+        print(json.dumps({'seeded': done}), flush=True)
+    cursor.execute('ANALYZE messages')
+    conn.commit()
+    return time.perf_counter() - started
+
+
+def search(messages, user_id: int, query: str, cursor: str = None) -> dict:
+    params = {'action': 'search', 'q': query, 'limit': '20'}
+    if cursor:
+        params['cursor'] = cursor
+    event = {'httpMethod': 'GET', 'headers': {'X-User-Id': str(user_id)}, 'queryStringParameters': params}
+    result = messages.handler(event, None)
+    if result['statusCode'] != 200:
+        raise RuntimeError(f"search returned {result['statusCode']} for {query!r}")
+    return json.loads(result['body'])
+
+
+def bench_query(messages, user_id: int, query: str, runs: int) -> dict:
+    """Latency of one query at each depth in PAGES that its results reach"""
+    cursors = {1: None}
+    page, body = 1, search(messages, user_id, query)
+    while body['nextCursor'] and page < PAGES[-1]:
+        page += 1
+        cursors[page] = body['nextCursor']
+        body = search(messages, user_id, query, body['nextCursor'])
+    by_page = {}
+    for depth in PAGES:
+        if depth not in cursors:
+            break
+        samples = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            search(messages, user_id, query, cursors[depth])
+            samples.append((time.perf_counter() - started) * 1000)
+        by_page[f'page{depth}'] = percentiles(samples)
+    return by_page
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=10_000_000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--channels', type=int, default=200)
+    parser.add_argument('--batch', type=int, default=200_000)
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--skip-seed', action='store_true')
+    args = parser.parse_args()
+
+    os.environ.setdefault('REQUEST_LOG', '0')
+    conn = connect()
+    report = {}
+    if not args.skip_seed:
+        apply_migrations(conn)
+        report['seedSeconds'] = round(seed(conn, args.messages, args.users, args.channels, args.batch), 1)
+
+    cursor = conn.cursor()
+    cursor.execute('SELECT count(*) FROM messages')
+    report['messages'] = cursor.fetchone()[0]
+    cursor.execute('SELECT min(user_id) FROM server_members')
+    user_id = cursor.fetchone()[0]
+    conn.rollback()
+    messages = load_handler('messages')
+    report['queries'] = {}
+    for query in QUERIES:
+        report['queries'][query] = bench_query(messages, user_id, query, args.runs)
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+'''
+Seed a local Postgres with a synthetic community for the benchmarks.
+
+Everything is generated set-based with generate_series, so millions of rows load
+in minutes. A fixture file with sample users, their channels, peers and the ids
+needed to fill tests.json requests is written for run_handlers.py.
+
+Usage:
+    DATABASE_URL=postgresql://localhost/incordes_bench python tools/bench/seed.py \
+        --users 10000 --servers 500 --channels-per-server 8 --members-per-server 200 \
+        --friends-per-user 20 --messages-per-channel 2000 --dms 200000 --history-days 0
+'''
+
+import argparse
+import json
+import time
+
+from common import apply_migrations, connect
+
+
+def seed(conn, args) -> dict:
+    cursor = conn.cursor()
+    timings = {}
+
+    def step(name: str, sql: str, params=None) -> None:
+        started = time.perf_counter()
+        cursor.execute(sql, params)
+        conn.commit()
+        timings[name] = round(time.perf_counter() - started, 2)
+        print(json.dumps({'step': name, 'seconds': timings[name]}), flush=True)
+
+    step('users', """
+        INSERT INTO users (incordes_id, email, username, discriminator, password_hash, status)
+        SELECT 'INCRD-B' || lpad(to_hex(g), greatest(3, length(to_hex(g))), '0') || '-' || lpad(to_hex(g * 7919 %% 65536), 4, '0'),
+               'bench' || g || '@example.com',
+               'user' || (g %% 500),
+               lpad((g / 500)::text, 4, '0'),
+               'x',
+               CASE WHEN g %% 5 = 0 THEN 'online' ELSE 'offline' END
+        FROM generate_series(1, %(users)s) g
+        ON CONFLICT DO NOTHING
+    """, vars(args))
+    cursor.execute('SELECT min(id), max(id) FROM users')
+    first_user, last_user = cursor.fetchone()
+    span = last_user - first_user + 1
+    # Spread history over --history-days so it spans monthly partitions; by default
+    # channel messages are a minute apart and DMs a second apart
+    history = args.history_days * 86400
+    params = dict(vars(args), first=first_user, span=span,
+                  channel_spacing=history / max(args.messages_per_channel, 1) if history else 60,
+                  dm_spacing=history / max(args.dms, 1) if history else 1)
+
+    step('servers', """
+        INSERT INTO servers (name, owner_id)
+        SELECT 'server ' || g, %(first)s + (g * 37) %% %(span)s
+        FROM generate_series(1, %(servers)s) g
+    """, params)
+    step('server_members', """
+        INSERT INTO server_members (server_id, user_id)
+        SELECT s.id, %(first)s + ((s.id * 131 + k * 17) %% %(span)s)
+        FROM servers s, generate_series(0, %(members_per_server)s - 1) k
+        ON CONFLICT DO NOTHING
+    """, params)
+    step('channels', """
+        INSERT INTO channels (server_id, name, type, position)
+        SELECT s.id, 'channel-' || k, 'text', k
+        FROM servers s, generate_series(0, %(channels_per_server)s - 1) k
+    """, params)
+    step('friend_edges', """
+        WITH pairs AS (
+            SELECT u.id AS a, %(first)s + ((u.id + k * 97) %% %(span)s) AS b,
+                   k %% 4 = 0 AS pending,
+                   now() - (k || ' hours')::interval AS at
+            FROM users u, generate_series(1, %(friends_per_user)s) k
+            WHERE %(first)s + ((u.id + k * 97) %% %(span)s) > u.id
+        )
+        INSERT INTO friend_edges (user_id, peer_id, state, created_at)
+        SELECT a, b, CASE WHEN pending THEN 'outgoing' ELSE 'friends' END, at FROM pairs
+        UNION ALL
+        SELECT b, a, CASE WHEN pending THEN 'incoming' ELSE 'friends' END, at FROM pairs
+        ON CONFLICT DO NOTHING
+    """, params)
+    cursor.execute("SELECT to_regproc('ensure_messages_partitions') IS NOT NULL")
+    # Without the partitioning migration (comparison runs on an older tree) there is nothing to create
+    if cursor.fetchone()[0]:
+        step('partitions', """
+            SELECT ensure_messages_partitions(
+                LOCALTIMESTAMP - make_interval(secs => greatest(%(messages_per_channel)s * %(channel_spacing)s, %(dms)s * %(dm_spacing)s)),
+                LOCALTIMESTAMP + INTERVAL '2 months'
+            )
+        """, params)
+    step('channel_messages', """
+        INSERT INTO messages (channel_id, sender_id, content, created_at)
+        SELECT c.id,
+               sm.user_id,
+               'message ' || k || ' in ' || c.name || CASE WHEN k %% 50 = 0 THEN ' <@' || sm.user_id || '>' ELSE '' END,
+               LOCALTIMESTAMP - make_interval(secs => (%(messages_per_channel)s - k) * %(channel_spacing)s)
+        FROM channels c
+        CROSS JOIN generate_series(1, %(messages_per_channel)s) k
+        JOIN LATERAL (
+            SELECT user_id FROM server_members
+            WHERE server_id = c.server_id
+            OFFSET (k * 13) %% %(members_per_server)s LIMIT 1
+        ) sm ON TRUE
+    """, params)
+    step('direct_messages', """
+        INSERT INTO messages (sender_id, recipient_id, content, created_at)
+        SELECT %(first)s + (g %% %(span)s),
+               %(first)s + ((g %% %(span)s) + 1 + (g / %(span)s) %% 20) %% %(span)s,
+               'dm ' || g,
+               LOCALTIMESTAMP - make_interval(secs => (%(dms)s - g) * %(dm_spacing)s)
+        FROM generate_series(1, %(dms)s) g
+    """, params)
+    step('analyze', 'ANALYZE')
+    return timings
+
+
+def write_fixture(conn, path: str, sample: int) -> None:
+    """Sample users that have servers, with what their requests need to be valid"""
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT u.id, u.incordes_id,
+               array_agg(DISTINCT c.id) AS channels,
+               array_agg(DISTINCT sm.server_id) AS servers
+        FROM users u
+        JOIN server_members sm ON sm.user_id = u.id
+        JOIN channels c ON c.server_id = sm.server_id
+        GROUP BY u.id, u.incordes_id
+        ORDER BY random()
+        LIMIT %s
+    """, (sample,))
+    users = [
+        {'id': row[0], 'incordesId': row[1], 'channels': row[2], 'servers': row[3]}
+        for row in cursor.fetchall()
+    ]
+    ids = [user['id'] for user in users]
+    cursor.execute("""
+        SELECT sender_id, array_agg(DISTINCT recipient_id)
+        FROM messages
+        WHERE sender_id = ANY(%s) AND recipient_id IS NOT NULL
+        GROUP BY sender_id
+    """, (ids,))
+    peers = dict(cursor.fetchall())
+    for user in users:
+        user['peers'] = peers.get(user['id'], [])
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'users': users}, f)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--servers', type=int, default=500)
+    parser.add_argument('--channels-per-server', type=int, default=8)
+    parser.add_argument('--members-per-server', type=int, default=200)
+    parser.add_argument('--friends-per-user', type=int, default=20)
+    parser.add_argument('--messages-per-channel', type=int, default=2000)
+    parser.add_argument('--dms', type=int, default=200_000)
+    parser.add_argument('--history-days', type=float, default=0, help='spread messages over this many days')
+    parser.add_argument('--fixture', default='bench_fixture.json')
+    parser.add_argument('--fixture-size', type=int, default=500)
+    args = parser.parse_args()
+
+    conn = connect()
+    apply_migrations(conn)
+    timings = seed(conn, args)
+    write_fixture(conn, args.fixture, args.fixture_size)
+    print(json.dumps({'seeded': timings, 'fixture': args.fixture}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
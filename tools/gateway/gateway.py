@@ -0,0 +1,274 @@
+'''
+Real-time push gateway: LISTENs on the incordes_events channel and fans events out over SSE.
+
+Clients connect with
+    GET /events?token=<auth token>&channels=10,11&dms=2,7
+(or userId=1 while AUTH_REQUIRE_TOKEN is off) and receive `event: message` frames whose data is the compact event published by
+backend/messages (t, id, q, x, c, d, s, at, b). Channel ids are checked against the
+user's server memberships once at connect; DM subscriptions are keyed by the
+canonical (low, high) user pair, so only the participants ever receive them.
+
+Every connection has a bounded queue. A client that falls behind gets its queue
+dropped and a single `event: resync` frame carrying a sync cursor (change_xid.change_seq)
+from just before the oldest undelivered event; it should catch up through messages ?action=sync.
+Events that commit later still arrive live, so the cursor only has to cover the dropped ones.
+
+Usage: DATABASE_URL=... python tools/gateway/gateway.py --port 8090
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import psycopg2
+import psycopg2.extensions
+
+# Tokens are checked with the same verifier module the backend functions use
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'backend', 'auth'))
+import tokens  # noqa: E402
+
+EVENTS_CHANNEL = 'incordes_events'
+QUEUE_SIZE = int(os.environ.get('GATEWAY_QUEUE_SIZE', '256'))
+HEARTBEAT_SECONDS = 15.0
+
+Key = Tuple
+
+
+class Subscriber:
+    """One SSE connection with its bounded outbound queue"""
+
+    def __init__(self, user_id: int, keys: Set[Key], writer: asyncio.StreamWriter):
+        self.user_id = user_id
+        self.keys = keys
+        self.writer = writer
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.overflows = 0
+
+    def offer(self, position: Tuple[int, int], frame: bytes) -> bool:
+        """Enqueue without blocking the fan-out loop; on overflow collapse the backlog into a resync"""
+        try:
+            self.queue.put_nowait((position, frame))
+            return True
+        except asyncio.QueueFull:
+            self.overflows += 1
+            oldest = position
+            while not self.queue.empty():
+                oldest = min(oldest, self.queue.get_nowait()[0])
+            # Syncing from just before the oldest undelivered event may repeat some, never skips any;
+            # same format as encode_change_cursor in backend/messages
+            resync = json.dumps({'cursor': f'{oldest[0]}.{max(oldest[1] - 1, 0)}'})
+            self.queue.put_nowait((oldest, f'event: resync\ndata: {resync}\n\n'.encode()))
+            return False
+
+
+class Hub:
+    """Subscription index keyed by ('c', channel_id) and ('d', low, high)"""
+
+    def __init__(self):
+        self.by_key: Dict[Key, Set[Subscriber]] = {}
+        self.stats = {'connections': 0, 'events': 0, 'delivered': 0, 'dropped': 0}
+
+    def add(self, sub: Subscriber) -> None:
+        for key in sub.keys:
+            self.by_key.setdefault(key, set()).add(sub)
+        self.stats['connections'] += 1
+
+    def remove(self, sub: Subscriber) -> None:
+        for key in sub.keys:
+            subs = self.by_key.get(key)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self.by_key[key]
+        self.stats['connections'] -= 1
+
+    def publish(self, payload: str) -> None:
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            return
+        self.stats['events'] += 1
+        if event.get('d'):
+            key = ('d', event['d'][0], event['d'][1])
+        else:
+            key = ('c', event.get('c'))
+        subs = self.by_key.get(key)
+        if not subs:
+            return
+        frame = f'event: message\ndata: {payload}\n\n'.encode()
+        position = (event.get('x') or 0, event.get('q') or 0)
+        for sub in subs:
+            if sub.offer(position, frame):
+                self.stats['delivered'] += 1
+            else:
+                self.stats['dropped'] += 1
+
+
+class Listener:
+    """Dedicated autocommit connection that LISTENs and feeds notifications into the hub"""
+
+    def __init__(self, dsn: str, hub: Hub):
+        self.dsn = dsn
+        self.hub = hub
+        self.conn = None
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                self.conn = psycopg2.connect(self.dsn)
+                self.conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                self.conn.cursor().execute(f'LISTEN {EVENTS_CHANNEL}')
+                closed = loop.create_future()
+                loop.add_reader(self.conn.fileno(), self._drain, closed)
+                await closed
+            except psycopg2.Error as exc:
+                print(json.dumps({'event': 'gateway_listen_error', 'error': str(exc)}))
+            finally:
+                if self.conn is not None:
+                    try:
+                        loop.remove_reader(self.conn.fileno())
+                    except (ValueError, psycopg2.InterfaceError):
+                        pass
+                    self.conn.close()
+            await asyncio.sleep(1)
+
+    def _drain(self, closed: asyncio.Future) -> None:
+        try:
+            self.conn.poll()
+        except psycopg2.Error:
+            if not closed.done():
+                closed.set_result(None)
+            return
+        while self.conn.notifies:
+            self.hub.publish(self.conn.notifies.pop(0).payload)
+
+
+class Gateway:
+    def __init__(self, dsn: str, check_membership: bool = True):
+        self.dsn = dsn
+        self.hub = Hub()
+        self.check_membership = check_membership
+        self._auth_conn = None
+        self._auth_lock = threading.Lock()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) < 2 or parts[0] != 'GET' or urlsplit(parts[1]).path != '/events':
+                writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+                return
+            params = parse_qs(urlsplit(parts[1]).query)
+            try:
+                channels = _ints(params.get('channels'))
+                peers = _ints(params.get('dms'))
+            except ValueError:
+                writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n')
+                return
+            user_id = tokens.authenticate({'headers': {
+                'X-Auth-Token': params.get('token', [None])[0],
+                'X-User-Id': params.get('userId', [None])[0]
+            }})
+            if user_id is None:
+                writer.write(b'HTTP/1.1 401 Unauthorized\r\nContent-Length: 0\r\n\r\n')
+                return
+
+            if self.check_membership and channels:
+                loop = asyncio.get_running_loop()
+                channels = await loop.run_in_executor(None, self._allowed_channels, user_id, channels)
+
+            keys: Set[Key] = {('c', channel_id) for channel_id in channels}
+            keys |= {('d', min(user_id, peer), max(user_id, peer)) for peer in peers}
+            writer.write(
+                b'HTTP/1.1 200 OK\r\n'
+                b'Content-Type: text/event-stream\r\n'
+                b'Cache-Control: no-cache\r\n'
+                b'Access-Control-Allow-Origin: *\r\n\r\n'
+                b': subscribed\n\n'
+            )
+            await writer.drain()
+            await self._pump(Subscriber(user_id, keys, writer))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _pump(self, sub: Subscriber) -> None:
+        self.hub.add(sub)
+        try:
+            while True:
+                try:
+                    _, frame = await asyncio.wait_for(sub.queue.get(), HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    frame = b': ping\n\n'
+                sub.writer.write(frame)
+                # Waiting for the socket buffer is the backpressure; meanwhile the queue absorbs bursts
+                await sub.writer.drain()
+        finally:
+            self.hub.remove(sub)
+
+    def _allowed_channels(self, user_id: int, channels: List[int]) -> List[int]:
+        with self._auth_lock:
+            if self._auth_conn is None or self._auth_conn.closed:
+                self._auth_conn = psycopg2.connect(self.dsn)
+                self._auth_conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            cursor = self._auth_conn.cursor()
+            cursor.execute("""
+                SELECT c.id FROM channels c
+                JOIN server_members sm ON sm.server_id = c.server_id
+                WHERE sm.user_id = %s AND c.id = ANY(%s)
+            """, (user_id, channels))
+            return [row[0] for row in cursor.fetchall()]
+
+    async def report(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            print(json.dumps({'event': 'gateway_stats', 'ts': time.time(), **self.hub.stats}))
+
+
+def _ints(values: Optional[List[str]]) -> List[int]:
+    if not values:
+        return []
+    return [int(v) for v in values[0].split(',') if v]
+
+
+async def serve(host: str, port: int, dsn: str, check_membership: bool, stats_interval: float) -> None:
+    gateway = Gateway(dsn, check_membership)
+    server = await asyncio.start_server(gateway.handle, host, port, backlog=4096, reuse_port=True)
+    tasks = [
+        asyncio.create_task(Listener(dsn, gateway.hub).run()),
+        asyncio.create_task(gateway.report(stats_interval))
+    ]
+    stop = asyncio.get_running_loop().create_future()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(sig, lambda: stop.done() or stop.set_result(None))
+    async with server:
+        await stop
+    for task in tasks:
+        task.cancel()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--no-membership-check', action='store_true',
+                        help='trust requested channel ids (load testing only)')
+    parser.add_argument('--stats-interval', type=float, default=10.0)
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port, os.environ['DATABASE_URL'],
+                      not args.no_membership_check, args.stats_interval))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+'''
+Load test for the push gateway against a local Postgres.
+
+Opens N SSE connections spread over C channels, publishes events with pg_notify
+at a fixed rate (the same path backend/messages uses), and reports delivered
+messages/sec plus publish-to-delivery latency percentiles. With --gateway-pid
+(same host, Linux) it also reports the gateway's resident memory per connection.
+
+Usage:
+    DATABASE_URL=... python tools/gateway/gateway.py --no-membership-check &
+    DATABASE_URL=... python tools/gateway/loadtest.py --connections 10000 --channels 100 --rate 200 --gateway-pid $!
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import statistics
+import threading
+import time
+from typing import List
+
+import psycopg2
+import psycopg2.extensions
+
+EVENTS_CHANNEL = 'incordes_events'
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.received = 0
+        self.resyncs = 0
+        self.connected = 0
+        self.failed = 0
+
+
+async def client(host: str, port: int, user_id: int, channel_id: int, recorder: Recorder,
+                 stop: asyncio.Event) -> None:
+    try:
+        reader, writer = await asyncio.open_connection(host, port)
+    except OSError:
+        recorder.failed += 1
+        return
+    writer.write(f'GET /events?userId={user_id}&channels={channel_id} HTTP/1.1\r\nHost: {host}\r\n\r\n'.encode())
+    await writer.drain()
+    status = await reader.readline()
+    if b'200' not in status:
+        recorder.failed += 1
+        writer.close()
+        return
+    recorder.connected += 1
+    event_name = None
+    try:
+        while not stop.is_set():
+            line = await reader.readline()
+            if not line:
+                break
+            if line.startswith(b'event: '):
+                event_name = line[7:].strip()
+            elif line.startswith(b'data: '):
+                if event_name == b'message':
+                    sent_at = json.loads(line[6:]).get('sentAt')
+                    if sent_at:
+                        recorder.latencies.append(time.time() - sent_at)
+                    recorder.received += 1
+                elif event_name == b'resync':
+                    recorder.resyncs += 1
+    finally:
+        writer.close()
+
+
+def publisher(dsn: str, channels: int, rate: float, duration: float, published: List[int]) -> None:
+    conn = psycopg2.connect(dsn)
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    cursor = conn.cursor()
+    interval = 1.0 / rate
+    deadline = time.monotonic() + duration
+    seq = 0
+    next_at = time.monotonic()
+    while time.monotonic() < deadline:
+        seq += 1
+        event = {'t': 'new', 'id': seq, 'q': seq, 'c': seq % channels + 1, 'd': None,
+                 's': 1, 'b': 'load test', 'sentAt': time.time()}
+        cursor.execute('SELECT pg_notify(%s, %s)', (EVENTS_CHANNEL, json.dumps(event)))
+        next_at += interval
+        pause = next_at - time.monotonic()
+        if pause > 0:
+            time.sleep(pause)
+    published.append(seq)
+    conn.close()
+
+
+def rss_kb(pid: int) -> int:
+    """Resident set size of a process, from /proc"""
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+async def run(args) -> dict:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    wanted = args.connections + 256
+    if soft < wanted:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (min(wanted, hard), hard))
+
+    recorder = Recorder()
+    stop = asyncio.Event()
+    rss_before = rss_kb(args.gateway_pid) if args.gateway_pid else None
+    tasks = []
+    for i in range(args.connections):
+        tasks.append(asyncio.create_task(
+            client(args.host, args.port, i + 1, i % args.channels + 1, recorder, stop)
+        ))
+        if i % 500 == 499:
+            await asyncio.sleep(0.05)
+    while recorder.connected + recorder.failed < args.connections:
+        await asyncio.sleep(0.1)
+    rss_connected = rss_kb(args.gateway_pid) if args.gateway_pid else None
+
+    published: List[int] = []
+    thread = threading.Thread(target=publisher, args=(
+        os.environ['DATABASE_URL'], args.channels, args.rate, args.duration, published
+    ))
+    started = time.monotonic()
+    thread.start()
+    while thread.is_alive():
+        await asyncio.sleep(0.1)
+    await asyncio.sleep(args.drain)
+    elapsed = time.monotonic() - started
+    rss_after = rss_kb(args.gateway_pid) if args.gateway_pid else None
+    stop.set()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    expected = published[0] * args.connections / args.channels if published else 0
+    latencies_ms = [value * 1000 for value in recorder.latencies]
+    report = {
+        'connections': recorder.connected,
+        'failedConnections': recorder.failed,
+        'published': published[0] if published else 0,
+        'delivered': recorder.received,
+        'expectedDeliveries': int(expected),
+        'resyncs': recorder.resyncs,
+        'deliveredPerSec': round(recorder.received / elapsed, 1),
+        'latencyMs': {
+            'p50': round(percentile(latencies_ms, 50), 2),
+            'p95': round(percentile(latencies_ms, 95), 2),
+            'p99': round(percentile(latencies_ms, 99), 2),
+            'mean': round(statistics.fmean(latencies_ms), 2) if latencies_ms else 0.0
+        }
+    }
+    if rss_before is not None:
+        report['gatewayRssMb'] = {
+            'idle': round(rss_before / 1024, 1),
+            'connected': round(rss_connected / 1024, 1),
+            'afterPublish': round(rss_after / 1024, 1)
+        }
+        report['rssPerConnectionKb'] = round((rss_connected - rss_before) / max(recorder.connected, 1), 2)
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--connections', type=int, default=10000)
+    parser.add_argument('--channels', type=int, default=100)
+    parser.add_argument('--rate', type=float, default=200.0, help='published events per second')
+    parser.add_argument('--duration', type=float, default=30.0)
+    parser.add_argument('--drain', type=float, default=2.0, help='seconds to wait for stragglers')
+    parser.add_argument('--gateway-pid', type=int, help='report this gateway process\'s memory per connection')
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,465 @@
+'''
+Query-plan regression check: every handler action is run against a large seeded database and
+the plan of each SQL statement it executes is checked.
+
+The migrations are applied first; with --seed, tools/bench/seed.py then fills the database
+(the defaults give several million rows, --scale multiplies the counts). The tests.json
+entries of the four functions plus REQUESTS below, which reach the remaining actions, are
+sent to the real handlers in-process as a few sampled server owners. The handlers' pools hand
+out connections whose cursors run each statement first under EXPLAIN (ANALYZE, BUFFERS) in
+a savepoint that is rolled back, then for real so the handler carries on as usual; commit()
+rolls back as well, so the database stays as seeded and the check can be rerun. The one thing
+committed is a pending purge job per sampled user, for resumePurge and purgeStatus to find;
+those are deleted again at the end.
+
+A statement fails when its plan sequentially scans a table estimated above --large-table-rows,
+or when it touches more shared buffers than its budget (BUFFER_BUDGETS, or --budget). The
+exit status is 1 when anything failed.
+
+Usage:
+    DATABASE_URL=postgresql://localhost/incordes_plan python tools/plancheck/plancheck.py --seed
+    DATABASE_URL=... python tools/plancheck/plancheck.py --only messages: --budget "messages:Search messages=50000"
+'''
+
+import argparse
+import copy
+import json
+import os
+import re
+import sys
+from typing import Dict, Any, List, Optional, Tuple
+
+import psycopg2
+import psycopg2.extensions
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'bench'))
+import seed  # noqa: E402
+from common import apply_migrations, connect, load_handler  # noqa: E402
+from run_handlers import FUNCTIONS, Context, build_event, load_scenarios  # noqa: E402
+
+SEED_DEFAULTS = {
+    'users': 200_000,
+    'servers': 4_000,
+    'channels_per_server': 8,
+    'members_per_server': 250,
+    'friends_per_user': 10,
+    'messages_per_channel': 100,
+    'dms': 1_000_000,
+    'history_days': 180
+}
+SCALED = ['users', 'servers', 'messages_per_channel', 'dms']
+EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'VALUES')
+COPY_QUERY = re.compile(r'^\s*COPY\s*\((.*)\)\s*TO\s+STDOUT', re.S | re.I)
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+VALUES_LIST = re.compile(r'VALUES\s*\(.*?\)(?:\s*,\s*\(.*?\))*', re.S)
+# Shared buffers (hit + read) one statement may touch; keys are "function:request name" or "*"
+BUFFER_BUDGETS = {
+    '*': 1000,
+    # A catch-up from change cursor 0 walks the feed until it finds a page the user may read
+    'messages:Sync message changes': 10000,
+    # Ranking needs every match the user can read; the probe term hits ~1% of messages
+    'messages:Search messages': 20000,
+    'messages:Export channel history': 5000,
+    'messages:Unread counts': 5000,
+    # A batch deletes up to PURGE_BATCH_SIZE rows: heap, every index and a tombstone insert for each
+    'messages:Purge channel': 15000,
+    'messages:Purge sender across server': 15000,
+    'messages:Resume purge': 15000,
+    # One users row per member, whole server at once
+    'auth:Presence of server members': 2000,
+    'servers:Bootstrap servers, channels and friends': 5000
+}
+
+# Actions the tests.json entries do not reach. "{name}" values are filled from the sampled user
+REQUESTS = {
+    'auth': [
+        {'name': 'Log in', 'method': 'POST', 'body': {'action': 'login', 'email': '{email}', 'password': 'x'}},
+        {'name': 'Presence of server members', 'method': 'POST', 'headers': {'X-User-Id': '{user}'},
+         'body': {'action': 'presence', 'serverId': '{server}'}},
+        {'name': 'Presence of users', 'method': 'POST', 'headers': {'X-User-Id': '{user}'},
+         'body': {'action': 'presence', 'userIds': '{friends}'}}
+    ],
+    'friends': [
+        {'name': 'Get outgoing friend requests page', 'method': 'GET', 'headers': {'X-User-Id': '{user}'},
+         'queryStringParameters': {'status': 'outgoing', 'limit': '50'}},
+        {'name': 'Accept friend request', 'method': 'POST', 'headers': {'X-User-Id': '{user}'},
+         'body': {'action': 'accept', 'friendId': '{incoming}'}},
+        {'name': 'Remove friend', 'method': 'DELETE', 'headers': {'X-User-Id': '{user}'},
+         'queryStringParameters': {'friendId': '{friend}'}}
+    ],
+    'messages': [
+        {'name': 'Get DM messages', 'method': 'GET', 'headers': {'X-User-Id': '{user}'},
+         'queryStringParameters': {'recipientId': '{peer}'}},
+        {'name': 'Sync recent changes', 'method': 'GET', 'headers': {'X-User-Id': '{user}'},
+         'queryStringParameters': {'action': 'sync', 'cursor': '{recentChange}'}},
+        {'name': 'Get messages with users map', 'method': 'GET', 'headers': {'X-User-Id': '{user}'},
+         'queryStringParameters': {'channelId': '{channel}', 'users': 'map'}},
+        {'name': 'Unread counts', 'method': 'GET', 'headers': {'X-User-Id': '{user}'},
+         'queryStringParameters': {'action': 'unread'}},
+        {'name': 'Search messages', 'method': 'GET', 'headers': {'X-User-Id': '{user}'},
+         'queryStringParameters': {'action': 'search', 'q': '77'}},
+        {'name': 'Search one channel', 'method': 'GET', 'headers': {'X-User-Id': '{user}'},
+         'queryStringParameters': {'action': 'search', 'q': '77', 'channelId': '{channel}'}},
+        {'name': 'Export channel history', 'method': 'GET', 'headers': {'X-User-Id': '{user}'},
+         'queryStringParameters': {'action': 'export', 'channelId': '{channel}', 'limit': '1000'}},
+        {'name': 'Acknowledge channel read', 'method': 'POST', 'headers': {'X-User-Id': '{user}'},
+         'body': {'action': 'ack', 'channelId': '{channel}', 'messageId': '{message}'}},
+        {'name': 'Edit message', 'method': 'PUT', 'headers': {'X-User-Id': '{user}'},
+         'body': {'messageId': '{message}', 'content': 'edited'}},
+        {'name': 'Delete message', 'method': 'DELETE', 'headers': {'X-User-Id': '{user}'},
+         'queryStringParameters': {'messageId': '{message}'}},
+        {'name': 'Bulk delete own messages', 'method': 'POST', 'headers': {'X-User-Id': '{user}'},
+         'body': {'action': 'bulkDelete', 'messageIds': ['{message}']}},
+        {'name': 'Purge channel', 'method': 'POST', 'headers': {'X-User-Id': '{user}'},
+         'body': {'action': 'purge', 'channelId': '{ownedFirstChannel}'}},
+        {'name': 'Purge sender across server', 'method': 'POST', 'headers': {'X-User-Id': '{user}'},
+         'body': {'action': 'purge', 'serverId': '{ownedServer}', 'senderId': '{user}'}},
+        {'name': 'Resume purge', 'method': 'POST', 'headers': {'X-User-Id': '{user}'},
+         'body': {'action': 'resumePurge', 'jobId': '{purgeJob}'}},
+        {'name': 'Purge status', 'method': 'GET', 'headers': {'X-User-Id': '{user}'},
+         'queryStringParameters': {'action': 'purgeStatus', 'jobId': '{purgeJob}'}}
+    ],
+    'servers': [
+        {'name': 'Get channels', 'method': 'GET', 'headers': {'X-User-Id': '{user}'},
+         'queryStringParameters': {'serverId': '{server}'}},
+        {'name': 'Move channel', 'method': 'POST', 'headers': {'X-User-Id': '{user}'},
+         'body': {'action': 'moveChannel', 'serverId': '{ownedServer}', 'channelId': '{ownedFirstChannel}',
+                  'afterChannelId': '{ownedLastChannel}'}},
+        {'name': 'Reorder channels', 'method': 'POST', 'headers': {'X-User-Id': '{user}'},
+         'body': {'action': 'reorderChannels', 'serverId': '{ownedServer}', 'channelIds': '{ownedChannels}'}}
+    ]
+}
+
+
+class Collector:
+    """Plans of the statements run by the request in progress"""
+
+    def __init__(self):
+        self.request: Optional[str] = None
+        self.plans: List[Tuple[str, Any]] = []
+
+
+collector = Collector()
+
+
+def fingerprint(query: Any) -> str:
+    """Statement text with literals and VALUES lists folded, so batches built by execute_values group together"""
+    text = query.decode() if isinstance(query, bytes) else query
+    text = VALUES_LIST.sub('VALUES (...)', LITERALS.sub('?', text))
+    return ' '.join(text.split())[:300]
+
+
+class ExplainMixin:
+    """Cursor mixin that explains every plannable statement before running it"""
+
+    def _explain(self, query: Any, vars=None) -> None:
+        text = query.decode() if isinstance(query, bytes) else query
+        if collector.request is None or not text.lstrip().upper().startswith(EXPLAINABLE):
+            return
+        if self.connection.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+            return
+        super().execute('SAVEPOINT plancheck')
+        try:
+            super().execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + text, vars)
+            collector.plans.append((fingerprint(query), self.fetchone()[0]))
+        except psycopg2.Error as exc:
+            # The real run below raises the same error to the handler
+            collector.plans.append((fingerprint(query), {'error': str(exc).strip()}))
+        finally:
+            super().execute('ROLLBACK TO SAVEPOINT plancheck')
+            super().execute('RELEASE SAVEPOINT plancheck')
+
+    def execute(self, query, vars=None):
+        self._explain(query, vars)
+        return super().execute(query, vars)
+
+    def copy_expert(self, sql, file, size=8192):
+        match = COPY_QUERY.match(sql)
+        if match:
+            self._explain(match.group(1))
+        return super().copy_expert(sql, file, size)
+
+
+class RollbackConnection(psycopg2.extensions.connection):
+    """Handlers commit as usual; nothing they write is kept"""
+
+    def commit(self):
+        self.rollback()
+
+
+def instrument_pool(module) -> None:
+    pool = module.db.get_pool()
+    base = pool.cursor_factory or psycopg2.extensions.cursor
+    pool.cursor_factory = type('ExplainCursor', (ExplainMixin, base), {})
+    pool.connect = lambda: psycopg2.connect(pool.dsn, connection_factory=RollbackConnection,
+                                            cursor_factory=pool.cursor_factory)
+
+
+def sample_users(conn, count: int) -> List[Dict[str, Any]]:
+    """Server owners that are also members somewhere, with the ids their requests need"""
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT DISTINCT s.owner_id FROM servers s
+        WHERE EXISTS (SELECT 1 FROM server_members sm WHERE sm.user_id = s.owner_id)
+        ORDER BY s.owner_id
+        LIMIT %s
+    """, (count,))
+    owners = cursor.fetchall()
+    # A sync cursor about 2000 changes behind the newest one
+    cursor.execute("""
+        SELECT change_xid::text || '.' || change_seq FROM messages
+        ORDER BY change_xid DESC, change_seq DESC
+        OFFSET 2000 LIMIT 1
+    """)
+    recent_change = (cursor.fetchone() or ('0',))[0]
+    users = []
+    for (user_id,) in owners:
+        cursor.execute("SELECT email, incordes_id FROM users WHERE id = %s", (user_id,))
+        email, incordes_id = cursor.fetchone()
+        cursor.execute("""
+            SELECT array_agg(DISTINCT sm.server_id), array_agg(c.id)
+            FROM server_members sm JOIN channels c ON c.server_id = sm.server_id
+            WHERE sm.user_id = %s
+        """, (user_id,))
+        servers, channels = cursor.fetchone()
+        cursor.execute("""
+            SELECT s.id, array_agg(c.id ORDER BY c.position, c.id)
+            FROM servers s JOIN channels c ON c.server_id = s.id
+            WHERE s.owner_id = %s
+            GROUP BY s.id
+            ORDER BY s.id
+            LIMIT 1
+        """, (user_id,))
+        owned = cursor.fetchone() or (None, [None])
+        cursor.execute("""
+            SELECT state, array_agg(peer_id) FROM friend_edges WHERE user_id = %s GROUP BY state
+        """, (user_id,))
+        edges = dict(cursor.fetchall())
+        cursor.execute("""
+            SELECT id FROM messages WHERE sender_id = %s ORDER BY created_at DESC LIMIT 1
+        """, (user_id,))
+        message = cursor.fetchone()
+        cursor.execute("""
+            SELECT array_agg(DISTINCT recipient_id) FROM (
+                SELECT recipient_id FROM messages
+                WHERE sender_id = %s AND recipient_id IS NOT NULL
+                ORDER BY created_at DESC LIMIT 20
+            ) r
+        """, (user_id,))
+        peers = cursor.fetchone()[0] or []
+        users.append({
+            'id': user_id,
+            'incordesId': incordes_id,
+            'email': email,
+            'servers': servers,
+            'channels': channels,
+            'peers': peers,
+            'targets': {
+                'user': str(user_id),
+                'email': email,
+                'server': str(servers[0]),
+                'channel': str(channels[0]),
+                'peer': str(peers[0]) if peers else None,
+                'message': message[0] if message else None,
+                'recentChange': str(recent_change),
+                'friend': (edges.get('friends') or [None])[0],
+                'friends': edges.get('friends') or [],
+                'incoming': (edges.get('incoming') or [None])[0],
+                'ownedServer': owned[0],
+                'ownedChannels': owned[1],
+                'ownedFirstChannel': owned[1][0],
+                'ownedLastChannel': owned[1][-1]
+            }
+        })
+    conn.rollback()
+    return users
+
+
+def add_purge_jobs(conn, users: List[Dict[str, Any]]) -> List[int]:
+    """A committed pending purge job of each user's owned first channel, as the "purgeJob" target"""
+    cursor = conn.cursor()
+    jobs = []
+    for user in users:
+        targets = user['targets']
+        cursor.execute("""
+            INSERT INTO purge_jobs (server_id, channel_id, requested_by) VALUES (%s, %s, %s) RETURNING id
+        """, (targets['ownedServer'], targets['ownedFirstChannel'], user['id']))
+        targets['purgeJob'] = cursor.fetchone()[0]
+        jobs.append(targets['purgeJob'])
+    conn.commit()
+    return jobs
+
+
+def fill(value: Any, targets: Dict[str, Any]) -> Any:
+    if isinstance(value, dict):
+        return {k: fill(v, targets) for k, v in value.items()}
+    if isinstance(value, list):
+        return [fill(v, targets) for v in value]
+    if isinstance(value, str) and value.startswith('{') and value.endswith('}') and value[1:-1] in targets:
+        return targets[value[1:-1]]
+    return value
+
+
+def build_request(test: Dict[str, Any], user: Dict[str, Any], users: List[Dict[str, Any]]) -> Dict[str, Any]:
+    if test.get('plancheck'):
+        test = fill(copy.deepcopy(test), user['targets'])
+        return {
+            'httpMethod': test['method'],
+            'headers': test.get('headers', {}),
+            'queryStringParameters': test.get('queryStringParameters', {}),
+            'body': json.dumps(test['body']) if 'body' in test else '{}',
+            'isBase64Encoded': False
+        }
+    return build_event(test, user, users)
+
+
+def large_tables(conn, min_rows: float) -> Dict[str, float]:
+    cursor = conn.cursor()
+    cursor.execute("SELECT relname, reltuples FROM pg_class WHERE relkind IN ('r', 'm') AND reltuples >= %s", (min_rows,))
+    tables = dict(cursor.fetchall())
+    conn.rollback()
+    return tables
+
+
+def walk(node: Dict[str, Any]):
+    yield node
+    for child in node.get('Plans', []):
+        yield from walk(child)
+
+
+def check(plan: Any, large: Dict[str, float], budget: int) -> Tuple[Dict[str, Any], List[str]]:
+    """Summary of one EXPLAIN result and what is wrong with it"""
+    if isinstance(plan, dict):
+        return {'error': plan['error']}, []
+    root = plan[0]['Plan']
+    buffers = root.get('Shared Hit Blocks', 0) + root.get('Shared Read Blocks', 0)
+    summary = {
+        'ms': round(plan[0].get('Execution Time', 0.0), 3),
+        'buffers': buffers,
+        'rows': root.get('Actual Rows')
+    }
+    failures = []
+    for node in walk(root):
+        relation = node.get('Relation Name')
+        if node['Node Type'] in ('Seq Scan', 'Parallel Seq Scan') and relation in large:
+            failures.append(f"seq scan on {relation} (~{int(large[relation])} rows)")
+    if buffers > budget:
+        failures.append(f"{buffers} buffers, budget {budget}")
+    return summary, failures
+
+
+def run(args, users: List[Dict[str, Any]], large: Dict[str, float], budgets: Dict[str, int]) -> Dict[str, Any]:
+    modules = {name: load_handler(name) for name in FUNCTIONS}
+    for module in modules.values():
+        instrument_pool(module)
+
+    scenarios = [(key, test) for key, test, _ in load_scenarios({})]
+    for name in FUNCTIONS:
+        scenarios += [(f"{name}:{test['name']}", dict(test, plancheck=True)) for test in REQUESTS.get(name, [])]
+    if args.only:
+        scenarios = [(key, test) for key, test in scenarios if any(part in key for part in args.only)]
+
+    statements: Dict[Tuple[str, str], Dict[str, Any]] = {}
+    requests = []
+    for key, test in scenarios:
+        name = key.split(':', 1)[0]
+        budget = budgets.get(key, budgets['*'])
+        statuses: Dict[str, int] = {}
+        for user in users:
+            collector.request, collector.plans = key, []
+            try:
+                status = modules[name].handler(build_request(test, user, users), Context(name))['statusCode']
+            except Exception as exc:
+                status = type(exc).__name__
+            finally:
+                collector.request = None
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            for statement, plan in collector.plans:
+                summary, failures = check(plan, large, budget)
+                entry = statements.setdefault((key, statement), {
+                    'request': key, 'statement': statement, 'calls': 0, 'maxBuffers': 0, 'maxMs': 0.0, 'failures': []
+                })
+                entry['calls'] += 1
+                entry['maxBuffers'] = max(entry['maxBuffers'], summary.get('buffers', 0))
+                entry['maxMs'] = max(entry['maxMs'], summary.get('ms', 0.0))
+                if 'error' in summary:
+                    entry['error'] = summary['error']
+                for failure in failures:
+                    if failure not in entry['failures']:
+                        entry['failures'].append(failure)
+        failed = [e for e in statements.values() if e['request'] == key and e['failures']]
+        line = {'request': key, 'statuses': statuses, 'budget': budget,
+                'statements': sum(1 for k in statements if k[0] == key), 'failed': len(failed)}
+        requests.append(line)
+        print(json.dumps(line), flush=True)
+
+    failures = [e for e in statements.values() if e['failures']]
+    return {
+        'largeTables': len(large),
+        'requests': requests,
+        'statements': list(statements.values()),
+        'failures': failures
+    }
+
+
+def seed_database(conn, args) -> None:
+    params = dict(SEED_DEFAULTS)
+    for key in SCALED:
+        params[key] = max(1, int(params[key] * args.scale))
+    params['members_per_server'] = min(params['members_per_server'], params['users'])
+    seed.seed(conn, argparse.Namespace(**params))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seed', action='store_true', help='seed the database first (it should be empty)')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplier for the seeded row counts')
+    parser.add_argument('--samples', type=int, default=3, help='sampled users each request is run as')
+    parser.add_argument('--large-table-rows', type=float, default=10_000,
+                        help='sequential scans of tables estimated above this fail')
+    parser.add_argument('--budget', action='append', default=[], help='"function:request name=buffers" or "*=buffers"')
+    parser.add_argument('--only', action='append', default=[], help='run requests whose key contains this')
+    parser.add_argument('--out', help='write the JSON report, with every statement, here')
+    args = parser.parse_args()
+
+    os.environ.setdefault('REQUEST_LOG', '0')
+    os.environ.setdefault('DB_POOL_MAX_SIZE', '1')
+    conn = connect()
+    applied = apply_migrations(conn)
+    print(json.dumps({'migrationsApplied': applied}), flush=True)
+    if args.seed:
+        seed_database(conn, args)
+    conn.autocommit = True
+    conn.cursor().execute('ANALYZE')
+    conn.autocommit = False
+
+    budgets = dict(BUFFER_BUDGETS)
+    for spec in args.budget:
+        key, value = spec.rsplit('=', 1)
+        budgets[key] = int(value)
+    users = sample_users(conn, args.samples)
+    if not users:
+        sys.exit('No server owner with memberships found; seed the database with --seed')
+    jobs = add_purge_jobs(conn, users)
+    try:
+        report = run(args, users, large_tables(conn, args.large_table_rows), budgets)
+    finally:
+        conn.rollback()
+        conn.cursor().execute('DELETE FROM purge_jobs WHERE id = ANY(%s)', (jobs,))
+        conn.commit()
+
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    for entry in report['failures']:
+        print(json.dumps({'failed': entry['request'], 'statement': entry['statement'][:160],
+                          'maxBuffers': entry['maxBuffers'], 'reasons': entry['failures']}))
+    print(json.dumps({'requests': len(report['requests']), 'statements': len(report['statements']),
+                      'failed': len(report['failures'])}))
+    sys.exit(1 if report['failures'] else 0)
+
+
+if __name__ == '__main__':
+    main()
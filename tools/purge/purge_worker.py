@@ -0,0 +1,77 @@
+'''
+Background runner for message purge jobs (purge_jobs, V0014).
+
+POST messages {action: 'purge'} deletes for PURGE_REQUEST_SECONDS within the request and
+answers 202 when batches remain; the job stays 'pending' until someone continues it. This
+worker continues such jobs, and 'running' ones whose runner died (their advisory lock is
+free again), oldest first, in slices of --slice seconds through the handler's own run_purge,
+so batching, tombstones and push events are exactly those of the request path. Jobs that
+failed are left for a moderator to retry with resumePurge. One JSON line per slice.
+
+Several workers can run at once: a job held by another runner is skipped.
+
+Usage:
+    DATABASE_URL=... python tools/purge/purge_worker.py --slice 30 --pause 0.05
+    DATABASE_URL=... python tools/purge/purge_worker.py --once
+'''
+
+import argparse
+import json
+import os
+import sys
+import time
+from typing import List
+
+import psycopg2
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'bench'))
+from common import connect, load_handler  # noqa: E402
+
+
+def unfinished_jobs(conn) -> List[int]:
+    cursor = conn.cursor()
+    cursor.execute("SELECT id FROM purge_jobs WHERE state IN ('pending', 'running') ORDER BY id")
+    ids = [row[0] for row in cursor.fetchall()]
+    conn.rollback()
+    return ids
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--slice', type=float, default=30.0, help='seconds spent on one job before moving on')
+    parser.add_argument('--pause', type=float, default=0.0, help='sleep between batches, lets replicas and vacuum keep up')
+    parser.add_argument('--interval', type=float, default=5.0, help='seconds to wait when there is nothing to do')
+    parser.add_argument('--once', action='store_true', help='exit once no unfinished job is left')
+    args = parser.parse_args()
+
+    messages = load_handler('messages')
+    conn = connect()
+    while True:
+        progressed = False
+        for job_id in unfinished_jobs(conn):
+            started = time.perf_counter()
+            try:
+                job = messages.run_purge(conn, job_id, args.slice, args.pause)
+            except psycopg2.Error as exc:
+                # run_purge has marked the job failed; the other jobs carry on
+                print(json.dumps({'jobId': job_id, 'state': 'failed', 'error': str(exc).strip()}), flush=True)
+                continue
+            if job is None:
+                continue
+            progressed = True
+            print(json.dumps({
+                'jobId': job_id,
+                'state': job['state'],
+                'deleted': job['deleted'],
+                'batches': job['batches'],
+                'seconds': round(time.perf_counter() - started, 2)
+            }), flush=True)
+        if not progressed:
+            if args.once:
+                return
+            time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+'''
+Download a channel's or DM's full history as an NDJSON archive through messages ?action=export.
+
+Follows X-Next-Cursor chunk by chunk and appends each chunk to the output file as it
+arrives, so neither side holds more than one chunk. A .gz output path is gzip-compressed.
+An interrupted download can be continued with --cursor (the last cursor is printed
+after every chunk) and --append.
+
+Usage:
+    python tools/transfer/export_messages.py --url https://functions.poehali.dev/<messages id> \
+        --token <auth token> --channel-id 12 --out channel-12.ndjson.gz
+'''
+
+import argparse
+import gzip
+import json
+import sys
+import time
+import urllib.request
+from urllib.parse import urlencode
+
+
+def fetch_chunk(url: str, token: str, params: dict) -> tuple:
+    request = urllib.request.Request(
+        f'{url}?{urlencode(params)}',
+        headers={'X-Auth-Token': token, 'Accept-Encoding': 'gzip'}
+    )
+    with urllib.request.urlopen(request, timeout=120) as reply:
+        body = reply.read()
+        if reply.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return body, int(reply.headers.get('X-Export-Rows', '0')), reply.headers.get('X-Next-Cursor')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', required=True, help='messages function URL')
+    parser.add_argument('--token', required=True)
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--channel-id', type=int)
+    target.add_argument('--recipient-id', type=int)
+    parser.add_argument('--out', required=True)
+    parser.add_argument('--chunk', type=int, default=5000, help='rows per request (the server caps it)')
+    parser.add_argument('--cursor', help='continue after this cursor')
+    parser.add_argument('--append', action='store_true', help='append to --out instead of replacing it')
+    args = parser.parse_args()
+
+    params = {'action': 'export', 'limit': args.chunk}
+    if args.channel_id:
+        params['channelId'] = args.channel_id
+    else:
+        params['recipientId'] = args.recipient_id
+    cursor = args.cursor
+    opener = gzip.open if args.out.endswith('.gz') else open
+    total = 0
+    started = time.perf_counter()
+
+    with opener(args.out, 'ab' if args.append else 'wb') as out:
+        while True:
+            if cursor:
+                params['cursor'] = cursor
+            body, rows, cursor = fetch_chunk(args.url, args.token, params)
+            out.write(body)
+            total += rows
+            print(json.dumps({'rows': total, 'cursor': cursor}), file=sys.stderr, flush=True)
+            if not cursor:
+                break
+
+    seconds = time.perf_counter() - started
+    print(json.dumps({'out': args.out, 'rows': total, 'seconds': round(seconds, 2),
+                      'rowsPerSec': round(total / seconds) if seconds else None}))
+
+
+if __name__ == '__main__':
+    main()
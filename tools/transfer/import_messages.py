@@ -0,0 +1,180 @@
+'''
+Bulk import of NDJSON message archives (the format of messages ?action=export) with COPY.
+
+Each file is streamed into a temporary staging table with COPY FROM, so memory stays flat
+whatever its size, then moved into messages with one INSERT ... SELECT per file and
+committed. Senders and DM recipients are mapped from incordesId to local users; lines whose
+users do not exist here are counted as skipped. Lines without a recipient are channel
+messages and go to --channel-id; without it they are skipped too.
+
+New ids are assigned unless --keep-ids is given (for loads into an empty deployment; rows
+already imported with the same id and time are then skipped, so a rerun is safe). Afterwards
+the messages id sequence is moved past the highest id and the table is analyzed.
+--rebuild-indexes drops the secondary messages indexes for the duration of the load and
+recreates them at the end, which is faster for large loads but blocks reads meanwhile:
+use it on a quiet deployment.
+
+Usage:
+    DATABASE_URL=... python tools/transfer/import_messages.py --channel-id 7 channel-12.ndjson.gz
+    DATABASE_URL=... python tools/transfer/import_messages.py --keep-ids --rebuild-indexes dms/*.ndjson.gz
+'''
+
+import argparse
+import gzip
+import json
+import os
+import time
+from typing import Dict, Any, List, Optional, Tuple
+
+import psycopg2
+
+# Same options as the export: one JSON document per line, read into a single jsonb column
+COPY_OPTIONS = "FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02'"
+COPY_BUFFER = 1 << 20
+
+
+def connect():
+    return psycopg2.connect(os.environ['DATABASE_URL'])
+
+
+def rate(rows: int, seconds: float) -> Optional[int]:
+    return round(rows / seconds) if seconds else None
+
+
+def secondary_indexes(conn) -> List[Tuple[str, str]]:
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT c.relname, pg_get_indexdef(x.indexrelid)
+        FROM pg_index x
+        JOIN pg_class c ON c.oid = x.indexrelid
+        WHERE x.indrelid = 'messages'::regclass AND NOT x.indisprimary AND NOT x.indisunique
+        ORDER BY c.relname
+    """)
+    return cursor.fetchall()
+
+
+def stage(conn, path: str) -> Tuple[int, float]:
+    cursor = conn.cursor()
+    cursor.execute('TRUNCATE transfer_staging')
+    started = time.perf_counter()
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        cursor.copy_expert(f'COPY transfer_staging (doc) FROM STDIN WITH ({COPY_OPTIONS})', f, size=COPY_BUFFER)
+    cursor.execute('DELETE FROM transfer_staging WHERE doc IS NULL')
+    cursor.execute('SELECT count(*) FROM transfer_staging')
+    return cursor.fetchone()[0], time.perf_counter() - started
+
+
+def load(conn, channel_id: Optional[int], keep_ids: bool) -> Tuple[int, float]:
+    cursor = conn.cursor()
+    started = time.perf_counter()
+    cursor.execute("""
+        SELECT ensure_messages_partitions(min((doc->>'createdAt')::timestamp), max((doc->>'createdAt')::timestamp))
+        FROM transfer_staging
+        HAVING count(*) > 0
+    """)
+    cursor.execute(f"""
+        INSERT INTO messages ({'id, ' if keep_ids else ''}channel_id, sender_id, recipient_id, content, created_at, edited_at)
+        SELECT {"(st.doc->>'id')::integer, " if keep_ids else ''}
+               CASE WHEN st.doc->>'recipient' IS NULL THEN %(channel)s END,
+               s.id,
+               r.id,
+               st.doc->>'content',
+               (st.doc->>'createdAt')::timestamp,
+               (st.doc->>'editedAt')::timestamp
+        FROM transfer_staging st
+        JOIN users s ON s.incordes_id = st.doc->>'sender'
+        LEFT JOIN users r ON r.incordes_id = st.doc->>'recipient'
+        WHERE CASE WHEN st.doc->>'recipient' IS NULL THEN %(channel)s IS NOT NULL ELSE r.id IS NOT NULL END
+        ORDER BY (st.doc->>'createdAt')::timestamp, (st.doc->>'id')::integer
+        {'ON CONFLICT DO NOTHING' if keep_ids else ''}
+    """, {'channel': channel_id})
+    return cursor.rowcount, time.perf_counter() - started
+
+
+def import_file(conn, path: str, channel_id: Optional[int], keep_ids: bool) -> Dict[str, Any]:
+    staged, copy_seconds = stage(conn, path)
+    inserted, insert_seconds = load(conn, channel_id, keep_ids)
+    conn.commit()
+    return {
+        'file': path,
+        'staged': staged,
+        'inserted': inserted,
+        'skipped': staged - inserted,
+        'copySeconds': round(copy_seconds, 2),
+        'copyRowsPerSec': rate(staged, copy_seconds),
+        'insertSeconds': round(insert_seconds, 2),
+        'insertRowsPerSec': rate(inserted, insert_seconds)
+    }
+
+
+def finish(conn) -> float:
+    """Move the id sequence past imported ids and refresh planner statistics"""
+    started = time.perf_counter()
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT setval(pg_get_serial_sequence('messages', 'id'), GREATEST(max(id), 1)) FROM messages
+    """)
+    conn.commit()
+    conn.autocommit = True
+    try:
+        cursor.execute('ANALYZE messages')
+    finally:
+        conn.autocommit = False
+    return time.perf_counter() - started
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='+', help='.ndjson or .ndjson.gz archives')
+    parser.add_argument('--channel-id', type=int, help='local channel that receives channel messages')
+    parser.add_argument('--keep-ids', action='store_true', help='keep the exported message ids')
+    parser.add_argument('--rebuild-indexes', action='store_true', help='drop secondary indexes during the load')
+    parser.add_argument('--maintenance-work-mem', default='512MB', help='used when rebuilding indexes')
+    args = parser.parse_args()
+
+    conn = connect()
+    cursor = conn.cursor()
+    cursor.execute('CREATE TEMP TABLE transfer_staging (doc jsonb)')
+    conn.commit()
+
+    dropped: List[Tuple[str, str]] = []
+    if args.rebuild_indexes:
+        dropped = secondary_indexes(conn)
+        for name, _ in dropped:
+            cursor.execute(f'DROP INDEX {name}')
+        conn.commit()
+
+    started = time.perf_counter()
+    total = 0
+    index_seconds = 0.0
+    try:
+        for path in args.files:
+            report = import_file(conn, path, args.channel_id, args.keep_ids)
+            total += report['inserted']
+            print(json.dumps(report), flush=True)
+    finally:
+        conn.rollback()
+        if dropped:
+            index_started = time.perf_counter()
+            cursor.execute('SET maintenance_work_mem = %s', (args.maintenance_work_mem,))
+            for _, definition in dropped:
+                # Definitions of partitioned indexes read "ON ONLY messages", which would skip the partitions
+                cursor.execute(definition.replace(' ON ONLY ', ' ON ', 1))
+            conn.commit()
+            index_seconds = time.perf_counter() - index_started
+
+    finish_seconds = finish(conn)
+    seconds = time.perf_counter() - started
+    print(json.dumps({
+        'files': len(args.files),
+        'inserted': total,
+        'indexSeconds': round(index_seconds, 2),
+        'finishSeconds': round(finish_seconds, 2),
+        'seconds': round(seconds, 2),
+        'rowsPerSec': rate(total, seconds)
+    }))
+
+
+if __name__ == '__main__':
+    main()